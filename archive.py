@@ -0,0 +1,339 @@
+"""
+Write the tarball for a stage 2 dir in a single pass.
+
+The stage dir is walked once (see the treewalk module, which also does the
+last fixes on the way).  Files from stage 1 (an exact-path set) and files
+matching the exclude patterns are left out, directories that end up empty are
+pruned (except for the ones we want to keep), and what is left is streamed
+into the compressed tarball, counting entries as they are written.
+The compression itself is done by one of the codecs from the compression
+module.
+
+Exclude patterns follow the rules GNU tar used for them when the tarball was
+made with `tar --exclude-from`: they are matched against the path relative to
+the stage dir, '*' matches '/' too, and excluding a directory excludes
+everything under it.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import grp
+import os
+import pwd
+import shutil
+import stat
+import tarfile
+import time
+
+import compression
+import treewalk
+from common import Error
+from treewalk import StageEntry, parent_dirs
+
+
+def read_stage1_filelist(stage1_filelist):
+    """Return the set of paths (relative to the stage dir) listed in a
+    stage1_filelist file
+
+    """
+    paths = set()
+    with open(stage1_filelist, 'r') as in_fh:
+        for line in in_fh:
+            line = line.rstrip('\n')
+            if line.startswith('./'):
+                line = line[2:]
+            if line:
+                paths.add(line)
+    return paths
+
+
+def scan_stage_dir(stage_dir_abs, excludes=None, exact_excludes=None, keep_dirs=None, visitors=None, stats=None):
+    """Walk stage_dir_abs and return a list of StageEntry objects for the
+    things to put in the tarball, in the order they should be written.
+    Entries whose relative paths are in the set exact_excludes or match one
+    of the patterns in excludes are skipped.  Directories that have nothing
+    left in them are skipped unless they are in keep_dirs.  The entries that
+    are not skipped are also passed to visitors (see the treewalk module),
+    e.g. to fix them up on the way.  If stats (a dict) is given, the stats
+    of the walk are stored in it.
+
+    """
+    walk = treewalk.TreeWalk(stage_dir_abs,
+                             [treewalk.Stage1Visitor(exact_excludes or set()),
+                              treewalk.ExcludeVisitor(excludes)]
+                             + list(visitors or [])
+                             + [treewalk.EmptyDirVisitor(keep_dirs)])
+    entries = walk.run()
+    if stats is not None:
+        stats.update(walk.stats())
+    return entries
+
+
+def _is_whiteout(st):
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def _is_opaque(path):
+    try:
+        return os.getxattr(path, 'trusted.overlay.opaque', follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+
+def _relpath_key(relpath):
+    # sorting on path components gives the same order as scan_stage_dir()
+    return relpath.split('/') if relpath else []
+
+
+class _OverlayUpperVisitor(treewalk.Visitor):
+    """Leave out whiteouts and stage 1 files that stage 2 modified (i.e.
+    files that are also in the lower layer) from a walk of the upper layer,
+    keeping track of whiteouts and opaque dirs
+
+    """
+    name = 'overlay'
+
+    def __init__(self, lower_dir, include_paths):
+        treewalk.Visitor.__init__(self)
+        self.lower_dir = lower_dir
+        self.include_paths = include_paths
+        self.whiteouts = set()
+        self.opaque_dirs = set()
+
+    def skip(self, relpath, dir_entry):
+        st = dir_entry.stat(follow_symlinks=False)
+        if _is_whiteout(st):
+            self.whiteouts.add(relpath)
+        elif stat.S_ISDIR(st.st_mode) or relpath in self.include_paths \
+                or not os.path.lexists(os.path.join(self.lower_dir, relpath)):
+            return False
+        self.changed += 1
+        return True
+
+    def visit(self, entry):
+        if stat.S_ISDIR(entry.st.st_mode) and _is_opaque(entry.path):
+            self.opaque_dirs.add(entry.relpath)
+
+
+def _copy_up(lower_dir, upper_dir, relpath):
+    """Copy relpath from the lower layer to the upper layer (whose parent
+    dir it must already have), as overlayfs would on a write, and return a
+    StageEntry for the copy
+
+    """
+    lower_path = os.path.join(lower_dir, relpath)
+    upper_path = os.path.join(upper_dir, relpath)
+    try:
+        st = os.lstat(lower_path)
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(upper_path):
+                os.mkdir(upper_path)
+            shutil.copystat(lower_path, upper_path)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(lower_path), upper_path)
+        else:
+            shutil.copy2(lower_path, upper_path)
+        return StageEntry(relpath, upper_path, os.lstat(upper_path))
+    except EnvironmentError as err:
+        raise Error("unable to copy %r up from the stage 1 layer: %s" % (relpath, err))
+
+
+def scan_overlay(upper_dir, lower_dir, excludes=None, include_paths=None, keep_dirs=None, visitors=None, stats=None):
+    """Like scan_stage_dir(), for a stage dir made of an overlay (no longer
+    mounted) of a stage 2 upper layer on a stage 1 lower layer.  Entries
+    come from the upper layer, leaving out whiteouts and stage 1 files that
+    stage 2 modified (i.e. files that are also in the lower layer).  The
+    files in the set include_paths are taken from the upper layer if they
+    are there, otherwise from the lower layer unless stage 2 removed them;
+    those are copied up into the upper layer first (the lower layer may be
+    a shared cache entry), and the copies are passed to visitors too.
+
+    """
+    exclude_re = treewalk.compile_excludes(excludes)
+    include_paths = include_paths or set()
+    keep_dirs = parent_dirs(keep_dirs or [])
+    overlay_visitor = _OverlayUpperVisitor(lower_dir, include_paths)
+    walk = treewalk.TreeWalk(upper_dir, [treewalk.ExcludeVisitor(excludes), overlay_visitor] + list(visitors or []))
+    found = dict((x.relpath, x) for x in walk.run() if x.relpath)
+    whiteouts = overlay_visitor.whiteouts
+    opaque_dirs = overlay_visitor.opaque_dirs
+
+    def _excluded(relpath):
+        return exclude_re and exclude_re.match(relpath)
+
+    def _hidden(relpath):
+        """Whether stage 2 removed or replaced relpath or one of its parents"""
+        parent = os.path.dirname(relpath)
+        while parent:
+            if parent in whiteouts or parent in opaque_dirs or (parent in found and not stat.S_ISDIR(found[parent].st.st_mode)):
+                return True
+            parent = os.path.dirname(parent)
+        return relpath in whiteouts
+
+    copied_up = []
+    for relpath in sorted(include_paths, key=_relpath_key):
+        lower_path = os.path.join(lower_dir, relpath)
+        if relpath in found or _excluded(relpath) or _hidden(relpath) or not os.path.lexists(lower_path):
+            continue
+        for path in sorted(parent_dirs([os.path.dirname(relpath)]), key=_relpath_key) + [relpath]:
+            if path not in found:
+                found[path] = _copy_up(lower_dir, upper_dir, path)
+                copied_up.append(found[path])
+    walk.visit_extra(copied_up)
+    if stats is not None:
+        stats.update(walk.stats())
+
+    # keep only the dirs that have something in them, as scan_stage_dir() does
+    wanted_dirs = keep_dirs | parent_dirs(os.path.dirname(x.relpath) for x in found.values() if not stat.S_ISDIR(x.st.st_mode))
+    entries = [x for x in found.values() if not stat.S_ISDIR(x.st.st_mode) or x.relpath in wanted_dirs]
+    if not entries:
+        return []
+    entries.sort(key=lambda x: _relpath_key(x.relpath))
+    return [StageEntry('', upper_dir, os.lstat(upper_dir))] + entries
+
+
+class _NameCache(object):
+    """Cache uid/gid to name lookups; there are only ever a handful of them"""
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def user(self, uid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self.users[uid] = ""
+        return self.users[uid]
+
+    def group(self, gid):
+        if gid not in self.groups:
+            try:
+                self.groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self.groups[gid] = ""
+        return self.groups[gid]
+
+
+def _make_tarinfo(entry, arcname, names, inodes):
+    st = entry.st
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.uname = names.user(st.st_uid)
+    tarinfo.gname = names.group(st.st_gid)
+    tarinfo.mtime = int(st.st_mtime)
+    tarinfo.size = 0
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        inode = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1 and inode in inodes:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = st.st_size
+            if st.st_nlink > 1:
+                inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(entry.path)
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        tarinfo.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    else:
+        return None
+    return tarinfo
+
+
+class ArchiveResult(object):
+    """What write_tarball() wrote, and how well it compressed"""
+    def __init__(self, filecount=0, codec="", uncompressed_size=0, compressed_size=0, seconds=0.0):
+        self.filecount = filecount
+        self.codec = codec
+        self.uncompressed_size = uncompressed_size
+        self.compressed_size = compressed_size
+        self.seconds = seconds
+
+    @property
+    def ratio(self):
+        if not self.compressed_size:
+            return 0.0
+        return float(self.uncompressed_size) / self.compressed_size
+
+    @property
+    def throughput(self):
+        """Uncompressed bytes per second"""
+        if not self.seconds:
+            return 0.0
+        return self.uncompressed_size / self.seconds
+
+    def to_dict(self):
+        return {'filecount': self.filecount,
+                'codec': self.codec,
+                'uncompressed_size': self.uncompressed_size,
+                'compressed_size': self.compressed_size,
+                'seconds': self.seconds,
+                'ratio': self.ratio,
+                'throughput': self.throughput}
+
+    @classmethod
+    def from_dict(cls, result_dict):
+        return cls(**dict((k, result_dict[k]) for k in
+                          ('filecount', 'codec', 'uncompressed_size', 'compressed_size', 'seconds')
+                          if k in result_dict))
+
+
+class _CountingWriter(object):
+    """Pass writes through to fileobj, counting the bytes"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.fileobj.write(data)
+
+
+def write_tarball(entries, tarball_abs, topdir, codec=None):
+    """Write entries (from scan_stage_dir()) into a tarball compressed with
+    codec (a compression.Codec; gzip if not specified), under the top-level
+    directory topdir.  Returns an ArchiveResult.
+
+    """
+    codec = codec or compression.Codec(compression.DEFAULT_CODEC)
+    names = _NameCache()
+    inodes = {}
+    count = 0
+    start_time = time.time()
+    try:
+        compressed_fh = codec.open(tarball_abs)
+        counter = _CountingWriter(compressed_fh)
+        try:
+            with tarfile.open(fileobj=counter, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                for entry in entries:
+                    arcname = topdir + '/' + entry.relpath if entry.relpath else topdir
+                    tarinfo = _make_tarinfo(entry, arcname, names, inodes)
+                    if tarinfo is None:
+                        continue
+                    if tarinfo.type == tarfile.REGTYPE:
+                        with open(entry.path, 'rb') as fileobj:
+                            tar.addfile(tarinfo, fileobj)
+                    else:
+                        tar.addfile(tarinfo)
+                    count += 1
+        finally:
+            compressed_fh.close()
+    except (EnvironmentError, tarfile.TarError) as err:
+        raise Error("unable to write tarball %r: %s" % (tarball_abs, err))
+    return ArchiveResult(filecount=count,
+                         codec=str(codec),
+                         uncompressed_size=counter.count,
+                         compressed_size=os.stat(tarball_abs).st_size,
+                         seconds=time.time() - start_time)
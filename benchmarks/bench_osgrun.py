@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare how long osgrun takes to start a command with the flat setup.env
+(the default) and with the full setup.sh (OSGRUN_FULL_SETUP=1).
+
+The setup files for a dver are generated into a temp dir, which is set up
+with osg-post-install as an unpacked tarball would be, and `osgrun /bin/true`
+is run the given number of times each way, alternating between the two.
+The environment osgrun sets up each way is compared first.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import envsetup
+
+POST_INSTALL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'post-install')
+
+# set by the shell, or by osgrun itself
+IGNORED_VARS = ['_', 'PWD', 'SHLVL', 'OLDPWD', 'OSGRUN_FULL_SETUP']
+
+
+def make_osg_location(osg_location, dver, basearch):
+    osg_dir = os.path.join(osg_location, 'osg')
+    os.makedirs(osg_dir)
+    envsetup.write_setup_in_files(osg_dir, dver, basearch)
+    for script_name in 'osg-post-install', 'osg_post_install.py', 'osgrun.in':
+        shutil.copy(os.path.join(POST_INSTALL_DIR, script_name), osg_dir)
+    with open(os.devnull, 'w') as fnull:
+        subprocess.check_call([sys.executable, os.path.join(osg_dir, 'osg_post_install.py'), osg_location], stdout=fnull)
+
+
+def osgrun_env(osgrun, base_env, full_setup):
+    env = dict(base_env, OSGRUN_FULL_SETUP='1') if full_setup else base_env
+    output = subprocess.check_output([osgrun, '/usr/bin/env'], env=env).decode()
+    return dict(x.split('=', 1) for x in output.splitlines() if '=' in x and x.split('=', 1)[0] not in IGNORED_VARS)
+
+
+def main(argv):
+    parser = OptionParser("%prog [options]")
+    parser.add_option("-n", "--runs", type="int", default=500, help="Number of times to run osgrun each way (default %default)")
+    parser.add_option("-d", "--dver", default="el9", help="dver to generate the setup files for (default %default)")
+    parser.add_option("-b", "--basearch", default="x86_64", help="basearch to generate the setup files for (default %default)")
+    options, _ = parser.parse_args(argv[1:])
+
+    work_dir = tempfile.mkdtemp(prefix='bench-osgrun-')
+    try:
+        make_osg_location(work_dir, options.dver, options.basearch)
+        osgrun = os.path.join(work_dir, 'osgrun')
+        base_env = {'PATH': '/usr/bin:/bin', 'HOME': work_dir, 'LD_LIBRARY_PATH': '/opt/lib'}
+        assert osgrun_env(osgrun, base_env, False) == osgrun_env(osgrun, base_env, True)
+
+        times = {False: [], True: []}
+        for _ in range(options.runs):
+            for full_setup in False, True:
+                env = dict(base_env, OSGRUN_FULL_SETUP='1') if full_setup else base_env
+                start = time.time()
+                subprocess.check_call([osgrun, '/bin/true'], env=env)
+                times[full_setup].append(time.time() - start)
+
+        for label, full_setup in ("setup.env (fast path)", False), ("setup.sh (OSGRUN_FULL_SETUP=1)", True):
+            runs = sorted(times[full_setup])
+            print("%-32s mean %6.2f ms   median %6.2f ms" % (
+                label, 1000 * sum(runs) / len(runs), 1000 * runs[len(runs) // 2]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Compare the stage 1 file index (fileindex.py) with the old stage 1 file list,
+made with find | sort | comm and read back line by line.
+
+A tree shaped roughly like a stage 1 dir (many small dirs with a handful of
+files and symlinks each) is generated in a temp dir, or an existing dir is
+used if one is given.  For each method this times making the list or index,
+loading it the way stage 2 does, and looking up every file in it.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from optparse import OptionParser
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+import fileindex
+
+
+def make_tree(root, num_files, files_per_dir=20):
+    """Make num_files files and symlinks in a tree of dirs under root.
+    Returns the relative paths of the files.
+
+    """
+    rand = random.Random(0)
+    relpaths = []
+    dirs = ['']
+    while len(relpaths) < num_files:
+        parent = rand.choice(dirs)
+        dir_relpath = os.path.join(parent, "dir%d" % len(dirs))
+        os.mkdir(os.path.join(root, dir_relpath))
+        dirs.append(dir_relpath)
+        for i in range(min(files_per_dir, num_files - len(relpaths))):
+            relpath = os.path.join(dir_relpath, "file%d.so.%d" % (i, rand.randint(0, 9)))
+            if i % 5 == 4:
+                os.symlink("file0", os.path.join(root, relpath))
+            else:
+                with open(os.path.join(root, relpath), 'w') as out_fh:
+                    out_fh.write("x" * rand.randint(0, 64))
+            relpaths.append(relpath)
+    return relpaths
+
+
+def make_includes_file(path, relpaths, count):
+    with open(path, 'w') as out_fh:
+        for relpath in sorted(random.Random(1).sample(relpaths, count)):
+            out_fh.write("./%s\n" % relpath)
+
+
+def timed(label, results, func, *args):
+    start = time.time()
+    ret = func(*args)
+    results.append((label, time.time() - start))
+    return ret
+
+
+def shell_filelist(stage_dir, includes_file, out_dir):
+    tmp_path = os.path.join(out_dir, 'stage1_filelist_tmp')
+    filelist_path = os.path.join(out_dir, 'stage1_filelist')
+    subprocess.check_call("find . -not -type d | sort > '%s'" % tmp_path, shell=True, cwd=stage_dir)
+    subprocess.check_call("comm -2 -3 '%s' '%s' > '%s'" % (tmp_path, includes_file, filelist_path), shell=True)
+    return filelist_path
+
+
+def find_printf(stage_dir, out_dir):
+    # find with the same fields as the index, for comparison
+    listing_path = os.path.join(out_dir, 'find_printf')
+    subprocess.check_call("find . -not -type d -printf '%%P\\t%%y\\t%%s\\t%%i\\n' | sort > '%s'" % listing_path, shell=True, cwd=stage_dir)
+
+
+def lookup_all(paths, relpaths):
+    return sum(1 for x in relpaths if x in paths)
+
+
+def main(argv):
+    parser = OptionParser("%prog [options] [<STAGE DIR>]")
+    parser.add_option("-n", "--num-files", type="int", default=120000, help="Number of files in the generated tree (default %default)")
+    parser.add_option("--includes", type="int", default=500, help="Number of files on the include list (default %default)")
+    options, args = parser.parse_args(argv[1:])
+
+    work_dir = tempfile.mkdtemp(prefix='bench-stage1-index-')
+    try:
+        if args:
+            stage_dir = os.path.abspath(args[0])
+            relpaths = [os.fsdecode(x[0]) for x in fileindex.scan_files(stage_dir)]
+        else:
+            stage_dir = os.path.join(work_dir, 'stage')
+            os.mkdir(stage_dir)
+            print("Making a tree of %d files in %s" % (options.num_files, stage_dir))
+            relpaths = make_tree(stage_dir, options.num_files)
+        includes_file = os.path.join(work_dir, 'include.lst')
+        num_includes = min(options.includes, len(relpaths))
+        make_includes_file(includes_file, relpaths, num_includes)
+        # warm the dentry cache so neither method pays for the first walk
+        fileindex.scan_files(stage_dir)
+
+        results = []
+        filelist_path = timed("find|sort|comm", results, shell_filelist, stage_dir, includes_file, work_dir)
+        paths = timed("  read file list", results, archive.read_stage1_filelist, filelist_path)
+        timed("  look up all (set)", results, lookup_all, paths, relpaths)
+        timed("find -printf (path, type, size, inode)|sort", results, find_printf, stage_dir, work_dir)
+
+        index_path = os.path.join(work_dir, fileindex.INDEX_FILE)
+        include_paths = archive.read_stage1_filelist(includes_file)
+        count = timed("scandir index", results, fileindex.make_index, stage_dir, index_path, include_paths)
+        with fileindex.Stage1Index(index_path) as index:
+            paths = timed("  load paths", results, index.paths)
+            timed("  look up all (set)", results, lookup_all, paths, relpaths)
+            found = timed("  look up all (mmap bisect)", results, lookup_all, index, relpaths)
+        assert found == count == len(relpaths) - num_includes, (found, count)
+
+        print("%d files, %d in the index (%d bytes)" % (len(relpaths), count, os.path.getsize(index_path)))
+        for label, seconds in results:
+            print("%-45s %8.3f s" % (label, seconds))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Compare the single-walk stage 2 fixups (treewalk.py) with the old sequence
+of walks: os.walk() over usr/ for the /etc/alternatives symlinks, then
+`chmod -R u+rwX`, then the walk that lists the files for the tarball.
+
+A tree shaped roughly like a stage dir is generated in a temp dir (see
+bench_stage1_index.py), or an existing dir is used if one is given; since
+both methods fix things in place, an existing dir is copied first.  The
+tarball itself is not written, as that is the same either way.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from optparse import OptionParser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+import stage2
+import treewalk
+
+from bench_stage1_index import make_tree
+
+
+def old_fix_alternatives_symlinks(stage_dir_abs):
+    for root, dirs, files in os.walk(os.path.join(stage_dir_abs, 'usr')):
+        for afile in files:
+            afilepath = os.path.join(root, afile)
+            if not os.path.islink(afilepath):
+                continue
+            linkpath = os.readlink(afilepath)
+            if not linkpath.startswith('/etc/alternatives'):
+                continue
+            stage_linkpath = os.path.join(stage_dir_abs, linkpath.lstrip('/'))
+            if not os.path.islink(stage_linkpath):
+                continue
+            target = os.path.join(stage_dir_abs, os.readlink(stage_linkpath).lstrip('/'))
+            if not os.path.exists(target):
+                continue
+            os.unlink(afilepath)
+            os.symlink(os.path.relpath(target, start=os.path.dirname(afilepath)), afilepath)
+
+
+def old_fixups(stage_dir_abs):
+    old_fix_alternatives_symlinks(stage_dir_abs)
+    subprocess.call(['chmod', '-R', 'u+rwX', stage_dir_abs])
+    return archive.scan_stage_dir(stage_dir_abs, excludes=stage2.TARBALL_EXCLUDES, keep_dirs=['var/lib/osg-ca-certs'])
+
+
+def new_fixups(stage_dir_abs, stats):
+    return archive.scan_stage_dir(stage_dir_abs, excludes=stage2.TARBALL_EXCLUDES, keep_dirs=['var/lib/osg-ca-certs'],
+                                  visitors=[treewalk.AlternativesVisitor([stage_dir_abs]), treewalk.PermissionsVisitor()],
+                                  stats=stats)
+
+
+def add_alternatives(stage_dir_abs, count):
+    """Make count symlinks under usr/bin that go through etc/alternatives"""
+    for path in 'usr/bin', 'etc/alternatives', 'usr/lib/alt':
+        os.makedirs(os.path.join(stage_dir_abs, path), exist_ok=True)
+    for i in range(count):
+        open(os.path.join(stage_dir_abs, 'usr/lib/alt/tool%d' % i), 'w').close()
+        os.symlink('/usr/lib/alt/tool%d' % i, os.path.join(stage_dir_abs, 'etc/alternatives/tool%d' % i))
+        os.symlink('/etc/alternatives/tool%d' % i, os.path.join(stage_dir_abs, 'usr/bin/tool%d' % i))
+
+
+def main(argv):
+    parser = OptionParser("%prog [options] [<STAGE DIR>]")
+    parser.add_option("-n", "--num-files", type="int", default=200000, help="Number of files in the generated tree (default %default)")
+    parser.add_option("--alternatives", type="int", default=100, help="Number of symlinks through /etc/alternatives (default %default)")
+    options, args = parser.parse_args(argv[1:])
+
+    work_dir = tempfile.mkdtemp(prefix='bench-tree-fixups-')
+    try:
+        template_dir = os.path.join(work_dir, 'template')
+        if args:
+            print("Copying %s" % args[0])
+            shutil.copytree(args[0], template_dir, symlinks=True)
+        else:
+            os.mkdir(template_dir)
+            print("Making a tree of %d files in %s" % (options.num_files, template_dir))
+            make_tree(os.path.join(template_dir), options.num_files)
+            add_alternatives(template_dir, options.alternatives)
+        old_dir = os.path.join(work_dir, 'old')
+        new_dir = os.path.join(work_dir, 'new')
+        subprocess.check_call(['cp', '-a', template_dir, old_dir])
+        subprocess.check_call(['cp', '-a', template_dir, new_dir])
+        # warm the dentry cache so neither method pays for the first walk
+        treewalk.TreeWalk(template_dir, []).run()
+
+        start = time.time()
+        old_entries = old_fixups(old_dir)
+        old_seconds = time.time() - start
+        stats = {}
+        start = time.time()
+        new_entries = new_fixups(new_dir, stats)
+        new_seconds = time.time() - start
+        assert [x.relpath for x in old_entries] == [x.relpath for x in new_entries]
+
+        print("%d entries in the tarball" % len(new_entries))
+        print("%-45s %8.3f s" % ("os.walk + chmod -R + scan", old_seconds))
+        print("%-45s %8.3f s" % ("single walk", new_seconds))
+        print(json.dumps(stats, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,126 @@
+"""
+Skip builds whose inputs have not changed.
+
+A build manifest fingerprint covers everything that determines the contents
+of a tarball: the resolved stage 2 NEVRAs, the stage 1 package lists, the
+patches, the post-install scripts, the generated environment setup files,
+the build code itself, and the naming parameters (version, relnum, ...).
+The fingerprint is cheap to compute since it only needs a repoquery, so it
+is checked before doing stage 1; if the artifact cache has a tarball with
+the same fingerprint, that tarball is reused instead of building it again.
+
+Each artifact cache entry is a directory named after the fingerprint,
+containing the tarball, manifest.json (the inputs the fingerprint was
+computed from) and artifact.json (facts about the tarball, e.g. its number of
+entries and how well it compressed).
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+import archive
+import envsetup
+from common import sha256_file, hash_strings
+import dircache
+
+
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_SIZE = "10G"
+
+POST_INSTALL_SCRIPTS = ['osg-post-install', 'osg_post_install.py', 'osgrun.in']
+
+
+def _file_hashes(paths, base_dir=None):
+    hashes = {}
+    for path in paths:
+        name = os.path.relpath(path, base_dir) if base_dir else os.path.basename(path)
+        hashes[name] = sha256_file(path)
+    return hashes
+
+
+def _patch_hashes(patch_dirs):
+    patch_dirs = [os.path.abspath(x) for x in patch_dirs]
+    if not patch_dirs:
+        return {}
+    patch_files = []
+    for patch_dir in patch_dirs:
+        patch_files += glob.glob(os.path.join(patch_dir, "*.patch"))
+    # Key on the path relative to the directory the patch dirs have in common,
+    # so patches with the same name in different patch dirs don't collide
+    patch_root = os.path.dirname(os.path.commonprefix([x + os.sep for x in patch_dirs]))
+    return _file_hashes(patch_files, patch_root)
+
+
+def _envsetup_hashes(dver, basearch):
+    tmp_dir = tempfile.mkdtemp(prefix='envsetup-')
+    try:
+        envsetup.write_setup_in_files(tmp_dir, dver, basearch)
+        return _file_hashes(glob.glob(os.path.join(tmp_dir, '*')))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def make_manifest(stage2_nevras, patch_dirs, post_scripts_dir, prog_dir, stage1_pkglist_file, stage1_includes_file,
+                  dver, basearch, dirname, tarball_path, relnum, codec, rewrite_rpath=False):
+    """Return a dict describing all the inputs of a build"""
+    stage1_files = [x for x in (stage1_pkglist_file, stage1_includes_file) if os.path.exists(x)]
+    return {
+        'stage2_nevras': sorted(stage2_nevras),
+        'patches': _patch_hashes(patch_dirs),
+        'post_install_scripts': _file_hashes([os.path.join(post_scripts_dir, x) for x in POST_INSTALL_SCRIPTS]),
+        'envsetup': _envsetup_hashes(dver, basearch),
+        'stage1_files': _file_hashes(stage1_files),
+        'build_code': _file_hashes(glob.glob(os.path.join(prog_dir, '*.py'))),
+        'dver': dver,
+        'basearch': basearch,
+        'dirname': dirname,
+        'tarball': os.path.basename(tarball_path),
+        'relnum': str(relnum),
+        'codec': str(codec),
+        'rewrite_rpath': bool(rewrite_rpath),
+    }
+
+
+def fingerprint(manifest):
+    """Return the fingerprint of a manifest made by make_manifest()"""
+    return hash_strings([json.dumps(manifest, sort_keys=True)])
+
+
+class ArtifactCache(dircache.DirCache):
+    description = "artifact cache"
+
+    def __init__(self, cache_dir, max_age_days=DEFAULT_MAX_AGE_DAYS, max_size=DEFAULT_MAX_SIZE):
+        super(ArtifactCache, self).__init__(cache_dir, max_age_days, max_size)
+
+    def _artifact_path(self, key, tarball_path):
+        return os.path.join(self.entry_dir(key), os.path.basename(tarball_path))
+
+    def has(self, key, tarball_path):
+        return os.path.isfile(self._artifact_path(key, tarball_path))
+
+    def fetch(self, key, tarball_path):
+        """Copy the cached tarball for key to tarball_path.
+        Returns the archive.ArchiveResult from when the tarball was built.
+
+        """
+        shutil.copyfile(self._artifact_path(key, tarball_path), tarball_path)
+        self.touch(key)
+        try:
+            with open(os.path.join(self.entry_dir(key), 'artifact.json')) as artifact_fh:
+                return archive.ArchiveResult.from_dict(json.load(artifact_fh))
+        except (EnvironmentError, ValueError, TypeError):
+            return archive.ArchiveResult(filecount="?")
+
+    def store(self, key, tarball_path, manifest, archive_result):
+        def _fill(tmp_dir):
+            shutil.copyfile(tarball_path, os.path.join(tmp_dir, os.path.basename(tarball_path)))
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as manifest_fh:
+                json.dump(manifest, manifest_fh, indent=2, sort_keys=True)
+            with open(os.path.join(tmp_dir, 'artifact.json'), 'w') as artifact_fh:
+                json.dump(archive_result.to_dict(), artifact_fh, indent=2, sort_keys=True)
+        self._store_dir(key, _fill)
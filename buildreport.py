@@ -0,0 +1,147 @@
+"""
+Per-phase timing and resource usage for a build.
+
+Each phase of a build (stage 1 install, stage 2 install, patching, the
+various fixes, archiving, ...) is recorded with its wall time and the CPU time
+and block I/O used both by the build process itself and by the child
+processes (yum, rpm, patch, compressors...) that finished during the phase.
+The report is written as JSON with sorted keys so reports from successive
+builds can be diffed directly; running this module with two report files
+prints the phases side by side with the differences in wall time.  When
+builds are pipelined (see the scheduler module), the time a phase spent
+waiting for its stage is recorded too.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import contextlib
+import json
+import resource
+import sys
+import time
+
+
+RUSAGE_FIELDS = ['ru_utime', 'ru_stime', 'ru_inblock', 'ru_oublock']
+
+
+def _rusage_delta(before, after):
+    return dict((field, getattr(after, field) - getattr(before, field)) for field in RUSAGE_FIELDS)
+
+
+class BuildReport(object):
+    def __init__(self, stage_slots=None):
+        self.start_time = time.time()
+        self.phases = {}
+        self.info = {}
+        # a scheduler.StageSlots, if the number of builds in each stage is limited
+        self.stage_slots = stage_slots
+
+    @contextlib.contextmanager
+    def phase(self, name, rusage=True, stage=None):
+        """Record the time and resources used by the body of the with block
+        as the phase called name.  Phases with the same name are added up.
+        Resource usage is per process, so phases run in a background thread
+        should pass rusage=False and only get their wall time recorded.
+        If stage (see the scheduler module) is given and we have stage_slots,
+        wait for a slot for the stage first; the time spent waiting is
+        recorded separately, as the phase's 'wait'.
+
+        """
+        if stage and self.stage_slots:
+            with self.stage_slots.slot(stage) as wait:
+                with self.phase(name, rusage):
+                    yield
+            self.phases[name]['wait'] = self.phases[name].get('wait', 0.0) + wait
+            return
+        if rusage:
+            self_before = resource.getrusage(resource.RUSAGE_SELF)
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            if rusage:
+                self_delta = _rusage_delta(self_before, resource.getrusage(resource.RUSAGE_SELF))
+                children_delta = _rusage_delta(children_before, resource.getrusage(resource.RUSAGE_CHILDREN))
+            else:
+                self_delta = children_delta = dict((x, 0) for x in RUSAGE_FIELDS)
+            self._add_phase(name, start, end, self_delta, children_delta)
+
+    def _add_phase(self, name, start, end, self_delta, children_delta):
+        if name not in self.phases:
+            self.phases[name] = {'order': len(self.phases),
+                                 'start': start - self.start_time,
+                                 'wall': 0.0,
+                                 'self': dict((x, 0) for x in RUSAGE_FIELDS),
+                                 'children': dict((x, 0) for x in RUSAGE_FIELDS)}
+        phase = self.phases[name]
+        phase['wall'] += end - start
+        phase['end'] = end - self.start_time
+        for field in RUSAGE_FIELDS:
+            phase['self'][field] += self_delta[field]
+            phase['children'][field] += children_delta[field]
+
+    def overlap(self, name, prefix):
+        """Return how long (in seconds) the phase called name overlapped the
+        span from the start of the first phase whose name starts with prefix
+        to the end of the last one
+
+        """
+        phase = self.phases.get(name)
+        others = [x for x_name, x in self.phases.items() if x_name.startswith(prefix) and x_name != name]
+        if not phase or not others:
+            return 0.0
+        start = max(phase['start'], min(x['start'] for x in others))
+        end = min(phase['end'], max(x['end'] for x in others))
+        return max(0.0, end - start)
+
+    def set(self, key, value):
+        """Record a fact about the build, e.g. the tarball size"""
+        self.info[key] = value
+
+    def to_dict(self):
+        return {'info': self.info,
+                'phases': self.phases,
+                'total_wall': time.time() - self.start_time}
+
+    def write(self, path):
+        with open(path, 'w') as report_fh:
+            json.dump(self.to_dict(), report_fh, indent=2, sort_keys=True)
+            report_fh.write("\n")
+
+
+def compare(old_report, new_report):
+    """Print the wall time of each phase in two reports, and the difference"""
+    old_phases = old_report.get('phases', {})
+    new_phases = new_report.get('phases', {})
+    names = sorted(set(old_phases) | set(new_phases),
+                   key=lambda x: (new_phases.get(x, old_phases.get(x))['order'], x))
+    print("%-40s %10s %10s %10s" % ("phase", "old (s)", "new (s)", "diff (s)"))
+    for name in names + ['total_wall']:
+        if name == 'total_wall':
+            old_wall = old_report.get('total_wall')
+            new_wall = new_report.get('total_wall')
+        else:
+            old_wall = old_phases.get(name, {}).get('wall')
+            new_wall = new_phases.get(name, {}).get('wall')
+        diff = "" if old_wall is None or new_wall is None else "%+10.1f" % (new_wall - old_wall)
+        print("%-40s %10s %10s %10s" % (name,
+                                        "" if old_wall is None else "%.1f" % old_wall,
+                                        "" if new_wall is None else "%.1f" % new_wall,
+                                        diff))
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("Usage: %s <OLD REPORT> <NEW REPORT>" % argv[0])
+        return 2
+    with open(argv[1]) as old_fh:
+        old_report = json.load(old_fh)
+    with open(argv[2]) as new_fh:
+        new_report = json.load(new_fh)
+    compare(old_report, new_report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
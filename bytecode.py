@@ -0,0 +1,215 @@
+"""
+Precompile the Python modules a tarball ships.
+
+Tarballs are mostly run from read-only file systems (CVMFS), where Python
+can't save the bytecode it compiles, so every run of a Python tool in the
+tarball used to compile every module it imported all over again.  Stage 2
+now compiles the modules it added to the site-packages dirs envsetup puts on
+the PYTHONPATH, with the interpreter in the stage dir (the one the dver
+ships), and the bytecode goes in the tarball.  The stage 1 modules are left
+alone; they don't ship.  With Python 3.7 and later the bytecode is checked
+against a hash of the source rather than its mtime (PEP 552), so it stays
+valid wherever the tarball is unpacked, and a source file osg-post-install
+changes is just compiled again in memory; older versions check the mtime,
+which tar preserves.
+
+To show what this buys, the time to import the top-level modules stage 2
+added is measured with the bytecode, and with a copy of the site-packages
+dirs without it (and with PYTHONDONTWRITEBYTECODE, as on CVMFS).
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import re
+import shutil
+import subprocess
+
+from common import Error, errormsg, safe_makedirs, to_str
+
+
+# How many modules to import for the benchmark, and how many times
+MAX_BENCHMARK_MODULES = 50
+BENCHMARK_RUNS = 3
+# Where (in the stage dir) the sources are copied to time imports without bytecode
+BENCHMARK_DIR = 'tmp/bytecode-benchmark'
+
+_IMPORT_TIMER = """
+import sys, time
+start = time.time()
+for name in sys.argv[1:]:
+    try:
+        __import__(name)
+    except Exception:
+        pass
+print(time.time() - start)
+"""
+
+
+def python_version(python_dir):
+    """Return the (major, minor) version of the Python a site-packages dir
+    is for, or None if it can't be told from its path
+
+    """
+    match = re.search(r'python(\d+)\.(\d+)/', python_dir + '/')
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def _interpreter(stage_dir_abs, version):
+    """The path (in the stage dir) of the interpreter for version, or None if
+    the stage dir doesn't have it
+
+    """
+    python = "/usr/bin/python%d.%d" % version
+    if os.path.exists(os.path.join(stage_dir_abs, python.lstrip('/'))):
+        return python
+    return None
+
+
+def _sources(search_dir, python_dir, stage1_files):
+    """Return the .py files (relative to search_dir) under python_dir in
+    search_dir, leaving out the ones in the set stage1_files
+
+    """
+    sources = []
+    for root, dirs, files in os.walk(os.path.join(search_dir, python_dir)):
+        if '__pycache__' in dirs:
+            dirs.remove('__pycache__')
+        for name in files:
+            relpath = os.path.relpath(os.path.join(root, name), search_dir)
+            if name.endswith('.py') and relpath not in stage1_files:
+                sources.append(relpath)
+    return sorted(sources)
+
+
+def compile_dirs(stage_dir_abs, python_dirs, search_dir=None, stage1_files=None):
+    """Compile the modules stage 2 added to python_dirs (relative to the stage
+    dir) with the interpreter in the stage dir: the ones under search_dir
+    (the stage dir, or the layer stage 2 installed into), leaving out the
+    ones in the set stage1_files.  Returns the dirs that had any.
+
+    """
+    search_dir = search_dir or stage_dir_abs
+    stage1_files = stage1_files or set()
+    compiled = []
+    for python_dir in python_dirs:
+        version = python_version(python_dir)
+        if not version or not os.path.isdir(os.path.join(stage_dir_abs, python_dir)):
+            continue
+        sources = _sources(search_dir, python_dir, stage1_files)
+        if not sources:
+            continue
+        python = _interpreter(stage_dir_abs, version)
+        if not python:
+            errormsg("Python %d.%d not found in the stage dir; not compiling %s" % (version + (python_dir,)))
+            continue
+        # the files to compile are read from stdin
+        cmd = ["chroot", stage_dir_abs, python, "-m", "compileall", "-q", "-f", "-i", "-"]
+        if version >= (3, 7):
+            cmd += ["--invalidation-mode", "checked-hash"]
+        with open(os.devnull, 'wb') as fnull:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fnull)
+            proc.communicate("".join("/%s\n" % x for x in sources).encode())
+            err = proc.returncode
+        if err:
+            # e.g. a module with syntax for another version of Python; the
+            # rest got compiled
+            errormsg("Some modules in %s could not be compiled (compileall returned %d)" % (python_dir, err))
+        compiled.append(python_dir)
+    return compiled
+
+
+def shipped_modules(search_dir, python_dirs, stage1_files=None):
+    """Return the names of the top-level modules and packages in python_dirs
+    under search_dir (the stage dir, or the layer stage 2 installed into),
+    leaving out the ones from stage 1 (whose files are in the set
+    stage1_files)
+
+    """
+    stage1_files = stage1_files or set()
+    modules = set()
+    for python_dir in python_dirs:
+        try:
+            names = os.listdir(os.path.join(search_dir, python_dir))
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith('.py'):
+                module, init_relpath = name[:-3], os.path.join(python_dir, name)
+            elif os.path.isfile(os.path.join(search_dir, python_dir, name, '__init__.py')):
+                module, init_relpath = name, os.path.join(python_dir, name, '__init__.py')
+            else:
+                continue
+            if re.match(r'^[A-Za-z][A-Za-z0-9_]*$', module) and init_relpath not in stage1_files:
+                modules.add(module)
+    return sorted(modules)[:MAX_BENCHMARK_MODULES]
+
+
+def _copy_sources(stage_dir_abs, python_dirs, dest_relpath):
+    """Hardlink python_dirs under dest_relpath in the stage dir, without the
+    bytecode.  Returns the paths of the copies in the stage dir.
+
+    """
+    copies = []
+    for python_dir in python_dirs:
+        src_path = os.path.join(stage_dir_abs, python_dir)
+        dest_path = os.path.join(stage_dir_abs, dest_relpath, python_dir)
+        if not os.path.isdir(src_path):
+            continue
+        safe_makedirs(os.path.dirname(dest_path))
+        err = subprocess.call(["cp", "-al", src_path, dest_path])
+        if err:
+            raise Error("Could not copy %r to %r (cp process returned %d)" % (src_path, dest_path, err))
+        for root, dirs, files in os.walk(dest_path):
+            if '__pycache__' in dirs:
+                dirs.remove('__pycache__')
+                shutil.rmtree(os.path.join(root, '__pycache__'))
+            for name in files:
+                if name.endswith(('.pyc', '.pyo')):
+                    os.unlink(os.path.join(root, name))
+        copies.append("/" + os.path.join(dest_relpath, python_dir))
+    return copies
+
+
+def time_imports(stage_dir_abs, python_dirs, modules, use_bytecode=True):
+    """Return the best time (in seconds) of BENCHMARK_RUNS runs of importing
+    modules from python_dirs with the interpreter in the stage dir, with or
+    without the bytecode in python_dirs, or None if it can't be measured
+
+    """
+    versions = set(python_version(x) for x in python_dirs) - set([None])
+    if not modules or len(versions) != 1:
+        return None
+    python = _interpreter(stage_dir_abs, versions.pop())
+    if not python:
+        return None
+    bench_dir = os.path.join(stage_dir_abs, BENCHMARK_DIR)
+    try:
+        if use_bytecode:
+            pythonpath = ["/" + x for x in python_dirs]
+        else:
+            pythonpath = _copy_sources(stage_dir_abs, python_dirs, BENCHMARK_DIR)
+        env = {'PATH': '/usr/sbin:/usr/bin:/sbin:/bin',
+               'PYTHONPATH': ":".join(pythonpath),
+               'PYTHONDONTWRITEBYTECODE': '1'}
+        best = None
+        for _ in range(BENCHMARK_RUNS):
+            with open(os.devnull, 'wb') as fnull:
+                proc = subprocess.Popen(["chroot", stage_dir_abs, python, "-c", _IMPORT_TIMER] + modules,
+                                        env=env, stdout=subprocess.PIPE, stderr=fnull)
+                output = to_str(proc.communicate()[0]).strip().splitlines()
+            try:
+                seconds = float(output[-1])
+            except (IndexError, ValueError):
+                return None
+            if proc.returncode:
+                return None
+            best = seconds if best is None else min(best, seconds)
+        return best
+    except (Error, EnvironmentError) as err:
+        errormsg("Could not time imports: %s" % err)
+        return None
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
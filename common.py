@@ -1,6 +1,9 @@
 from __future__ import print_function
 import errno
+import fcntl
+import hashlib
 import os
+import re
 import subprocess
 import sys
 
@@ -67,6 +70,186 @@ class MountProcFS(object):
         subprocess.call(['umount', self.proc_dir])
 
 
+class BindMount(object):
+    """Bind mount src_dir onto dest_dir for the duration of a with block.
+    dest_dir is created if needed, and removed afterward if it was.
+
+    """
+    def __init__(self, src_dir, dest_dir):
+        self.src_dir = src_dir
+        self.dest_dir = dest_dir
+        self.created = False
+
+    def __enter__(self):
+        if not os.path.isdir(self.dest_dir):
+            safe_makedirs(self.dest_dir)
+            self.created = True
+        subprocess.check_call(['mount', '--bind', self.src_dir, self.dest_dir])
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        subprocess.call(['umount', self.dest_dir])
+        if self.created:
+            try:
+                os.rmdir(self.dest_dir)
+            except OSError:
+                pass
+
+
+class OverlayMount(object):
+    """Mount an overlay of upper_dir on top of lower_dir (read-only) on
+    merged_dir for the duration of a with block.  Changes go to upper_dir;
+    work_dir is overlayfs scratch space on the same file system as upper_dir.
+
+    """
+    def __init__(self, lower_dir, upper_dir, work_dir, merged_dir):
+        self.lower_dir = lower_dir
+        self.upper_dir = upper_dir
+        self.work_dir = work_dir
+        self.merged_dir = merged_dir
+
+    def __enter__(self):
+        for path in self.upper_dir, self.work_dir, self.merged_dir:
+            safe_makedirs(path)
+        options = "lowerdir=%s,upperdir=%s,workdir=%s" % (self.lower_dir, self.upper_dir, self.work_dir)
+        err = subprocess.call(['mount', '-t', 'overlay', 'overlay', '-o', options, self.merged_dir])
+        if err:
+            raise Error("Could not mount overlay on %r (mount process returned %d)" % (self.merged_dir, err))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        subprocess.call(['umount', self.merged_dir])
+
+
+class MountTmpFS(object):
+    """Mount a tmpfs of at most size bytes on mount_dir, for the duration of
+    a with block or between calls to mount() and umount()
+
+    """
+    def __init__(self, mount_dir, size):
+        self.mount_dir = mount_dir
+        self.size = size
+
+    def mount(self):
+        safe_makedirs(self.mount_dir)
+        err = subprocess.call(['mount', '-t', 'tmpfs', '-o', 'size=%d,mode=0755' % self.size, 'tmpfs', self.mount_dir])
+        if err:
+            raise Error("Could not mount tmpfs on %r (mount process returned %d)" % (self.mount_dir, err))
+
+    def umount(self):
+        subprocess.call(['umount', self.mount_dir])
+
+    def __enter__(self):
+        self.mount()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.umount()
+
+
+class FileLock(object):
+    """Hold an exclusive (or shared) flock() on lock_path for the duration of
+    a with block.  Used to keep concurrent builds from stepping on each other
+    in the caches.
+
+    """
+    def __init__(self, lock_path, shared=False):
+        self.lock_path = lock_path
+        self.shared = shared
+        self.lock_fh = None
+
+    def __enter__(self):
+        safe_makedirs(os.path.dirname(self.lock_path))
+        self.lock_fh = open(self.lock_path, 'a')
+        fcntl.flock(self.lock_fh.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_fh.fileno(), fcntl.LOCK_UN)
+        self.lock_fh.close()
+
+
+def sha256_file(path, blocksize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_strings(strings):
+    """Return a hex digest of an iterable of strings, which is stable as
+    long as the strings and their order are the same.
+
+    """
+    digest = hashlib.sha256()
+    for string in strings:
+        digest.update(to_bytes(string) + b'\0')
+    return digest.hexdigest()
+
+
+def clone_tree(src_dir, dest_dir, unshare_dirs=None, hardlink=True):
+    """Copy the contents of src_dir into dest_dir (which may exist), as cheaply
+    as the filesystem allows.  Use reflinks if possible; otherwise, hardlink
+    the files and make real copies of the directories in unshare_dirs (relative
+    to src_dir), which contain files that are modified in place, e.g. the rpmdb.
+    If dest_dir is on another file system (e.g. a tmpfs), or hardlink is False
+    (anything in dest_dir may be modified in place), copy everything.
+    Returns 'reflink', 'hardlink' or 'copy' depending on the method used.
+
+    """
+    safe_makedirs(dest_dir)
+    src_contents = os.path.join(src_dir, '.')
+    with open(os.devnull, 'wb') as fnull:
+        err = subprocess.call(['cp', '-a', '--reflink=always', src_contents, dest_dir], stderr=fnull)
+    if not err:
+        return 'reflink'
+
+    subprocess.call(['rm', '-rf', dest_dir])
+    safe_makedirs(dest_dir)
+    if not hardlink or os.stat(src_dir).st_dev != os.stat(dest_dir).st_dev:
+        err = subprocess.call(['cp', '-a', src_contents, dest_dir])
+        if err:
+            raise Error("Could not copy %r to %r (cp process returned %d)" % (src_dir, dest_dir, err))
+        return 'copy'
+    err = subprocess.call(['cp', '-al', src_contents, dest_dir])
+    if err:
+        raise Error("Could not clone %r to %r (cp process returned %d)" % (src_dir, dest_dir, err))
+    for unshare_dir in unshare_dirs or []:
+        src_path = os.path.join(src_dir, unshare_dir)
+        dest_path = os.path.join(dest_dir, unshare_dir)
+        if not os.path.isdir(src_path):
+            continue
+        subprocess.call(['rm', '-rf', dest_path])
+        err = subprocess.call(['cp', '-a', src_path, dest_path])
+        if err:
+            raise Error("Could not copy %r to %r (cp process returned %d)" % (src_path, dest_path, err))
+    return 'hardlink'
+
+
+def tree_size(path):
+    """Return the disk usage of path in bytes, counting hardlinked files once"""
+    seen_inodes = set()
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen_inodes:
+                continue
+            seen_inodes.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def parse_size(size_str):
+    """Parse a size such as '500M' or '20G' into a number of bytes"""
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', str(size_str), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size %r" % size_str)
+    multiplier = 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * multiplier)
+
+
 VALID_DVERS        = ["el8", "el9", "el10"]
 VALID_BASEARCHES   = ["x86_64"]
 DEFAULT_BASEARCH   = "x86_64"
@@ -0,0 +1,140 @@
+"""
+Compression codecs for output tarballs.
+
+A codec is specified as NAME[,level=N][,threads=N], e.g. 'gzip',
+'zstd,level=19' or 'xz,level=6,threads=8'.  Valid names are:
+
+- gzip: single-threaded gzip, done in-process
+- pigz: parallel gzip; produces ordinary .tar.gz files
+- zstd: zstandard; multithreaded
+- xz:   xz; multithreaded
+
+threads=0 (the default) means to use all available CPUs.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import gzip
+import multiprocessing
+import subprocess
+
+try:
+    from shutil import which as find_executable
+except ImportError:  # Python 2:
+    from distutils.spawn import find_executable
+
+from common import Error
+
+
+# name: (tarball extension, executable, default level, min level, max level)
+CODECS = {
+    'gzip': ('tar.gz',  None,   6, 1, 9),
+    'pigz': ('tar.gz',  'pigz', 6, 1, 9),
+    'zstd': ('tar.zst', 'zstd', 3, 1, 19),
+    'xz':   ('tar.xz',  'xz',   6, 0, 9),
+}
+
+DEFAULT_CODEC = 'gzip'
+
+
+class Codec(object):
+    def __init__(self, name, level=None, threads=0):
+        if name not in CODECS:
+            raise ValueError("Unknown codec %r; must be one of %s" % (name, ", ".join(sorted(CODECS))))
+        self.name = name
+        self.extension, self.executable, default_level, min_level, max_level = CODECS[name]
+        self.level = default_level if level is None else int(level)
+        if not min_level <= self.level <= max_level:
+            raise ValueError("Level for codec %r must be between %d and %d" % (name, min_level, max_level))
+        self.threads = int(threads)
+        if self.threads < 0:
+            raise ValueError("Thread count must not be negative")
+
+    def __str__(self):
+        spec = "%s,level=%d" % (self.name, self.level)
+        if self.executable:
+            spec += ",threads=%d" % self.threads
+        return spec
+
+    def _nthreads(self):
+        return self.threads or multiprocessing.cpu_count()
+
+    def check(self):
+        """Raise Error if the codec can't be used on this machine"""
+        if self.executable and not find_executable(self.executable):
+            raise Error("Required executable %r for codec %r not found" % (self.executable, self.name))
+
+    def _command(self):
+        if self.name == 'pigz':
+            return ['pigz', '-%d' % self.level, '-p', str(self._nthreads()), '-c']
+        elif self.name == 'zstd':
+            return ['zstd', '-%d' % self.level, '-T%d' % self.threads, '-q', '-c']
+        elif self.name == 'xz':
+            return ['xz', '-%d' % self.level, '-T%d' % self.threads, '-c']
+        raise AssertionError("no command for codec %r" % self.name)
+
+    def open(self, path):
+        """Return a writable binary file object that compresses what is
+        written to it into path.  Closing it finishes the compressed file.
+
+        """
+        if self.name == 'gzip':
+            return gzip.GzipFile(path, 'wb', compresslevel=self.level)
+        return _CompressorPipe(self._command(), path)
+
+
+class _CompressorPipe(object):
+    """A file object that pipes what is written to it into an external
+    compressor, whose output goes to a file.
+
+    """
+    def __init__(self, cmd, path):
+        self.cmd = cmd
+        self.path = path
+        self.out_fh = open(path, 'wb')
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.out_fh)
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except IOError as err:
+            # The compressor has most likely died; report how it exited
+            self._finish(err)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError as err:
+            self._finish(err)
+        self._finish()
+
+    def _finish(self, write_err=None):
+        if write_err is not None:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+        ret = self.proc.wait()
+        self.out_fh.close()
+        self.proc = None
+        if ret:
+            raise Error("compressor %r returned %d while writing %r" % (" ".join(self.cmd), ret, self.path))
+        if write_err is not None:
+            raise Error("unable to write to compressor %r while writing %r: %s" % (" ".join(self.cmd), self.path, write_err))
+
+
+def parse_codec(spec):
+    """Parse a codec spec (see the module docstring) into a Codec"""
+    parts = [x.strip() for x in spec.split(',')]
+    kwargs = {}
+    for part in parts[1:]:
+        key, sep, value = part.partition('=')
+        if not sep or key not in ('level', 'threads'):
+            raise ValueError("Invalid codec option %r in %r" % (part, spec))
+        try:
+            kwargs[key] = int(value)
+        except ValueError:
+            raise ValueError("Invalid value for %s in %r" % (key, spec))
+    return Codec(parts[0], **kwargs)
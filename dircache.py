@@ -0,0 +1,106 @@
+"""
+Base class for the persistent caches used by the build.
+
+A cache is a directory of entries, each of which is a directory named after
+its key.  Entries are evicted when they have not been used for a while, and
+the least recently used entries are evicted when the cache gets too big.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import time
+
+import common
+from common import statusmsg, tree_size
+
+
+DEFAULT_MAX_AGE_DAYS = 14
+
+
+class DirCache(object):
+    # Used in status messages
+    description = "cache"
+
+    def __init__(self, cache_dir, max_age_days=DEFAULT_MAX_AGE_DAYS, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = (max_age_days or 0) * 86400
+        self.max_size = common.parse_size(max_size) if max_size else 0
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lock(self, key, shared=False):
+        """Return a lock that should be held while looking up or filling the
+        entry for key, so concurrent builds don't do the same work twice.
+        Builds that only read the entry can hold a shared lock.
+
+        """
+        return common.FileLock(os.path.join(self.cache_dir, 'locks', key + '.lock'), shared=shared)
+
+    def has(self, key):
+        return os.path.isdir(self.entry_dir(key))
+
+    def touch(self, key):
+        """Mark the entry for key as recently used"""
+        os.utime(self.entry_dir(key), None)
+
+    def _store_dir(self, key, fill_func):
+        """Atomically create the entry for key; fill_func is called with the
+        (temporary) entry dir and should put the entry's contents in it.
+
+        """
+        entry_dir = self.entry_dir(key)
+        tmp_dir = entry_dir + '.tmp.%d' % os.getpid()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            common.safe_makedirs(tmp_dir)
+            fill_func(tmp_dir)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.cache_dir, x) for x in names
+                if '.tmp.' not in x and x != 'locks' and os.path.isdir(os.path.join(self.cache_dir, x))]
+
+    def _remove(self, entry_dir):
+        # don't pull an entry out from under a build that is using it
+        with self.lock(os.path.basename(entry_dir)):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def evict(self, keep_key=None):
+        """Remove entries older than max_age, then remove the least recently
+        used entries until the cache is no bigger than max_size.
+        The entry for keep_key is never removed.
+
+        """
+        now = time.time()
+        entries = []
+        for entry_dir in self._entries():
+            if keep_key and os.path.basename(entry_dir) == keep_key:
+                continue
+            mtime = os.stat(entry_dir).st_mtime
+            if self.max_age and now - mtime > self.max_age:
+                statusmsg("Evicting %s entry %r (too old)" % (self.description, entry_dir))
+                self._remove(entry_dir)
+            else:
+                entries.append((mtime, entry_dir))
+
+        if not self.max_size:
+            return
+        total_size = tree_size(self.cache_dir)
+        for _, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            entry_size = tree_size(entry_dir)
+            statusmsg("Evicting %s entry %r (cache too big)" % (self.description, entry_dir))
+            self._remove(entry_dir)
+            total_size -= entry_size
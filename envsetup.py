@@ -1,4 +1,4 @@
-'''Module to write the template setup.sh and setup.csh files
+'''Module to write the template setup.sh, setup.csh and setup.env files
 
 This is scripted because the contents of the setup files depend on the dver and
 the basearch of the tarball they will be part of.
@@ -40,59 +40,189 @@ shell_construct = {
 
 
 
-def write_setup_in_files(dest_dir, dver, basearch):
-    '''Writes dest_dir/setup.csh.in and dest_dir/setup.sh.in according to the
-    dver and basearch provided.
+PYTHON_VERSIONS = {
+    'el6': '2.6',
+    'el7': '2.7',
+    'el8': '3.6',
+    'el9': '3.9',
+    'el10': '3.12',
+}
+
+
+def get_python_dirs(dver, basearch):
+    '''Returns the site-packages dirs (relative to $OSG_LOCATION) to put on
+    the PYTHONPATH for the dver and basearch provided.
 
     '''
+    if dver not in PYTHON_VERSIONS:
+        raise Exception("Unknown dver %r" % dver)
+    # Arch-independent python stuff always goes in usr/lib/, even on x86_64
+    python_dirs = ["usr/lib/python%s/site-packages" % PYTHON_VERSIONS[dver]]
+    if basearch == 'x86_64':
+        python_dirs.append("usr/lib64/python%s/site-packages" % PYTHON_VERSIONS[dver])
+    return python_dirs
+
 
+def get_library_dirs(basearch):
+    '''Returns the dirs (relative to $OSG_LOCATION) to put on the
+    LD_LIBRARY_PATH for the basearch provided, in search order.
+
+    '''
     if basearch == 'x86_64':
-        osg_ld_library_path = ":".join([
-            "$OSG_LOCATION/lib64",
-            "$OSG_LOCATION/lib",     # search 32-bit libs too
-            "$OSG_LOCATION/usr/lib64",
-            "$OSG_LOCATION/usr/lib", # search 32-bit libs too
-            "$OSG_LOCATION/usr/lib64/dcap",
-            "$OSG_LOCATION/usr/lib64/lcgdm"])
+        return [
+            "lib64",
+            "lib",      # search 32-bit libs too
+            "usr/lib64",
+            "usr/lib",  # search 32-bit libs too
+            "usr/lib64/dcap",
+            "usr/lib64/lcgdm"]
     else:
         raise Exception("Unknown basearch %r" % basearch)
 
-    if dver in ['el6', 'el7', 'el8', 'el9', 'el10']:
-        osg_perl5lib = ":".join([
-            "$OSG_LOCATION/usr/share/perl5/vendor_perl",
-            "$OSG_LOCATION/usr/share/perl5"])
-        if basearch == 'x86_64':
-            osg_perl5lib += ":$OSG_LOCATION/usr/lib64/perl5/vendor_perl"
-            osg_perl5lib += ":$OSG_LOCATION/usr/lib64/perl5"
-    else:
-        raise Exception("Unknown dver %r" % dver)
 
-    # Arch-independent python stuff always goes in usr/lib/, even on x86_64
-    if dver == 'el6':
-        osg_pythonpath = "$OSG_LOCATION/usr/lib/python2.6/site-packages"
-        if basearch == 'x86_64':
-            osg_pythonpath += ":$OSG_LOCATION/usr/lib64/python2.6/site-packages"
-    elif dver == 'el7':
-        osg_pythonpath = "$OSG_LOCATION/usr/lib/python2.7/site-packages"
-        if basearch == 'x86_64':
-            osg_pythonpath += ":$OSG_LOCATION/usr/lib64/python2.7/site-packages"
-    elif dver == 'el8':
-        osg_pythonpath = "$OSG_LOCATION/usr/lib/python3.6/site-packages"
-        if basearch == 'x86_64':
-            osg_pythonpath += ":$OSG_LOCATION/usr/lib64/python3.6/site-packages"
-    elif dver == 'el9':
-        osg_pythonpath = "$OSG_LOCATION/usr/lib/python3.9/site-packages"
-        if basearch == 'x86_64':
-            osg_pythonpath += ":$OSG_LOCATION/usr/lib64/python3.9/site-packages"
-    elif dver == 'el10':
-        osg_pythonpath = "$OSG_LOCATION/usr/lib/python3.12/site-packages"
-        if basearch == 'x86_64':
-            osg_pythonpath += ":$OSG_LOCATION/usr/lib64/python3.12/site-packages"
-    else:
+# The search path variables setup.sh sets, and how their dirs are searched:
+# 'names' for the names of the files right in each dir (binaries, libraries),
+# 'modules' for the top-level Python modules and packages in each dir, and
+# 'tree' for the paths of all the files under each dir (Perl modules, man
+# pages)
+SEARCH_PATH_VARS = [
+    ("PATH",            'names'),
+    ("LD_LIBRARY_PATH", 'names'),
+    ("PERL5LIB",        'tree'),
+    ("PYTHONPATH",      'modules'),
+    ("MANPATH",         'tree'),
+]
+
+
+def get_search_paths(dver, basearch):
+    '''Returns a dict of the dirs (relative to $OSG_LOCATION) to put on each
+    of the SEARCH_PATH_VARS for the dver and basearch provided, in search
+    order.
+
+    '''
+    if dver not in PYTHON_VERSIONS:
         raise Exception("Unknown dver %r" % dver)
+    perl5lib = ["usr/share/perl5/vendor_perl", "usr/share/perl5"]
+    if basearch == 'x86_64':
+        perl5lib += ["usr/lib64/perl5/vendor_perl", "usr/lib64/perl5"]
+    return {
+        "PATH":            ["usr/bin", "usr/sbin"],
+        "LD_LIBRARY_PATH": get_library_dirs(basearch),
+        "PERL5LIB":        perl5lib,
+        "PYTHONPATH":      get_python_dirs(dver, basearch),
+        "MANPATH":         ["usr/share/man"],
+    }
 
-    osg_manpath = "$OSG_LOCATION/usr/share/man"
 
+def _dir_keys(tree_dir, search_dir, lookup, skip, other_dirs):
+    '''Returns the set of things (see SEARCH_PATH_VARS) that can be looked
+    up in search_dir, leaving out the relpaths (relative to tree_dir) that
+    skip() is true for, and the files under other_dirs (other dirs on the
+    same search path, which may be under search_dir).
+
+    '''
+    keys = set()
+    top = os.path.join(tree_dir, search_dir)
+    for root, dirs, files in os.walk(top):
+        root_relpath = os.path.relpath(root, tree_dir)
+        dirs[:] = [x for x in dirs if os.path.join(root_relpath, x) not in other_dirs]
+        if lookup != 'tree':
+            for name in files + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
+                if not skip(os.path.join(root_relpath, name)):
+                    keys.add(name)
+            if lookup == 'modules':
+                keys = set(x.split('.')[0] for x in keys)
+                keys.update(x for x in dirs if x != '__pycache__' and not skip(os.path.join(root_relpath, x))
+                            and os.listdir(os.path.join(root, x)))
+            break
+        for name in files:
+            relpath = os.path.join(root_relpath, name)
+            if not skip(relpath):
+                keys.add(os.path.relpath(relpath, search_dir))
+    return keys
+
+
+def _order_dirs(dirs, keys):
+    '''Returns dirs ordered by how many things they have (most first), but
+    without changing the order of two dirs that have something with the
+    same name, so nothing is found in a different dir than before.
+
+    '''
+    ordered = []
+    left = list(dirs)
+    while left:
+        for candidate in sorted(left, key=lambda x: -len(keys[x])):
+            before = left[:left.index(candidate)]
+            if not any(keys[x] & keys[candidate] for x in before):
+                ordered.append(candidate)
+                left.remove(candidate)
+                break
+    return ordered
+
+
+def prune_search_paths(search_paths, tree_dir, skip=None, include_paths=None):
+    '''Returns a copy of search_paths (from get_search_paths()) without the
+    dirs that are absent or have nothing in them in tree_dir, and with the
+    rest ordered by how many files they have, and a dict of what was
+    decided for the build report.  skip(relpath) returns True for files
+    (relative to tree_dir) that are not in the tarball; include_paths are
+    files that are in the tarball but not in tree_dir.
+
+    '''
+    skip = skip or (lambda relpath: False)
+    pruned = {}
+    decisions = {}
+    for variable, lookup in SEARCH_PATH_VARS:
+        keys = {}
+        for search_dir in search_paths.get(variable, []):
+            other_dirs = set(search_paths[variable]) - set([search_dir])
+            keys[search_dir] = _dir_keys(tree_dir, search_dir, lookup, skip, other_dirs)
+            nested_dirs = [x for x in other_dirs if x.startswith(search_dir + '/')]
+            for relpath in include_paths or []:
+                if relpath.startswith(search_dir + '/') and not any(relpath.startswith(x + '/') for x in nested_dirs):
+                    name = relpath[len(search_dir) + 1:]
+                    if lookup == 'tree':
+                        keys[search_dir].add(name)
+                    elif '/' not in name:
+                        keys[search_dir].add(name.split('.')[0] if lookup == 'modules' else name)
+        kept = [x for x in search_paths.get(variable, []) if keys[x]]
+        pruned[variable] = _order_dirs(kept, keys)
+        decisions[variable] = {
+            'dirs': pruned[variable],
+            'dropped': [x for x in search_paths.get(variable, []) if x not in kept],
+            'files': dict((x, len(y)) for x, y in keys.items()),
+        }
+    return pruned, decisions
+
+
+def write_setup_in_files(dest_dir, dver, basearch, search_paths=None):
+    '''Writes dest_dir/setup.csh.in and dest_dir/setup.sh.in according to the
+    dver and basearch provided, and dest_dir/setup.env.in, a flat version of
+    setup.sh.in for osgrun.  search_paths, if given, replaces the dirs
+    from get_search_paths() (see prune_search_paths()).
+
+    '''
+
+    if search_paths is None:
+        search_paths = get_search_paths(dver, basearch)
+    osg_search_paths = dict((x, ":".join("$OSG_LOCATION/" + y for y in search_paths.get(x, [])))
+                            for x, _ in SEARCH_PATH_VARS)
+
+    # Variables that are set, and search paths that are prepended to
+    # (leaving out the ones with nothing to find, or whose files are all
+    # found some other way, e.g. libraries through their RUNPATH)
+    setenv_vars = [
+        ("GFAL_CONFIG_DIR", "$OSG_LOCATION/etc/gfal2.d/"),
+        ("GFAL_PLUGIN_DIR", "$OSG_LOCATION/usr/lib64/gfal2-plugins/" if basearch == "x86_64"
+                            else "$OSG_LOCATION/usr/lib/gfal2-plugins/"),
+        ("GLOBUS_LOCATION", "$OSG_LOCATION/usr"),
+        ("PATH",            osg_search_paths["PATH"] and osg_search_paths["PATH"] + ":$PATH"),
+        ("X509_CERT_DIR",   "$OSG_LOCATION/etc/grid-security/certificates"),
+        ("X509_VOMS_DIR",   "$OSG_LOCATION/etc/grid-security/vomsdir"),
+        ("VOMS_USERCONF",   "$OSG_LOCATION/etc/vomses")]
+    setenv_vars = [(x, y) for x, y in setenv_vars if y]
+    # PATH is set above, ahead of the old PATH
+    prepend_vars = [(x, osg_search_paths[x]) for x, _ in SEARCH_PATH_VARS if x != "PATH" and osg_search_paths[x]]
 
     for sh in 'csh', 'sh':
         dest_path = os.path.join(dest_dir, 'setup.%s.in' % sh)
@@ -109,24 +239,10 @@ def write_setup_in_files(dest_dir, dver, basearch):
         # Set OSG_LOCATION first because all the other variables depend on it
         text_to_write += _setenv("OSG_LOCATION", "@@OSG_LOCATION@@")
 
-        for variable, value in [
-                ("GFAL_CONFIG_DIR", "$OSG_LOCATION/etc/gfal2.d/"),
-                ("GFAL_PLUGIN_DIR", "$OSG_LOCATION/usr/lib64/gfal2-plugins/" if basearch == "x86_64"
-                                    else "$OSG_LOCATION/usr/lib/gfal2-plugins/"),
-                ("GLOBUS_LOCATION", "$OSG_LOCATION/usr"),
-                ("PATH",            "$OSG_LOCATION/usr/bin:$OSG_LOCATION/usr/sbin:$PATH"),
-                ("X509_CERT_DIR",   "$OSG_LOCATION/etc/grid-security/certificates"),
-                ("X509_VOMS_DIR",   "$OSG_LOCATION/etc/grid-security/vomsdir"),
-                ("VOMS_USERCONF",   "$OSG_LOCATION/etc/vomses")]:
-
+        for variable, value in setenv_vars:
             text_to_write += _setenv(variable, value)
 
-        for variable, value in [
-                ("LD_LIBRARY_PATH", osg_ld_library_path),
-                ("PERL5LIB",        osg_perl5lib),
-                ("PYTHONPATH",      osg_pythonpath),
-                ("MANPATH",         osg_manpath)]:
-
+        for variable, value in prepend_vars:
             text_to_write += (
                  _ifdef(variable)
                + "\t" + _setenv(variable, value + ":$" + variable)
@@ -146,6 +262,20 @@ def write_setup_in_files(dest_dir, dver, basearch):
         with open(dest_path, "wt") as fh:
             fh.write(text_to_write)
 
+    # A flat version of setup.sh for osgrun, without the tests and with
+    # OSG_LOCATION filled in: each search path is prepended to the old value
+    # with ${var:+...}, which is empty if the variable is unset or empty.
+    # setup-local.sh is sourced by osgrun.
+    _setenv = lambda var, value: shell_construct['sh']['setenv'](var, value.replace("$OSG_LOCATION", "@@OSG_LOCATION@@"))
+    text_to_write = "# The environment of setup.sh, for osgrun\n"
+    text_to_write += _setenv("OSG_LOCATION", "@@OSG_LOCATION@@")
+    for variable, value in setenv_vars:
+        text_to_write += _setenv(variable, value)
+    for variable, value in prepend_vars:
+        text_to_write += _setenv(variable, "%s${%s:+:$%s}" % (value, variable, variable))
+    with open(os.path.join(dest_dir, 'setup.env.in'), "wt") as fh:
+        fh.write(text_to_write)
+
 
 def main(argv):
     dest_dir, dver, basearch = argv[1:4]
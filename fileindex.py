@@ -0,0 +1,182 @@
+"""
+A compact, sorted index of the files in a stage 1 dir.
+
+Stage 2 leaves the files that were already in stage 1 out of the tarball.
+The index records the path (relative to the stage dir), type, size and inode
+of every non-directory in stage 1, minus the ones on the stage 1 include list
+(which do go in the tarball).  It is made by walking the stage dir once in
+process, and written as a binary file that can be memory-mapped and searched
+without parsing it, or loaded into a set in one go.
+
+File format (all integers little-endian):
+- header:  magic b'S1IX', format version (uint32), record count (uint32),
+           offset of the path blob (uint64)
+- records: one per file, sorted by path; each is the offset (uint64) and
+           length (uint32) of the path in the blob, the type (one byte: 'f'
+           file, 'l' symlink, 'c'/'b' device, 'p' fifo, 's' socket,
+           '?' other), 3 bytes of padding, the size (uint64) and the inode
+           (uint64)
+- blob:    the paths, sorted, each followed by a NUL byte
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import mmap
+import os
+import stat
+import struct
+import sys
+
+from common import Error
+
+
+INDEX_FILE = 'stage1_index'
+
+_MAGIC = b'S1IX'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIIQ')
+_RECORD = struct.Struct('<QIc3xQQ')
+
+
+def _file_type(mode):
+    if stat.S_ISREG(mode):
+        return b'f'
+    elif stat.S_ISLNK(mode):
+        return b'l'
+    elif stat.S_ISCHR(mode):
+        return b'c'
+    elif stat.S_ISBLK(mode):
+        return b'b'
+    elif stat.S_ISFIFO(mode):
+        return b'p'
+    elif stat.S_ISSOCK(mode):
+        return b's'
+    return b'?'
+
+
+def scan_files(root):
+    """Return a list of (relpath (bytes), type, size, inode) for every
+    non-directory under root
+
+    """
+    files = []
+    append = files.append
+    stack = [(os.fsencode(root), b'')]
+    while stack:
+        dir_path, dir_prefix = stack.pop()
+        try:
+            dir_entries = os.scandir(dir_path)
+        except OSError as err:
+            raise Error("unable to read directory %r: %s" % (os.fsdecode(dir_path), err))
+        with dir_entries:
+            for dir_entry in dir_entries:
+                relpath = dir_prefix + dir_entry.name
+                # the type comes from the directory entry; only the size
+                # needs a stat
+                if dir_entry.is_dir(follow_symlinks=False):
+                    stack.append((dir_entry.path, relpath + b'/'))
+                elif dir_entry.is_symlink():
+                    append((relpath, b'l', dir_entry.stat(follow_symlinks=False).st_size, dir_entry.inode()))
+                elif dir_entry.is_file(follow_symlinks=False):
+                    append((relpath, b'f', dir_entry.stat(follow_symlinks=False).st_size, dir_entry.inode()))
+                else:
+                    st = dir_entry.stat(follow_symlinks=False)
+                    append((relpath, _file_type(st.st_mode), st.st_size, dir_entry.inode()))
+    return files
+
+
+def write_index(index_path, files):
+    """Write the index for files (as returned by scan_files()) to index_path"""
+    files = sorted(files)
+    records = []
+    blob = []
+    offset = 0
+    for relpath, ftype, size, inode in files:
+        records.append(_RECORD.pack(offset, len(relpath), ftype, size, inode))
+        blob.append(relpath + b'\0')
+        offset += len(relpath) + 1
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as index_fh:
+        index_fh.write(_HEADER.pack(_MAGIC, _VERSION, len(records), _HEADER.size + _RECORD.size * len(records)))
+        index_fh.write(b''.join(records))
+        index_fh.write(b''.join(blob))
+    os.rename(tmp_path, index_path)
+
+
+def make_index(root, index_path, include_paths=None):
+    """Index the files under root, leaving out index_path itself and the
+    paths (relative to root, as str) in include_paths.  Returns the number
+    of files in the index.
+
+    """
+    skip = set(os.fsencode(x) for x in include_paths or [])
+    index_relpath = os.fsencode(os.path.relpath(index_path, root))
+    skip.add(index_relpath)
+    skip.add(index_relpath + b'.tmp')
+    files = [x for x in scan_files(root) if x[0] not in skip]
+    write_index(index_path, files)
+    return len(files)
+
+
+class Stage1Index(object):
+    """A memory-mapped stage 1 index.  'relpath in index' does a binary
+    search; paths() loads all the paths at once.
+
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_fh:
+            try:
+                self.map = mmap.mmap(index_fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise Error("stage 1 index %r is empty" % index_path)
+        magic, version, self.count, self.blob_offset = _HEADER.unpack_from(self.map, 0)
+        if magic != _MAGIC:
+            raise Error("%r is not a stage 1 index" % index_path)
+        if version != _VERSION:
+            raise Error("stage 1 index %r is version %d, not version %d" % (index_path, version, _VERSION))
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, i):
+        return _RECORD.unpack_from(self.map, _HEADER.size + _RECORD.size * i)
+
+    def _path(self, i):
+        offset, length = self._record(i)[:2]
+        start = self.blob_offset + offset
+        return self.map[start:start + length]
+
+    def entry(self, i):
+        """Return (relpath, type, size, inode) for record i"""
+        offset, length, ftype, size, inode = self._record(i)
+        start = self.blob_offset + offset
+        return os.fsdecode(self.map[start:start + length]), ftype.decode(), size, inode
+
+    def __contains__(self, relpath):
+        key = os.fsencode(relpath)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._path(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low < self.count and self._path(low) == key
+
+    def paths(self):
+        """Return the set of all the paths in the index"""
+        blob = self.map[self.blob_offset:]
+        if not blob:
+            return set()
+        # decoding the blob in one go is much faster than path by path
+        return set(blob[:-1].decode(sys.getfilesystemencoding(), 'surrogateescape').split('\0'))
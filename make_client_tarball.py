@@ -1,6 +1,7 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 from __future__ import print_function
 import sys
+import contextlib
 
 import os
 from optparse import OptionParser
@@ -8,6 +9,8 @@ import shutil
 import tempfile
 import subprocess
 import re
+import time
+import multiprocessing
 try:
     import ConfigParser
 except ImportError:
@@ -24,8 +27,21 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 
+import archive
+import buildcache
+import buildreport
+import compression
+import patch_preflight
+import pkglock
+import prefetch
+import repocache
+import rpmdb
+import rpmstore
+import scheduler
 import stage1
+import stage1cache
 import stage2
+import staging
 
 from common import *
 import yumconf
@@ -61,43 +77,647 @@ def check_yum_priorities():
     return True
 
 def get_repofile(prog_dir, bundlecfg, bundle, basearch, dver):
-    return os.path.join(prog_dir, bundlecfg.get(bundle, 'repofile') % {'basearch': basearch, 'dver': dver})
-
-def make_tarball(bundlecfg, bundle, basearch, dver, packages, patch_dirs, prog_dir, stage_dir, relnum="0", extra_repos=None, version=None):
-    """Run all the steps to make a non-root tarball.
-    Returns (success (bool), tarball_path (relative), tarball_size (in bytes))
+    return os.path.join(prog_dir, bundlecfg.get(bundle, 'repofile') % {'basearch': basearch, 'dver': dver, 'bundle': bundle})
+
+def get_stage1_pkglist_file(prog_dir, bundlecfg, bundle, basearch, dver):
+    return os.path.join(prog_dir, bundlecfg.get(bundle, 'stage1file') % {'basearch': basearch, 'dver': dver})
+
+def get_patch_dirs(prog_dir, bundlecfg, bundle, basearch, dver):
+    if not bundlecfg.has_option(bundle, 'patchdirs'):
+        return []
+    return [os.path.join(prog_dir, x) for x in (bundlecfg.get(bundle, 'patchdirs') % {'basearch': basearch, 'dver': dver}).split()]
+
+def make_tarball(bundlecfg, bundle, basearch, dver, packages, patch_dirs, prog_dir, stage_dir, relnum="0", extra_repos=None, version=None, repo_cache=None, rpm_store=None,
+                 stage1_pkglist_file=None, stage1_cache=None, artifact_cache=None, codec=None, report=None,
+                 package_lock=None, lock_mode=None, overlay=False, base_snapshots=None, snapshot_base=False, basebundle=None,
+                 prefetch_rpms=False, rewrite_rpath=False, scratch_dir=None):
+    """Run all the steps to make a non-root tarball, recording the time taken
+    by each step in report (a buildreport.BuildReport).
+    Things that don't have to be in the stage dir's file system (the locked
+    RPMs, and the stage 1 layer of an overlay) go in scratch_dir, which
+    defaults to the parent of stage_dir; that can keep them out of a tmpfs.
+    If lock_mode is 'lock', record the RPMs that went into the build in
+    package_lock (a pkglock.PackageLock); if it is 'locked', install exactly
+    the RPMs recorded there instead.  Both need rpm_store.
+    If overlay is True, stage 1 is used as the read-only lower layer of an
+    overlay, and stage 2 is done in the upper layer.
+    base_snapshots is a stage1cache.BaseBundleSnapshots.  If snapshot_base is
+    True, a snapshot of this build is taken right after its stage 2 packages
+    are installed.  If basebundle is given and there is a snapshot of it,
+    this build starts from the snapshot and only installs the packages the
+    base bundle does not have.
+    If prefetch_rpms is True, the RPMs for stage 2 are downloaded into
+    rpm_store in the background while stage 1 is being made.
+    If rewrite_rpath is True, the ELF files in the tarball find their
+    libraries through $ORIGIN RUNPATHs instead of the LD_LIBRARY_PATH.
+    Returns (success (bool), tarball_path (relative), tarball_size (in bytes),
+             archive_result (archive.ArchiveResult))
 
     """
     repofile = get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
 
+    scratch_dir = scratch_dir or os.path.dirname(stage_dir)
     extra_repos = extra_repos or []
-
-    with yumconf.YumInstaller(repofile, dver, basearch, extra_repos) as yum:
+    codec = codec or compression.Codec(compression.DEFAULT_CODEC)
+    tarext = codec.extension
+    report = report or buildreport.BuildReport()
+
+    locked_stages = {}
+    if lock_mode == 'locked':
+        statusmsg("Checking out locked RPMs from %r" % package_lock.path)
+        try:
+            with report.phase("tarball.checkout_locked_rpms"):
+                locked_version, locked_stages = package_lock.checkout(
+                    bundle, dver, basearch, rpm_store, os.path.join(scratch_dir, 'locked-rpms'))
+        except (Error, EnvironmentError) as err:
+            errormsg(str(err))
+            return (False, None, 0, None)
+        version = version or locked_version
+        repo_cache = None  # no repo metadata needed
+
+    with contextlib.ExitStack() as yum_stack:
+        try:
+            yum = yum_stack.enter_context(
+                yumconf.YumInstaller(repofile, dver, basearch, extra_repos, metadata_cache=repo_cache, rpm_store=rpm_store))
+        except Error as err:
+            errormsg("Could not set up yum for %s: %s" % (bundle, err))
+            return (False, None, 0, None)
         if not version:
             if bundlecfg.has_option(bundle, 'versionrpm'):
-                version = yum.repoquery(bundlecfg.get(bundle, 'versionrpm'), "--queryformat=%{VERSION}").rstrip()
+                with report.phase("tarball.get_version"):
+                    version = yum.repoquery(bundlecfg.get(bundle, 'versionrpm'), "--queryformat=%{VERSION}").rstrip()
             else:
                 version = 'unknown'
         tarball_path = bundlecfg.get(bundle, 'tarballname') % locals()
+        report.set('version', version)
+        report.set('tarball', tarball_path)
 
         post_scripts_dir = os.path.join(prog_dir, "post-install")
 
-        statusmsg("Making stage 2 tarball for %s" % (packages))
-        if not stage2.make_stage2_tarball(
-                stage_dir        = stage_dir,
-                packages         = packages,
-                tarball          = tarball_path,
-                patch_dirs       = patch_dirs,
-                post_scripts_dir = post_scripts_dir,
-                repofile         = repofile,
-                dver             = dver,
-                basearch         = basearch,
-                relnum           = relnum,
-                extra_repos      = extra_repos):
-            errormsg("Making stage 2 tarball for %s unsuccessful. Files have been left in %r" % (packages, stage_dir))
-            return (False, None, 0)
-        tarball_size = os.stat(tarball_path)[6]
-        return (True, tarball_path, tarball_size)
+        manifest = fingerprint = None
+        if artifact_cache:
+            statusmsg("Computing build fingerprint")
+            try:
+                with report.phase("tarball.resolve_fingerprint"):
+                    if locked_stages:
+                        stage2_nevras = sorted(locked_stages['stage2'].nevras())
+                    else:
+                        stage2_nevras = yum.resolve(packages)
+            except (subprocess.CalledProcessError, IndexError, Error) as err:
+                errormsg("Could not resolve stage 2 packages for the build fingerprint: %s" % err)
+                return (False, None, 0, None)
+            manifest = buildcache.make_manifest(
+                stage2_nevras        = stage2_nevras,
+                patch_dirs           = patch_dirs,
+                post_scripts_dir     = post_scripts_dir,
+                prog_dir             = prog_dir,
+                stage1_pkglist_file  = stage1_pkglist_file,
+                stage1_includes_file = stage1.get_includes_file(stage1_pkglist_file),
+                dver                 = dver,
+                basearch             = basearch,
+                dirname              = bundlecfg.get(bundle, 'dirname'),
+                tarball_path         = tarball_path,
+                relnum               = relnum,
+                codec                = codec,
+                rewrite_rpath        = rewrite_rpath)
+            fingerprint = buildcache.fingerprint(manifest)
+            report.set('fingerprint', fingerprint)
+            if artifact_cache.has(fingerprint, tarball_path):
+                statusmsg("Build fingerprint %s unchanged; reusing the previously built tarball" % fingerprint)
+                with report.phase("tarball.fetch_artifact"):
+                    archive_result = artifact_cache.fetch(fingerprint, tarball_path)
+                report.set('reused_artifact', True)
+                return (True, tarball_path, os.stat(tarball_path)[6], archive_result)
+            statusmsg("Build fingerprint is %s" % fingerprint)
+
+        stage2_packages = packages
+        base_key = None
+        if base_snapshots and basebundle:
+            base_key = base_snapshots.key(basebundle, dver, basearch)
+            if base_snapshots.has(base_key):
+                base_packages = set(bundlecfg.get(basebundle, 'packages').split())
+                stage2_packages = [x for x in packages if x not in base_packages]
+                report.set('basebundle', basebundle)
+            else:
+                statusmsg("No snapshot of base bundle %s for %s,%s; building %s from scratch" % (basebundle, dver, basearch, bundle))
+                base_key = None
+
+        snapshot_func = None
+        if base_snapshots and snapshot_base:
+            def snapshot_func(changed_dir):
+                key = base_snapshots.key(bundle, dver, basearch)
+                with base_snapshots.lock(key):
+                    base_snapshots.store(key, changed_dir, info={'bundle': bundle, 'packages': packages})
+
+        prefetcher = None
+        if prefetch_rpms and rpm_store and not locked_stages and stage2_packages:
+            # what stage 1 (or the base bundle) provides is not needed
+            installed_packages = stage1.FORCE_INSTALL_PACKAGES + stage1.get_stage1_packages(stage1_pkglist_file)
+            if base_key:
+                installed_packages += bundlecfg.get(basebundle, 'packages').split()
+            prefetcher = prefetch.Prefetcher(repofile, dver, basearch, stage2_packages, rpm_store, extra_repos=extra_repos,
+                                             metadata_cache=repo_cache, stage1_packages=installed_packages, report=report)
+
+        def _clone_base_snapshot(dest_dir):
+            statusmsg("Starting from the snapshot of base bundle %s" % basebundle)
+            with report.phase("tarball.clone_base_snapshot"):
+                with base_snapshots.lock(base_key, shared=True):
+                    method = base_snapshots.clone_to(base_key, dest_dir)
+            statusmsg("Cloned snapshot of %s using %ss" % (basebundle, method))
+
+        def _stage2(layers):
+            """Everything after stage 1.  layers is a stage2.OverlayLayers if
+            stage 2 is done in an overlay.
+
+            """
+            def _stage_root():
+                # the overlay is only mounted while stage 2 needs it
+                if layers:
+                    return OverlayMount(layers.lower_dir, layers.upper_dir, layers.work_dir, stage_dir)
+                return _NoMount()
+
+            if prefetcher:
+                with report.phase("tarball.wait_for_prefetch"):
+                    prefetcher.wait()
+                report.set('prefetch', {'rpms': prefetcher.rpm_count,
+                                        'success': not prefetcher.error,
+                                        'overlap_with_stage1': report.overlap('tarball.prefetch', 'stage1.')})
+
+            if lock_mode == 'lock':
+                stage1_packages = rpmdb.RpmDbSnapshot(layers.lower_dir if layers else stage_dir).packages
+
+            statusmsg("Making stage 2 tarball for %s" % (stage2_packages))
+            archive_result = stage2.make_stage2_tarball(
+                    stage_dir        = stage_dir,
+                    packages         = stage2_packages,
+                    tarball          = tarball_path,
+                    patch_dirs       = patch_dirs,
+                    post_scripts_dir = post_scripts_dir,
+                    repofile         = repofile,
+                    dver             = dver,
+                    basearch         = basearch,
+                    relnum           = relnum,
+                    extra_repos      = extra_repos,
+                    repo_cache       = repo_cache,
+                    rpm_store        = rpm_store,
+                    codec            = codec,
+                    report           = report,
+                    locked           = locked_stages.get('stage2'),
+                    overlay          = layers,
+                    snapshot_func    = snapshot_func,
+                    rewrite_rpath    = rewrite_rpath)
+            if archive_result is None:
+                errormsg("Making stage 2 tarball for %s unsuccessful" % stage2_packages)
+                return (False, None, 0, None)
+
+            if lock_mode == 'lock':
+                statusmsg("Recording the installed RPMs in %r" % package_lock.path)
+                try:
+                    with report.phase("tarball.update_lock"):
+                        with _stage_root():
+                            update_package_lock(package_lock, yum, rpm_store, stage_dir, stage1_packages,
+                                                bundle, dver, basearch, version)
+                except (Error, EnvironmentError) as err:
+                    errormsg("Could not update lockfile: %s" % err)
+                    return (False, None, 0, None)
+
+            if artifact_cache:
+                statusmsg("Saving tarball in artifact cache")
+                with report.phase("tarball.store_artifact"):
+                    artifact_cache.store(fingerprint, tarball_path, manifest, archive_result)
+                    artifact_cache.evict(keep_key=fingerprint)
+
+            tarball_size = os.stat(tarball_path)[6]
+            return (True, tarball_path, tarball_size, archive_result)
+
+        def _stages():
+            """Stage 1 (or the base bundle snapshot) and stage 2"""
+            if overlay:
+                try:
+                    with stage1.stage1_layer(os.path.join(scratch_dir, 'stage1'), repofile, dver, basearch, stage1_pkglist_file,
+                                             repo_cache=repo_cache, rpm_store=rpm_store, cache=stage1_cache, report=report,
+                                             locked=locked_stages.get('stage1')) as lower_dir:
+                        statusmsg("Using %r as the stage 1 layer" % lower_dir)
+                        layers = stage2.OverlayLayers(
+                            lower_dir     = lower_dir,
+                            upper_dir     = os.path.join(os.path.dirname(stage_dir), 'upper'),
+                            work_dir      = os.path.join(os.path.dirname(stage_dir), 'work'),
+                            include_paths = get_stage1_include_paths(stage1_pkglist_file))
+                        if base_key:
+                            _clone_base_snapshot(layers.upper_dir)
+                        return _stage2(layers)
+                except Error as err:
+                    errormsg(str(err))
+                    return (False, None, 0, None)
+
+            if base_key:
+                try:
+                    _clone_base_snapshot(stage_dir)
+                except Error as err:
+                    errormsg(str(err))
+                    return (False, None, 0, None)
+                return _stage2(None)
+
+            statusmsg("Making stage 1 dir")
+            if not stage1.make_stage1_dir(stage_dir, repofile, dver, basearch, stage1_pkglist_file, repo_cache=repo_cache, rpm_store=rpm_store,
+                                          cache=stage1_cache, report=report, locked=locked_stages.get('stage1')):
+                errormsg("Making stage 1 dir unsuccessful")
+                return (False, None, 0, None)
+            return _stage2(None)
+
+        if not prefetcher:
+            return _stages()
+        prefetcher.start()
+        try:
+            return _stages()
+        finally:
+            # don't leave it running if stage 1 failed
+            prefetcher.wait()
+
+
+def get_stage1_include_paths(stage1_pkglist_file):
+    includes_file = stage1.get_includes_file(stage1_pkglist_file)
+    if not os.path.exists(includes_file):
+        return set()
+    return archive.read_stage1_filelist(includes_file)
+
+
+class _NoMount(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def update_package_lock(package_lock, yum, rpm_store, stage_dir, stage1_packages, bundle, dver, basearch, version):
+    """Record the RPMs in stage 1 (stage1_packages) and the ones stage 2
+    added in package_lock, first adding any that are not in rpm_store to it
+
+    """
+    # gpg-pubkey "packages" are imported keys; there are no RPMs for them
+    stage1_packages = [x for x in stage1_packages if x.name != 'gpg-pubkey']
+    stage1_nevras = set(x.nevra for x in stage1_packages)
+    stage2_packages = [x for x in rpmdb.RpmDbSnapshot(stage_dir).packages
+                       if x.nevra not in stage1_nevras and x.name != 'gpg-pubkey']
+    pkglock.fill_rpm_store(yum, os.path.abspath(stage_dir), stage1_packages + stage2_packages, rpm_store)
+    package_lock.update(bundle, dver, basearch, version,
+                        pkglock.lock_entries(stage1_packages, rpm_store),
+                        pkglock.lock_entries(stage2_packages, rpm_store))
+
+
+def read_bundlecfg(prog_dir):
+    bundlecfg = ConfigParser.RawConfigParser()
+    with open(os.path.join(prog_dir, BUNDLES_FILE)) as bundlesfh:
+        bundlecfg.readfp(bundlesfh)
+    return bundlecfg
+
+
+def get_stage1_cache(options):
+    if options.stage1_cache:
+        return stage1cache.Stage1Cache(options.stage1_cache,
+                                       max_age_days=options.stage1_cache_max_age,
+                                       max_size=options.stage1_cache_max_size)
+    elif options.shared_stage1_dir:
+        return stage1cache.SharedStage1Dirs(options.shared_stage1_dir)
+    return None
+
+
+def get_stage_slots(options):
+    if not options.stage_slot_dir:
+        return None
+    return scheduler.StageSlots(options.stage_slot_dir, options.stage_limits)
+
+
+def get_base_snapshots(options):
+    if not options.base_snapshot_dir:
+        return None
+    return stage1cache.BaseBundleSnapshots(options.base_snapshot_dir)
+
+
+def check_basebundle(bundlecfg, bundle):
+    """Return what is wrong with the basebundle of bundle, or None.  A bundle
+    can only be built on top of a base bundle that uses the same repos and
+    stage 1, and whose packages it also has.
+
+    """
+    basebundle = bundlecfg.get(bundle, 'basebundle')
+    if basebundle == bundle:
+        return "a bundle can't be its own base bundle"
+    if not bundlecfg.has_section(basebundle):
+        return "base bundle %s not found in %s" % (basebundle, BUNDLES_FILE)
+    for key in 'repofile', 'stage1file':
+        if bundlecfg.get(bundle, key) != bundlecfg.get(basebundle, key):
+            return "%s is not the same as in base bundle %s" % (key, basebundle)
+    missing = set(bundlecfg.get(basebundle, 'packages').split()) - set(bundlecfg.get(bundle, 'packages').split())
+    if missing:
+        return "packages of base bundle %s missing: %s" % (basebundle, " ".join(sorted(missing)))
+    return None
+
+
+def get_derived_tasks(bundlecfg, tasks):
+    """Return a dict of the (bundle, dver, basearch) tasks that can be built
+    on top of the build of their base bundle, which is also in tasks, to the
+    task for the base bundle
+
+    """
+    task_set = set(tasks)
+    derived_tasks = {}
+    for bundle, dver, basearch in tasks:
+        if not bundlecfg.has_option(bundle, 'basebundle'):
+            continue
+        base_task = (bundlecfg.get(bundle, 'basebundle'), dver, basearch)
+        if base_task in task_set:
+            derived_tasks[(bundle, dver, basearch)] = base_task
+    return derived_tasks
+
+
+def group_tasks_by_stage1(bundlecfg, tasks, prog_dir):
+    """Group the (bundle, dver, basearch) tasks by the inputs of their
+    stage 1 (the repo file, the stage 1 package list and the paramset).
+    Returns a list of lists of tasks, in the order they first appear.
+
+    """
+    groups = []
+    group_for_inputs = {}
+    for bundle, dver, basearch in tasks:
+        inputs = (get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver),
+                  get_stage1_pkglist_file(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver),
+                  dver, basearch)
+        if inputs not in group_for_inputs:
+            group_for_inputs[inputs] = []
+            groups.append(group_for_inputs[inputs])
+        group_for_inputs[inputs].append((bundle, dver, basearch))
+    return groups
+
+
+def get_repo_cache(options):
+    if not options.repo_cache:
+        return None
+    return repocache.RepoMetadataCache(options.repo_cache,
+                                       ttl_hours=options.repo_cache_ttl,
+                                       refresh_before=options.repo_cache_refresh_before)
+
+
+def get_rpm_store(options):
+    if not options.rpm_store:
+        return None
+    return rpmstore.RpmStore(options.rpm_store, max_size=options.rpm_store_max_size)
+
+
+def get_package_lock(options, prog_dir):
+    if not options.lock_mode:
+        return None
+    return pkglock.PackageLock(options.lockfile or os.path.join(prog_dir, pkglock.LOCK_FILE))
+
+
+def get_codec(bundlecfg, bundle, options):
+    if options.codec:
+        return compression.parse_codec(options.codec)
+    elif bundlecfg.has_option(bundle, 'codec'):
+        return compression.parse_codec(bundlecfg.get(bundle, 'codec'))
+    return compression.Codec(compression.DEFAULT_CODEC)
+
+
+def get_artifact_cache(options):
+    if not options.artifact_cache:
+        return None
+    return buildcache.ArtifactCache(options.artifact_cache,
+                                    max_age_days=options.artifact_cache_max_age,
+                                    max_size=options.artifact_cache_max_size)
+
+
+def write_report(report, options, bundle, dver, basearch):
+    report_path = os.path.join(options.report_dir, "%s-%s-%s.report.json" % (bundle, dver, basearch))
+    try:
+        safe_makedirs(options.report_dir)
+        report.write(report_path)
+        statusmsg("Build report written to %r" % report_path)
+    except EnvironmentError as err:
+        errormsg("Unable to write build report %r: %s" % (report_path, err))
+
+
+def build_paramset(bundlecfg, bundle, dver, basearch, options, prog_dir, repo_cache=None):
+    """Make stage 1 and the tarball for a single bundle/paramset.
+    Returns (success (bool), tarball_path, tarball_size, archive_result)
+
+    """
+    if options.repofile:
+        bundlecfg.set(bundle, 'repofile', options.repofile)
+
+    report = buildreport.BuildReport(stage_slots=get_stage_slots(options))
+    report.set('bundle', bundle)
+    report.set('dver', dver)
+    report.set('basearch', basearch)
+
+    stage1_pkglist_file = get_stage1_pkglist_file(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
+    stage2_pkglist = bundlecfg.get(bundle, 'packages').split()
+
+    with report.phase("tarball.choose_staging"):
+        tmpfs_size = get_tmpfs_size(bundlecfg, bundle, dver, basearch, options, prog_dir, stage1_pkglist_file, repo_cache, report)
+    staging_dir = None
+    if tmpfs_size:
+        try:
+            staging_dir = staging.StagingDir('stagedir-%s-%s-' % (dver, basearch), tmpfs_size)
+        except Error as err:
+            errormsg("%s; staging on disk" % err)
+    if not staging_dir:
+        staging_dir = staging.StagingDir('stagedir-%s-%s-' % (dver, basearch))
+    report.set('staging', 'tmpfs' if staging_dir.tmpfs else 'disk')
+    stage_dir_parent = staging_dir.path
+    stage_dir = os.path.join(stage_dir_parent, bundlecfg.get(bundle, 'dirname'))
+    # downloaded RPMs, repo metadata and the stage 1 layer of an overlay don't
+    # need to be in RAM
+    scratch_dir = stage_dir_parent
+    if staging_dir.tmpfs:
+        scratch_dir = tempfile.mkdtemp(prefix='scratch-%s-%s-' % (dver, basearch))
+    patch_dirs = get_patch_dirs(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
+
+    rpm_store = get_rpm_store(options)
+    prefetch_rpms = options.prefetch and options.lock_mode != 'locked'
+    if prefetch_rpms and not repo_cache:
+        # the prefetch must not share the system yum cache with stage 1,
+        # which cleans it
+        repo_cache = repocache.RepoMetadataCache(os.path.join(scratch_dir, 'repo-cache'))
+    base_snapshots = get_base_snapshots(options)
+    snapshot_base = basebundle = None
+    if base_snapshots:
+        snapshot_base = (bundle, dver, basearch) in options.base_tasks
+        if bundlecfg.has_option(bundle, 'basebundle') and (bundlecfg.get(bundle, 'basebundle'), dver, basearch) in options.base_tasks:
+            basebundle = bundlecfg.get(bundle, 'basebundle')
+
+    (success, tarball_path, tarball_size, archive_result) = \
+        make_tarball(
+            bundlecfg=bundlecfg,
+            bundle=bundle,
+            basearch=basearch,
+            dver=dver,
+            packages=stage2_pkglist,
+            patch_dirs=patch_dirs,
+            prog_dir=prog_dir,
+            stage_dir=stage_dir,
+            relnum=options.relnum,
+            extra_repos=options.extra_repos,
+            version=options.version,
+            repo_cache=repo_cache,
+            rpm_store=rpm_store,
+            stage1_pkglist_file=stage1_pkglist_file,
+            stage1_cache=get_stage1_cache(options),
+            artifact_cache=get_artifact_cache(options),
+            codec=get_codec(bundlecfg, bundle, options),
+            report=report,
+            package_lock=get_package_lock(options, prog_dir),
+            lock_mode=options.lock_mode,
+            overlay=options.overlay,
+            base_snapshots=base_snapshots,
+            snapshot_base=snapshot_base,
+            basebundle=basebundle,
+            prefetch_rpms=prefetch_rpms,
+            scratch_dir=scratch_dir,
+            rewrite_rpath=options.rewrite_rpath)
+
+    report.set('success', success)
+    if rpm_store:
+        rpm_store_stats = rpm_store.stats()
+        report.set('rpm_store', rpm_store_stats)
+        statusmsg("RPM store: %d hits, %d misses (%.0f%% hit rate)" % (
+            rpm_store_stats['hits'], rpm_store_stats['misses'], rpm_store_stats['hit_rate'] * 100))
+        rpm_store.evict()
+    if success:
+        report.set('tarball_size', tarball_size)
+        report.set('archive', archive_result.to_dict())
+    write_report(report, options, bundle, dver, basearch)
+
+    if not success:
+        if staging_dir.tmpfs and not options.keep:
+            # don't tie up the RAM for the rest of the run
+            errormsg("Removing the tmpfs staging dir %r; use --keep or --staging=disk to keep the files of failed builds" % stage_dir_parent)
+            staging_dir.remove()
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        else:
+            errormsg("Files have been left in %s" % " and ".join(repr(x) for x in sorted(set([stage_dir_parent, scratch_dir]))))
+        return (False, None, 0, None)
+
+    print("Tarball created as %r, size %d bytes, %s files" % (tarball_path, tarball_size, archive_result.filecount))
+
+    if not options.keep:
+        statusmsg("Removing temp dirs")
+        staging_dir.remove()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    elif staging_dir.tmpfs:
+        statusmsg("The tmpfs on %r is still mounted; unmount it when done" % stage_dir_parent)
+
+    return (True, tarball_path, tarball_size, archive_result)
+
+
+def get_tmpfs_size(bundlecfg, bundle, dver, basearch, options, prog_dir, stage1_pkglist_file, repo_cache, report):
+    """Return the size of the tmpfs to do the build in, or None to do it on
+    disk, according to --staging
+
+    """
+    if options.staging == 'disk':
+        return None
+    elif options.staging == 'tmpfs':
+        return options.staging_mem_budget
+    if options.lock_mode == 'locked':
+        statusmsg("Not estimating the size of a locked build; staging on disk")
+        return None
+
+    repofile = get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
+    packages = (stage1.FORCE_INSTALL_PACKAGES + stage1.get_stage1_packages(stage1_pkglist_file)
+                + bundlecfg.get(bundle, 'packages').split())
+    try:
+        with yumconf.YumInstaller(repofile, dver, basearch, options.extra_repos, metadata_cache=repo_cache) as yum:
+            estimate = staging.estimate_size(yum, packages)
+    except (Error, subprocess.CalledProcessError) as err:
+        errormsg("Could not estimate the size of the build (%s); staging on disk" % err)
+        return None
+    report.set('staging_estimate', estimate)
+    if estimate > options.staging_mem_budget:
+        statusmsg("The build needs about %d MB, more than the %d MB memory budget; staging on disk" % (
+            estimate // (1024 * 1024), options.staging_mem_budget // (1024 * 1024)))
+        return None
+    return options.staging_mem_budget
+
+
+def _build_paramset_worker(args):
+    """Build a single paramset in a worker process.  The output of the worker
+    (including that of its child processes) goes to its own log file.  If no
+    --repo-cache is given, it uses its own yum cache so workers don't fight
+    over the system one.
+
+    """
+    bundle, dver, basearch, options, prog_dir = args
+    log_path = os.path.join(options.log_dir, "%s-%s-%s.log" % (bundle, dver, basearch))
+    private_cache_dir = None
+    repo_cache = get_repo_cache(options)
+    if not repo_cache:
+        private_cache_dir = tempfile.mkdtemp(prefix='repocache-%s-%s-' % (dver, basearch))
+        repo_cache = repocache.RepoMetadataCache(private_cache_dir)
+    try:
+        with open(log_path, 'w') as log_fh:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(log_fh.fileno(), 1)
+            os.dup2(log_fh.fileno(), 2)
+            try:
+                bundlecfg = read_bundlecfg(prog_dir)
+                return build_paramset(bundlecfg, bundle, dver, basearch, options, prog_dir, repo_cache=repo_cache)
+            except Exception as err:  # don't take down the other workers
+                errormsg("Unexpected error building %s %s %s: %s" % (bundle, dver, basearch, err))
+                return (False, None, 0, None)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        if private_cache_dir:
+            shutil.rmtree(private_cache_dir, ignore_errors=True)
+
+
+def build_paramsets_parallel(tasks, options, prog_dir):
+    """Build each (bundle, dver, basearch) in tasks in its own worker process,
+    running up to options.jobs at once.  Returns the results of
+    build_paramset() in the same order as tasks.
+
+    """
+    safe_makedirs(options.log_dir)
+    for bundle, dver, basearch in tasks:
+        statusmsg("Building %s for %s,%s; log in %s" % (
+            bundle, dver, basearch, os.path.join(options.log_dir, "%s-%s-%s.log" % (bundle, dver, basearch))))
+    pool = multiprocessing.Pool(min(options.jobs, len(tasks)))
+    try:
+        results = pool.map(_build_paramset_worker,
+                           [(bundle, dver, basearch, options, prog_dir) for bundle, dver, basearch in tasks],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def run_preflight(bundlecfg, tasks, options, prog_dir, repo_cache=None):
+    """Check that the patches of each (bundle, dver, basearch) in tasks apply
+    to the packages in the repos (see the patch_preflight module), printing
+    what was found.  Returns the number of bundle/paramsets with patches
+    that fail, or None if the check could not be done at all.
+
+    """
+    for tool in "rpm2cpio", "cpio":
+        if not find_executable(tool):
+            errormsg("Can't check the patches: required executable '%s' not found" % tool)
+            return None
+    checks = [(get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver),
+               dver, basearch,
+               get_patch_dirs(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver))
+              for bundle, dver, basearch in tasks]
+    checked = patch_preflight.check_paramsets(checks, options.extra_repos, repo_cache, get_rpm_store(options), jobs=max(options.jobs, 4))
+    failed_count = patch_preflight.print_results(tasks, checked)
+    error_count = len([x for x in checked if x[1]])
+    statusmsg("Checked the patches for %d bundle/paramsets: %d with failing patches, %d could not be checked" % (
+        len(tasks), failed_count, error_count))
+    if error_count == len(tasks):
+        return None
+    return failed_count
 
 
 def parse_cmdline_args(argv):
@@ -115,6 +735,34 @@ or: %prog [options] --version=<version> --all
     parser.add_option("--keep", default=False, action="store_true", help="Keep temp dirs after tarball creation")
     parser.add_option("--bundle", dest="bundles", action="append", default=[], help="Names of bundles (from {0}) to make tarballs for".format(BUNDLES_FILE))
     parser.add_option("--extra-repos", dest="extra_repos", action="append", help="Extra yum repos to use")
+    parser.add_option("--repofile", default=None, help="Repo file to use instead of the one set for the bundle in {0}, e.g. one written by make-repo-snapshot. May contain %(bundle)s, %(dver)s and %(basearch)s. Implies --no-prerelease.".format(BUNDLES_FILE))
+    parser.add_option("-j", "--jobs", type="int", default=None, help="Number of bundle/paramset builds to run in parallel. Each build runs in its own process with its own log file. Default is 1 (%d with --pipeline)." % len(scheduler.STAGES))
+    parser.add_option("--pipeline", default=False, action="store_true", help="Run the builds at the same time (up to --jobs of them; %d if --jobs is not given), but let only --stage-jobs of them be in each stage (making stage 1, installing stage 2 packages, fixing up stage 2 and making the tarball) at once, so one build can install while another compresses." % len(scheduler.STAGES))
+    parser.add_option("--stage-jobs", default=scheduler.DEFAULT_STAGE_JOBS, help="How many builds can be in each stage at once with --pipeline, as STAGE=N[,STAGE=N...], where STAGE is one of (" + ", ".join(scheduler.STAGES) + "). Default is %default.")
+    parser.add_option("--codec", default=None, help="Compression codec for the tarballs, as NAME[,level=N][,threads=N], where NAME is one of (" + ", ".join(sorted(compression.CODECS)) + "). Overrides the codec set in {0}; the default is {1}.".format(BUNDLES_FILE, compression.DEFAULT_CODEC))
+    parser.add_option("--stage1-cache", default=None, help="Directory to keep a persistent cache of stage 1 dirs in. Stage 1 dirs are not cached if not specified.")
+    parser.add_option("--stage1-cache-max-age", type="float", default=stage1cache.DEFAULT_MAX_AGE_DAYS, help="Evict stage 1 cache entries not used in this many days. Default is %default.")
+    parser.add_option("--stage1-cache-max-size", default=stage1cache.DEFAULT_MAX_SIZE, help="Evict the least recently used stage 1 cache entries when the cache is bigger than this. Default is %default.")
+    parser.add_option("--repo-cache", default=None, help="Directory to keep a persistent cache of yum repo metadata in, shared by all builds that use the same repos. If not specified, the system yum cache is used (and cleaned) when building serially, and each parallel build uses its own temporary cache.")
+    parser.add_option("--repo-cache-ttl", type="float", default=repocache.DEFAULT_TTL_HOURS, help="Refresh cached repo metadata older than this many hours. Default is %default.")
+    parser.add_option("--refresh-repo-cache", default=False, action="store_true", help="Refresh the cached repo metadata (once per set of repos) regardless of its age")
+    parser.add_option("--rpm-store", default=None, help="Directory to keep downloaded RPMs in, so later builds can use them instead of downloading them again. Not used if not specified.")
+    parser.add_option("--rpm-store-max-size", default=rpmstore.DEFAULT_MAX_SIZE, help="Evict the least recently used RPMs when the RPM store is bigger than this. Default is %default.")
+    parser.add_option("--prefetch", default=False, action="store_true", help="Download the RPMs for stage 2 into the RPM store in the background while stage 1 is being made. Requires --rpm-store.")
+    parser.add_option("--no-preflight", dest="preflight", default=True, action="store_false", help="Do not check that the patches of the bundles apply before building. The check extracts only the patched files from the packages that provide them, and stops the run if a patch fails; it is always skipped with --locked.")
+    parser.add_option("--preflight-only", default=False, action="store_true", help="Only check that the patches of the bundles apply (see --no-preflight), without building anything")
+    parser.add_option("--staging", default="disk", choices=staging.STAGING_MODES, help="Where to do the builds: 'disk' (in a temp dir, the default), 'tmpfs' (in a tmpfs of --staging-mem-budget) or 'auto' (in a tmpfs if the packages of the build fit in --staging-mem-budget, on disk otherwise)")
+    parser.add_option("--staging-mem-budget", default=None, help="Size of the tmpfs for each build with --staging=tmpfs or auto. Default is half the available memory, divided by --jobs.")
+    parser.add_option("--overlay", default=False, action="store_true", help="Do stage 2 in an overlay on top of a read-only stage 1 dir, and make the tarball from what stage 2 added. With --stage1-cache, the cached stage 1 dir is used directly, and can be shared by concurrent builds.")
+    parser.add_option("--rewrite-rpath", default=False, action="store_true", help="Give the ELF files in the tarballs RUNPATHs relative to $ORIGIN pointing at the libraries they need in the tarball, and leave the library dirs that are then not needed off the LD_LIBRARY_PATH in setup.sh and setup.csh. Requires patchelf.")
+    parser.add_option("--lock", dest="lock_mode", action="store_const", const="lock", default=None, help="Record the exact RPMs that went into each build in the lockfile, and make sure they are in the RPM store. Requires --rpm-store.")
+    parser.add_option("--locked", dest="lock_mode", action="store_const", const="locked", help="Install exactly the RPMs recorded in the lockfile from the RPM store, with one rpm transaction per stage and without loading repo metadata or resolving dependencies. Requires --rpm-store.")
+    parser.add_option("--lockfile", default=None, help="Lockfile to use with --lock and --locked. Default is {0} next to {1}.".format(pkglock.LOCK_FILE, BUNDLES_FILE))
+    parser.add_option("--artifact-cache", default=None, help="Directory to keep previously built tarballs in, keyed on a fingerprint of the build inputs. A build whose fingerprint matches a cached tarball reuses it instead of running stage 1, stage 2 and tar. Not used if not specified.")
+    parser.add_option("--artifact-cache-max-age", type="float", default=buildcache.DEFAULT_MAX_AGE_DAYS, help="Evict artifact cache entries not used in this many days. Default is %default.")
+    parser.add_option("--artifact-cache-max-size", default=buildcache.DEFAULT_MAX_SIZE, help="Evict the least recently used artifact cache entries when the cache is bigger than this. Default is %default.")
+    parser.add_option("--report-dir", default=".", help="Directory to write the JSON build report for each bundle/paramset to. Default is %default.")
+    parser.add_option("--log-dir", default=".", help="Directory to write per-build log files to when --jobs is greater than 1. Default is %default.")
 
     options, args = parser.parse_args(argv[1:])
 
@@ -125,6 +773,47 @@ or: %prog [options] --version=<version> --all
     if not options.all and not options.dver:
         parser.error("Either --all or --dver must be specified.")
 
+    if options.jobs is None:
+        options.jobs = len(scheduler.STAGES) if options.pipeline else 1
+    elif options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    try:
+        options.stage_limits = scheduler.parse_stage_jobs(options.stage_jobs)
+    except ValueError as err:
+        parser.error("--stage-jobs: %s" % err)
+    if options.staging_mem_budget:
+        try:
+            options.staging_mem_budget = parse_size(options.staging_mem_budget)
+        except ValueError as err:
+            parser.error("--staging-mem-budget: %s" % err)
+    else:
+        options.staging_mem_budget = staging.default_mem_budget(options.jobs)
+    if options.staging != 'disk' and not options.staging_mem_budget:
+        parser.error("Could not tell how much memory is available; --staging-mem-budget must be given with --staging=%s" % options.staging)
+    # set by main() with --pipeline
+    options.stage_slot_dir = None
+    if options.codec:
+        try:
+            compression.parse_codec(options.codec).check()
+        except (ValueError, Error) as err:
+            parser.error("--codec: %s" % err)
+    for size_option in "stage1_cache_max_size", "artifact_cache_max_size", "rpm_store_max_size":
+        try:
+            parse_size(getattr(options, size_option))
+        except ValueError as err:
+            parser.error("--%s: %s" % (size_option.replace('_', '-'), err))
+
+    if options.lock_mode and not options.rpm_store:
+        parser.error("--lock and --locked require --rpm-store")
+    if options.prefetch and not options.rpm_store:
+        parser.error("--prefetch requires --rpm-store")
+    if options.lockfile:
+        options.lockfile = os.path.abspath(options.lockfile)
+    if options.repo_cache_ttl <= 0:
+        parser.error("--repo-cache-ttl must be positive")
+    # metadata fetched before now is refreshed the first time it is used
+    options.repo_cache_refresh_before = time.time() if options.refresh_repo_cache else 0
+
     if not options.bundles and not options.version:
         parser.error("--version or --bundle must be specified")
 
@@ -132,6 +821,16 @@ or: %prog [options] --version=<version> --all
         match = re.search(r'^[0-9.]+\.', options.version)
         options.osgver = match.group()[0:-1]
 
+    # set by main() if builds in this run share stage 1 dirs
+    options.shared_stage1_dir = None
+    # set by main() if builds in this run start from base bundle snapshots
+    options.base_snapshot_dir = None
+    options.base_tasks = []
+
+    if options.repofile:
+        options.repofile = os.path.abspath(options.repofile)
+        # the prerelease repo is not in a snapshot
+        options.prerelease = False
     if options.prerelease:
         options.extra_repos = options.extra_repos or []
         options.extra_repos.append('osg-prerelease-for-tarball')
@@ -145,19 +844,23 @@ def main(argv):
 
     options, args = parse_cmdline_args(argv)
 
+    if sys.version_info < (3, 6):
+        errormsg("Python 3.6 or newer is required (running %s)" % sys.version.split()[0])
+        return 1
     statusmsg("Checking privileges")
     if not check_running_as_root():
         return 1
     statusmsg("Checking required tools")
     if not check_tools():
         return 1
+    if options.rewrite_rpath and not find_executable("patchelf"):
+        errormsg("Required executable 'patchelf' not found (needed for --rewrite-rpath)")
+        return 1
     statusmsg("Checking yum-priorities")
     if not check_yum_priorities():
         return 1
 
-    bundlecfg = ConfigParser.RawConfigParser()
-    with open(os.path.join(prog_dir, BUNDLES_FILE)) as bundlesfh:
-        bundlecfg.readfp(bundlesfh)
+    bundlecfg = read_bundlecfg(prog_dir)
 
     if options.bundles:
         bundles = options.bundles
@@ -174,69 +877,103 @@ def main(argv):
         errormsg("No bundles.  Exiting")
         return 1
 
-    failed_paramsets = []
-    written_tarballs = []
+    for bundle in bundles:
+        try:
+            get_codec(bundlecfg, bundle, options).check()
+        except (ValueError, Error) as err:
+            errormsg("Bad codec for bundle %s: %s" % (bundle, err))
+            return 2
+
+    tasks = []
     for bundle in bundles:
         if options.all:
             paramsets = [tuple(x.split(',')) for x in bundlecfg.get(bundle, 'paramsets').split()]
         else:
             paramsets = [(options.dver, options.basearch)]
-
         for dver, basearch in paramsets:
-            stage_dir_parent = tempfile.mkdtemp(prefix='stagedir-%s-%s-' % (dver, basearch))
-            stage_dir = os.path.join(stage_dir_parent, bundlecfg.get(bundle, 'dirname'))
+            tasks.append((bundle, dver, basearch))
 
-            statusmsg("Making stage 1 dir")
+    repo_cache = get_repo_cache(options)
+    if repo_cache:
+        repo_cache.evict()
 
-            repofile = get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
-            stage1_pkglist_file = os.path.join(prog_dir, bundlecfg.get(bundle, 'stage1file') % {'basearch': basearch, 'dver': dver})
-            if not stage1.make_stage1_dir(stage_dir, repofile, dver, basearch, stage1_pkglist_file):
-                errormsg("Making stage 1 dir unsuccessful. Files have been left in %r" % stage_dir)
-                failed_paramsets.append([bundle, dver, basearch])
-                continue
-
-            stage2_pkglist = bundlecfg.get(bundle, 'packages').split()
-            patch_dirs = []
-            if bundlecfg.has_option(bundle, 'patchdirs'):
-                patch_dirs = [os.path.join(prog_dir, x) for x in (bundlecfg.get(bundle, 'patchdirs') % {'basearch': basearch, 'dver': dver}).split()]
-
-            (success, tarball_path, tarball_size) = \
-                make_tarball(
-                    bundlecfg=bundlecfg,
-                    bundle=bundle,
-                    basearch=basearch,
-                    dver=dver,
-                    packages=stage2_pkglist,
-                    patch_dirs=patch_dirs,
-                    prog_dir=prog_dir,
-                    stage_dir=stage_dir,
-                    relnum=options.relnum,
-                    extra_repos=options.extra_repos,
-                    version=options.version)
-
-            if success:
-                tarball_filecount = "?"
-                try:
-                    with os.popen("tar tzf %s | wc -l" % tarball_path) as ph:
-                        tarball_filecount = int(to_str(ph.read()))
-                except (EnvironmentError, ValueError) as e:
-                    print("error getting file count: %s" % e)
-                written_tarballs.append([tarball_path, tarball_size, tarball_filecount])
-                print("Tarball created as %r, size %d bytes, %d files" % (tarball_path, tarball_size, tarball_filecount))
+    if options.repofile:
+        for bundle in bundles:
+            bundlecfg.set(bundle, 'repofile', options.repofile)
+    for bundle in bundles:
+        if bundlecfg.has_option(bundle, 'basebundle'):
+            problem = check_basebundle(bundlecfg, bundle)
+            if problem:
+                errormsg("Bad basebundle for bundle %s: %s" % (bundle, problem))
+                return 2
+
+    if options.preflight_only or (options.preflight and options.lock_mode != 'locked'):
+        statusmsg("Checking that the patches apply")
+        failed_count = run_preflight(bundlecfg, tasks, options, prog_dir, repo_cache)
+        if options.preflight_only:
+            return 0 if failed_count == 0 else 1
+        elif failed_count:
+            errormsg("Patches fail for %d bundle/paramsets; not building. Pass --no-preflight to build anyway." % failed_count)
+            return 1
+
+    # Derived bundles are built after their base bundles, starting from a
+    # snapshot of the base bundle's stage 2.  Locked builds install their
+    # exact RPMs from scratch, and --lock needs stage 1 by itself.
+    derived_tasks = {}
+    if not options.lock_mode:
+        derived_tasks = get_derived_tasks(bundlecfg, tasks)
+    if derived_tasks:
+        options.base_snapshot_dir = tempfile.mkdtemp(prefix='base-snapshots-')
+        options.base_tasks = sorted(set(derived_tasks.values()))
+        for task, base_task in sorted(derived_tasks.items()):
+            statusmsg("Building %s %s,%s on top of %s" % (task + base_task[:1]))
+    stage1_groups = group_tasks_by_stage1(bundlecfg, tasks, prog_dir)
+    for group in stage1_groups:
+        if len(group) > 1:
+            statusmsg("Sharing a stage 1 dir between %s" % ", ".join("%s %s,%s" % x for x in group))
+    if len(stage1_groups) < len(tasks) and not options.stage1_cache:
+        # the stage 1 cache (if any) already shares stage 1 dirs
+        options.shared_stage1_dir = tempfile.mkdtemp(prefix='stage1-shared-')
+    if options.jobs > 1:
+        # start making each stage 1 dir before starting the builds that will
+        # wait for it
+        tasks = [group[i] for i in range(max(len(x) for x in stage1_groups))
+                 for group in stage1_groups if i < len(group)]
+    if options.pipeline:
+        options.stage_slot_dir = tempfile.mkdtemp(prefix='stage-slots-')
+    waves = [[x for x in tasks if x not in derived_tasks],
+             [x for x in tasks if x in derived_tasks]]
+    tasks = waves[0] + waves[1]
+
+    try:
+        results = []
+        for wave in waves:
+            if options.jobs > 1 and len(wave) > 1:
+                results += build_paramsets_parallel(wave, options, prog_dir)
             else:
-                failed_paramsets.append([bundle, dver, basearch])
-                continue
+                results += [build_paramset(bundlecfg, bundle, dver, basearch, options, prog_dir, repo_cache=repo_cache)
+                            for bundle, dver, basearch in wave]
+    finally:
+        for shared_dir in options.shared_stage1_dir, options.base_snapshot_dir, options.stage_slot_dir:
+            if shared_dir:
+                shutil.rmtree(shared_dir, ignore_errors=True)
 
-            if not options.keep:
-                statusmsg("Removing temp dirs")
-                shutil.rmtree(stage_dir_parent, ignore_errors=True)
-        #end for dver, basearch in paramsets
-    #end for bundle in options.bundles
+    failed_paramsets = []
+    written_tarballs = []
+    for (bundle, dver, basearch), (success, tarball_path, tarball_size, archive_result) in zip(tasks, results):
+        if success:
+            written_tarballs.append([tarball_path, tarball_size, archive_result])
+        else:
+            failed_paramsets.append([bundle, dver, basearch])
 
     if written_tarballs:
         statusmsg("The following tarballs were written:")
         for tarball in written_tarballs:
-            print("    path: %-50s size: %9d bytes %5s files" % (tarball[0], tarball[1], tarball[2]))
+            print("    path: %-50s size: %9d bytes %5s files" % (tarball[0], tarball[1], tarball[2].filecount))
+        statusmsg("Compression:")
+        for tarball in written_tarballs:
+            print("    path: %-50s codec: %-24s ratio: %5.2f throughput: %7.1f MB/s" % (
+                tarball[0], tarball[2].codec, tarball[2].ratio, tarball[2].throughput / (1024 * 1024)))
     if failed_paramsets:
         errormsg("The following sets of parameters failed:")
         for paramset in failed_paramsets:
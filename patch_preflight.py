@@ -0,0 +1,223 @@
+"""
+Check that the patches of bundles still apply, without building them.
+
+A patch that no longer applies to a new release of a package is otherwise
+only found when patch_installed_packages() fails, after a full stage 1 and
+stage 2 install.  For each bundle/paramset, this reads the paths of the
+files its patches change, asks the repos which package provides each one,
+downloads just those packages and extracts just those files from them into
+a scratch tree, and applies the patches there in the same order as a build
+would.  Patches that fail, or only apply with fuzz, are reported.  The
+bundle/paramsets are checked in parallel.
+
+make-client-tarball runs the check before building unless --no-preflight is
+given, and stops if a patch fails; `make-client-tarball --preflight-only` (or
+patch-preflight) runs just the check.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import glob
+import io
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import repocache
+import yumconf
+from common import Error, statusmsg, errormsg, safe_makedirs, to_str
+
+
+class PatchResult(object):
+    """How a patch fared for one bundle/paramset.  status is one of
+    'ok', 'fuzz' (applied, but some hunks needed fuzz), 'missing' (a file
+    it changes is not in any package) or 'failed'.
+
+    """
+    def __init__(self, patch_file, status, details=None):
+        self.patch_file = patch_file
+        self.status = status
+        self.details = details or []
+
+    @property
+    def failed(self):
+        return self.status in ('missing', 'failed')
+
+
+def get_patch_files(patch_dirs):
+    """Return the patch files in patch_dirs, in the order
+    stage2.patch_installed_packages() applies them
+
+    """
+    patch_files = []
+    for patch_dir in patch_dirs:
+        patch_files += glob.glob(os.path.join(os.path.abspath(patch_dir), "*.patch"))
+    patch_files.sort(key=os.path.basename)
+    return patch_files
+
+
+def _patch_path(header):
+    """The path (relative to the stage dir, as with patch -p1) from a
+    ---/+++ line of a patch, or None for /dev/null
+
+    """
+    path = header.split('\t')[0].strip()
+    if path == '/dev/null':
+        return None
+    return path.split('/', 1)[1] if '/' in path else path
+
+
+def patch_targets(patch_file):
+    """Return the paths (relative to the stage dir) of the existing files
+    patch_file changes; files it creates are left out
+
+    """
+    targets = []
+    old_path = None
+    with io.open(patch_file, 'r', errors='replace') as patch_fh:
+        for line in patch_fh:
+            if line.startswith('--- '):
+                old_path = _patch_path(line[4:])
+            elif line.startswith('+++ '):
+                new_path = _patch_path(line[4:])
+                if old_path and new_path and new_path not in targets:
+                    targets.append(new_path)
+                old_path = None
+    return targets
+
+
+def extract_files(rpm_path, relpaths, dest_dir):
+    """Extract the files in relpaths (where they are in the payload of
+    rpm_path) into dest_dir
+
+    """
+    rpm2cpio = subprocess.Popen(["rpm2cpio", rpm_path], stdout=subprocess.PIPE)
+    with open(os.devnull, 'wb') as fnull:
+        err = subprocess.call(["cpio", "-idm", "--quiet", "--no-absolute-filenames"] + ["./" + x for x in relpaths],
+                              stdin=rpm2cpio.stdout, stderr=fnull, cwd=dest_dir)
+    rpm2cpio.stdout.close()
+    if rpm2cpio.wait() or err:
+        raise Error("Could not extract files from %r" % rpm_path)
+
+
+def apply_patch(patch_file, tree_dir):
+    """Apply patch_file to tree_dir as a build would, and return a
+    PatchResult
+
+    """
+    proc = subprocess.Popen(["patch", "-p1", "--force", "-d", tree_dir, "--input", patch_file],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = to_str(proc.communicate()[0]).splitlines()
+    details = [x for x in output if re.search(r'FAILED|fuzz|can\'t find file|No file to patch|malformed', x)]
+    if proc.returncode:
+        return PatchResult(patch_file, 'failed', details)
+    elif any('fuzz' in x for x in details):
+        return PatchResult(patch_file, 'fuzz', details)
+    return PatchResult(patch_file, 'ok')
+
+
+def check_paramset(repofile, dver, basearch, patch_dirs, extra_repos=None, repo_cache=None, rpm_store=None):
+    """Check the patches in patch_dirs against the packages in the repos of
+    repofile for dver,basearch.  Returns a list of PatchResults, in the
+    order the patches are applied.
+
+    """
+    patch_files = get_patch_files(patch_dirs)
+    if not patch_files:
+        return []
+    targets = dict((x, patch_targets(x)) for x in patch_files)
+    paths = sorted(set(sum(targets.values(), [])))
+
+    scratch_dir = tempfile.mkdtemp(prefix='preflight-%s-%s-' % (dver, basearch))
+    try:
+        tree_dir = os.path.join(scratch_dir, 'tree')
+        empty_root = os.path.join(scratch_dir, 'root')
+        rpm_dir = os.path.join(scratch_dir, 'rpms')
+        for path in tree_dir, empty_root, rpm_dir:
+            safe_makedirs(path)
+        with yumconf.YumInstaller(repofile, dver, basearch, extra_repos, metadata_cache=repo_cache, rpm_store=rpm_store) as yum:
+            try:
+                owners = yum.file_owners(["/" + x for x in paths])
+            except subprocess.CalledProcessError as err:
+                raise Error("Could not look up the packages providing the patched files: %s" % err)
+            nevras = sorted(set(owners.values()))
+            if nevras:
+                err = subprocess.call(["rpm", "--initdb", "--root", empty_root])
+                if err:
+                    raise Error("Could not initialize rpmdb into %r (rpm process returned %d)" % (empty_root, err))
+                yum.download(empty_root, nevras, rpm_dir)
+        for rpm_path in glob.glob(os.path.join(rpm_dir, "*.rpm")):
+            extract_files(rpm_path, paths, tree_dir)
+
+        results = []
+        for patch_file in patch_files:
+            missing = [x for x in targets[patch_file] if not os.path.lexists(os.path.join(tree_dir, x))]
+            if missing:
+                results.append(PatchResult(patch_file, 'missing', ["no package provides /%s" % x for x in missing]))
+            else:
+                results.append(apply_patch(patch_file, tree_dir))
+        return results
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _check_paramset_worker(args):
+    repofile, dver, basearch, patch_dirs, extra_repos, repo_cache, rpm_store = args
+    try:
+        return check_paramset(repofile, dver, basearch, patch_dirs, extra_repos, repo_cache, rpm_store), None
+    except (Error, EnvironmentError) as err:
+        return [], err
+
+
+def check_paramsets(checks, extra_repos=None, repo_cache=None, rpm_store=None, jobs=4):
+    """Run check_paramset() for each (repofile, dver, basearch, patch_dirs)
+    in checks, up to jobs at once.  Returns a list of (results, error) in
+    the same order as checks, where results is the list from
+    check_paramset() and error is the Error (or None) that kept the check
+    from being done.
+
+    """
+    private_cache_dir = None
+    if not repo_cache:
+        # the checks run at the same time, so they can't share the system yum cache
+        private_cache_dir = tempfile.mkdtemp(prefix='preflight-repocache-')
+        repo_cache = repocache.RepoMetadataCache(private_cache_dir)
+    pool = ThreadPool(max(1, min(jobs, len(checks))))
+    try:
+        return pool.map(_check_paramset_worker,
+                        [tuple(x) + (extra_repos, repo_cache, rpm_store) for x in checks],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if private_cache_dir:
+            shutil.rmtree(private_cache_dir, ignore_errors=True)
+
+
+def print_results(tasks, checked):
+    """Print what check_paramsets() found for each (bundle, dver, basearch)
+    in tasks.  Returns the number of bundle/paramsets with patches that fail.
+
+    """
+    failed_count = 0
+    for (bundle, dver, basearch), (results, error) in zip(tasks, checked):
+        name = "%s %s,%s" % (bundle, dver, basearch)
+        if error:
+            errormsg("%s: could not check patches: %s" % (name, error))
+            continue
+        if any(x.failed for x in results):
+            failed_count += 1
+        for result in results:
+            if result.status == 'ok':
+                continue
+            line = "%s: %-7s %s" % (name, result.status, os.path.basename(result.patch_file))
+            if result.failed:
+                errormsg(line)
+            else:
+                statusmsg(line)
+            for detail in result.details:
+                print("    " + detail)
+    return failed_count
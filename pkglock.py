@@ -0,0 +1,141 @@
+"""
+Exact package lists for bundles, so known-good builds can be repeated quickly.
+
+A build with --lock records the NEVRA, file name and sha256 of every RPM that
+went into stage 1 and stage 2 of each bundle/paramset in the lockfile
+(bundles.lock, next to bundles.ini), and makes sure the RPMs are in the RPM
+store.  A build with --locked installs exactly those RPMs from the RPM store
+with one rpm transaction per stage: no repo metadata is loaded and nothing
+is depsolved.  It fails before doing anything if the lockfile has no entry
+for a bundle/paramset, or if any of its RPMs is missing from the store or
+does not match its checksum.
+
+The lockfile is JSON:
+
+    {"<bundle>": {"<dver>,<basearch>": {"version": "<version>",
+                                        "stage1": [<package>, ...],
+                                        "stage2": [<package>, ...]}}}
+
+where each package is {"nevra": ..., "filename": ..., "sha256": ...}.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+import shutil
+import tempfile
+
+import common
+from common import Error
+
+
+LOCK_FILE = 'bundles.lock'
+STAGES = ['stage1', 'stage2']
+
+
+def lock_entries(packages, rpm_store):
+    """Return the lockfile entries for packages (rpmdb.RpmPackage objects),
+    whose RPMs must be in rpm_store
+
+    """
+    entries = []
+    for package in sorted(packages, key=lambda x: x.nevra):
+        filename = package.nvra + '.rpm'
+        digest = rpm_store.digest(filename)
+        if not digest:
+            raise Error("%s is not in the RPM store %r" % (filename, rpm_store.store_dir))
+        entries.append({'nevra': package.nevra, 'filename': filename, 'sha256': digest})
+    return entries
+
+
+class LockedStage(object):
+    """The RPMs locked for one stage of a build, checked out of the RPM store"""
+    def __init__(self, entries, rpm_dir):
+        self.entries = entries
+        self.rpm_dir = rpm_dir
+
+    def nevras(self):
+        return [x['nevra'] for x in self.entries]
+
+    def rpm_paths(self):
+        return [os.path.join(self.rpm_dir, x['filename']) for x in self.entries]
+
+
+class PackageLock(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def _flock(self, shared=False):
+        # the lockfile itself is locked; it is rewritten in place
+        return common.FileLock(self.path, shared=shared)
+
+    def _read(self):
+        with open(self.path, 'r') as lock_fh:
+            contents = lock_fh.read()
+        if not contents.strip():
+            return {}
+        try:
+            return json.loads(contents)
+        except ValueError as err:
+            raise Error("Could not parse lockfile %r: %s" % (self.path, err))
+
+    def get(self, bundle, dver, basearch):
+        """Return the lock entry for a bundle/paramset, or None"""
+        if not os.path.exists(self.path):
+            return None
+        with self._flock(shared=True):
+            return self._read().get(bundle, {}).get("%s,%s" % (dver, basearch))
+
+    def update(self, bundle, dver, basearch, version, stage1_entries, stage2_entries):
+        with self._flock():
+            contents = self._read()
+            contents.setdefault(bundle, {})["%s,%s" % (dver, basearch)] = {
+                'version': version,
+                'stage1': stage1_entries,
+                'stage2': stage2_entries}
+            with open(self.path, 'w') as lock_fh:
+                json.dump(contents, lock_fh, indent=2, sort_keys=True)
+                lock_fh.write("\n")
+
+    def checkout(self, bundle, dver, basearch, rpm_store, dest_dir):
+        """Check out the locked RPMs for a bundle/paramset from rpm_store
+        into subdirs of dest_dir.  Returns the locked version and a dict of
+        stage name -> LockedStage.  Raises Error if anything is missing.
+
+        """
+        entry = self.get(bundle, dver, basearch)
+        if not entry:
+            raise Error("No entry for %s %s,%s in lockfile %r; make one with --lock" % (bundle, dver, basearch, self.path))
+        stages = {}
+        problems = []
+        for stage in STAGES:
+            rpm_dir = os.path.join(dest_dir, stage)
+            common.safe_makedirs(rpm_dir)
+            entries = entry.get(stage, [])
+            for missing in rpm_store.checkout([x['filename'] for x in entries], rpm_dir):
+                problems.append("%s is not in the RPM store" % missing)
+            for lock_entry in entries:
+                digest = rpm_store.digest(lock_entry['filename'])
+                if digest and digest != lock_entry['sha256']:
+                    problems.append("%s in the RPM store has sha256 %s, but %s is locked"
+                                    % (lock_entry['filename'], digest, lock_entry['sha256']))
+            stages[stage] = LockedStage(entries, rpm_dir)
+        if problems:
+            raise Error("Locked RPMs for %s %s,%s are not available:\n    %s" % (bundle, dver, basearch, "\n    ".join(problems)))
+        return entry.get('version'), stages
+
+
+def fill_rpm_store(yum, installroot, packages, rpm_store):
+    """Download the RPMs for packages (rpmdb.RpmPackage objects) that are not
+    in rpm_store into it
+
+    """
+    missing = [x.nvra for x in packages if not rpm_store.digest(x.nvra + '.rpm')]
+    if not missing:
+        return
+    rpm_dir = tempfile.mkdtemp(suffix='.lock')
+    try:
+        yum.download(installroot, missing, rpm_dir)
+    finally:
+        shutil.rmtree(rpm_dir, ignore_errors=True)
@@ -1,8 +1,11 @@
 from __future__ import print_function
 import glob
+import json
+import mmap
 import re
 import os
 import shutil
+import stat
 import sys
 import tempfile
 
@@ -13,11 +16,37 @@ SCRIPT_DIR = os.path.dirname(sys.argv[0])
 SCRIPT_PARENT_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, '..'))
 
 
+# Written by make-client-tarball: the files (other than the templates in osg/)
+# with the placeholder for OSG_LOCATION in them, and where it is in them
+RELOCATION_INDEX = 'osg/relocation-index.json'
+RELOCATION_THREADS = 8
+
 ANSI_CURSOR_TO_COLUMN_60 = "\x1b[999D\x1b[60C"
 ANSI_COLOR_BRIGHT_GREEN = "\x1b[32;1m"
 ANSI_COLOR_BRIGHT_RED = "\x1b[31;1m"
 ANSI_COLOR_NORMAL = "\x1b[0;m"
 
+def path_bytes(path):
+    """Return path as the bytes it is on the file system: a str already is
+    on Python 2, and os.fsencode() does it on Python 3
+
+    """
+    if isinstance(path, bytes):
+        return path
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+def native_path(path):
+    """Return path (from the relocation index; json gives unicode on Python
+    2) as a str, so it can be joined with the str paths we are given.  The
+    index is written from UTF-8 file names, whatever our locale is.
+
+    """
+    if not isinstance(path, str):
+        return path.encode('utf-8')
+    return path
+
 def print_nonl(*args):
     sys.stdout.write(" ".join(args))
     sys.stdout.flush()
@@ -53,7 +82,7 @@ def write_setup_from_templates(staging_dir, final_osg_location):
     abs_staging_dir = os.path.abspath(staging_dir)
 
     print("Creating environment setup files...")
-    for setup_file, mode in ('setup.sh', 0o644), ('setup.csh', 0o644), ('osgrun', 0o755):
+    for setup_file, mode in ('setup.sh', 0o644), ('setup.csh', 0o644), ('setup.env', 0o644), ('osgrun', 0o755):
         setup_in_file = setup_file + ".in"
         setup_in_path = os.path.join(abs_staging_dir, "osg", setup_in_file)
         setup_path = os.path.join(abs_staging_dir, setup_file)
@@ -126,7 +155,7 @@ def fix_osg_location_in_file(file_path, osg_location):
         file_mode = os.stat(file_path).st_mode
         file_fh = open(file_path, 'rb')
         for file_line in file_fh:
-            tmp_fh.write(re.sub(b'@@OSG_LOCATION@@', osg_location.encode(), file_line))
+            tmp_fh.write(re.sub(b'@@OSG_LOCATION@@', path_bytes(osg_location), file_line))
         tmp_fh.close()
         shutil.copy(file_path, file_path + ".bak")
         shutil.move(tmp_path, file_path)
@@ -182,6 +211,120 @@ def fix_osg_location_in_sysconfig_bestman2(staging_dir, final_osg_location):
         failure("Unable to fix BeSTMan2 sysconfig file for the following reason:\n%s" % err)
 
 
+def find_all(data, placeholder):
+    """Return the offsets of placeholder in data (a string or mmap)"""
+    offsets = []
+    offset = data.find(placeholder)
+    while offset != -1:
+        offsets.append(offset)
+        offset = data.find(placeholder, offset + len(placeholder))
+    return offsets
+
+
+def relocate_file(file_path, offsets, placeholder, replacement):
+    """Replace placeholder (bytes) at offsets in the file at file_path with
+    replacement (bytes).  The new contents are written to a temp file next
+    to it, which is then renamed over it.  If the placeholder is not at
+    offsets (the file was changed after the build), it is searched for.
+    Returns the number of placeholders replaced.
+
+    """
+    file_fh = tmp_fh = tmp_path = None
+    try:
+        file_fh = open(file_path, 'rb')
+        file_st = os.fstat(file_fh.fileno())
+        if file_st.st_size < len(placeholder):
+            return 0
+        mapped = mmap.mmap(file_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if not offsets or [x for x in offsets if mapped[x:x + len(placeholder)] != placeholder]:
+                offsets = find_all(mapped, placeholder)
+            if not offsets:
+                return 0
+            _tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.' + os.path.basename(file_path) + '.')
+            tmp_fh = os.fdopen(_tmp_fd, 'wb')
+            start = 0
+            for offset in offsets:
+                tmp_fh.write(mapped[start:offset])
+                tmp_fh.write(replacement)
+                start = offset + len(placeholder)
+            tmp_fh.write(mapped[start:])
+        finally:
+            mapped.close()
+        tmp_fh.close()
+        os.chmod(tmp_path, stat.S_IMODE(file_st.st_mode))
+        os.rename(tmp_path, file_path)
+        tmp_path = None
+        return len(offsets)
+    finally:
+        if tmp_fh:
+            tmp_fh.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if file_fh:
+            file_fh.close()
+
+
+def _map(func, args_list):
+    """map(func, args_list) on a pool of threads, or one at a time if
+    threads can't be used here
+
+    """
+    try:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(RELOCATION_THREADS, len(args_list))))
+    except (ImportError, OSError):
+        return [func(x) for x in args_list]
+    try:
+        return pool.map(func, args_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def relocate_from_index(staging_dir, final_osg_location):
+    """Replace the placeholder for OSG_LOCATION with final_osg_location in
+    every file listed in the relocation index under staging_dir, in
+    parallel.  Only the files in the index are read, and the placeholder
+    is checked for where the index says it is.  Returns False if there is
+    no usable index (e.g. the tarball was made by an older version), True
+    otherwise.
+
+    """
+    index_path = os.path.join(staging_dir, RELOCATION_INDEX)
+    if not os.path.exists(index_path):
+        return False
+    index_fh = None
+    try:
+        index_fh = open(index_path, 'r')
+        index = json.load(index_fh)
+        placeholder = index['placeholder'].encode()
+        files = index['files']
+    except (EnvironmentError, ValueError, KeyError) as err:
+        print("Unable to read %r (%s); updating known files only" % (index_path, err))
+        return False
+    finally:
+        if index_fh:
+            index_fh.close()
+
+    replacement = path_bytes(final_osg_location)
+    print_nonl("Updating OSG_LOCATION in %d file(s)" % len(files))
+
+    def _relocate(entry):
+        try:
+            relocate_file(os.path.join(staging_dir, native_path(entry['path'])), entry['offsets'], placeholder, replacement)
+            return None
+        except EnvironmentError as err:
+            return "%s: %s" % (entry['path'], err)
+
+    errors = [x for x in _map(_relocate, files) if x]
+    if errors:
+        failure("Unable to update the following file(s):\n" + "\n".join(errors))
+    else:
+        success()
+    return True
+
+
 def check_required_binaries():
     """Make sure we have all the prerequisites for running the tarball install.
 
@@ -268,8 +411,9 @@ def main(argv):
 
     write_setup_from_templates(staging_dir, final_osg_location)
     write_setup_local_files(staging_dir)
-    fix_osg_location_in_fetch_crl(staging_dir, final_osg_location)
-    fix_osg_location_in_sysconfig_bestman2(staging_dir, final_osg_location)
+    if not relocate_from_index(staging_dir, final_osg_location):
+        fix_osg_location_in_fetch_crl(staging_dir, final_osg_location)
+        fix_osg_location_in_sysconfig_bestman2(staging_dir, final_osg_location)
     return 0
 
 if __name__ == "__main__":
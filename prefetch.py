@@ -0,0 +1,91 @@
+"""
+Download the RPMs stage 2 will need while stage 1 is being made.
+
+Stage 1 spends most of its time running rpm scriptlets and walking the stage
+dir, and stage 2 then spends a good part of its time downloading.  A
+Prefetcher resolves the stage 2 packages in a background thread, as soon as
+the repos are known, and downloads the RPMs into the RPM store; by the time
+stage 2 installs, it finds them there.  Packages stage 1 will provide are
+left out.  A failed prefetch only costs time: stage 2 downloads whatever is
+not in the store as usual.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import buildreport
+import yumconf
+from common import Error, statusmsg, errormsg
+
+
+class Prefetcher(object):
+    def __init__(self, repofile, dver, basearch, packages, rpm_store, extra_repos=None, metadata_cache=None,
+                 stage1_packages=None, report=None):
+        """Prefetch the RPMs for packages (and their dependencies, less those
+        of stage1_packages) into rpm_store, recording the time taken as the
+        phase 'tarball.prefetch' in report (a buildreport.BuildReport; a
+        throwaway one if not given)
+
+        """
+        self.repofile = repofile
+        self.dver = dver
+        self.basearch = basearch
+        self.packages = packages
+        self.rpm_store = rpm_store
+        self.extra_repos = extra_repos
+        self.metadata_cache = metadata_cache
+        self.stage1_packages = stage1_packages or []
+        self.report = report or buildreport.BuildReport()
+        self.thread = None
+        self.rpm_count = 0
+        self.error = None
+
+    def start(self):
+        statusmsg("Prefetching the RPMs for %s in the background" % self.packages)
+        self.thread = threading.Thread(target=self._run, name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self):
+        """Wait for the prefetch to finish.  Returns True if it succeeded."""
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            if self.error:
+                errormsg("Prefetching RPMs failed; stage 2 will download them: %s" % self.error)
+            else:
+                statusmsg("Prefetched %d RPMs" % self.rpm_count)
+        return not self.error
+
+    def _run(self):
+        try:
+            with self.report.phase("tarball.prefetch", rusage=False):
+                self._prefetch()
+        except (Error, EnvironmentError, subprocess.CalledProcessError) as err:
+            self.error = err
+        except Exception as err:  # pylint: disable=W0703
+            # nothing else would see it die, and wait() must not report success
+            self.error = Error("unexpected %s: %s" % (type(err).__name__, err))
+
+    def _prefetch(self):
+        with yumconf.YumInstaller(self.repofile, self.dver, self.basearch, self.extra_repos,
+                                  metadata_cache=self.metadata_cache, rpm_store=self.rpm_store) as yum:
+            nevras = set(yum.resolve(self.packages))
+            if self.stage1_packages:
+                nevras.difference_update(yum.resolve(self.stage1_packages))
+            if not nevras:
+                return
+            empty_root = tempfile.mkdtemp(prefix='prefetch-root-')
+            rpm_dir = tempfile.mkdtemp(prefix='prefetch-rpms-')
+            try:
+                err = subprocess.call(["rpm", "--initdb", "--root", empty_root])
+                if err:
+                    raise Error("Could not initialize rpmdb into %r (rpm process returned %d)" % (empty_root, err))
+                self.rpm_count = len(yum.download(empty_root, sorted(nevras), rpm_dir))
+            finally:
+                shutil.rmtree(empty_root, ignore_errors=True)
+                shutil.rmtree(rpm_dir, ignore_errors=True)
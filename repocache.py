@@ -0,0 +1,82 @@
+"""
+A persistent cache of yum repo metadata that concurrent builds can share.
+
+Without it, every yum, yumdownloader and repoquery invocation in a build
+downloads and parses the repo metadata again.  Entries are keyed on a hash of
+the rendered repo config (see YumInstaller.metadata_cache_key()), so builds
+that use the same repos share an entry.  An entry is refreshed when it is
+older than the TTL, or when a refresh was asked for and it was fetched before
+the refresh was asked for.
+
+Each YumInstaller gets a private copy of the entry (made with reflinks, or
+a real copy; dnf rewrites some files in its cachedir in place, e.g.
+expired_repos.json, so hardlinks would let it change the shared entry) to use
+as its cachedir, so yum can download packages and write its own files there
+without interfering with other builds; the shared entry is only ever replaced
+as a whole, under the entry's lock.
+
+Each entry is a directory named after its key, containing:
+- cache/:    the yum cachedir
+- repos.txt: the repo config the key was computed from, for the curious
+- refreshed: a stamp file whose mtime is when the metadata was fetched
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import time
+
+from common import statusmsg, clone_tree
+import dircache
+
+
+DEFAULT_TTL_HOURS = 6
+DEFAULT_MAX_AGE_DAYS = dircache.DEFAULT_MAX_AGE_DAYS
+
+
+class RepoMetadataCache(dircache.DirCache):
+    description = "repo metadata cache"
+
+    def __init__(self, cache_dir, ttl_hours=DEFAULT_TTL_HOURS, refresh_before=0, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        super(RepoMetadataCache, self).__init__(cache_dir, max_age_days)
+        self.ttl = ttl_hours * 3600
+        # metadata fetched before this time is stale regardless of the TTL
+        self.refresh_before = refresh_before
+
+    def _stamp_path(self, key):
+        return os.path.join(self.entry_dir(key), 'refreshed')
+
+    def is_fresh(self, key):
+        try:
+            fetched = os.stat(self._stamp_path(key)).st_mtime
+        except OSError:
+            return False
+        return fetched >= self.refresh_before and time.time() - fetched < self.ttl
+
+    def _refresh(self, key, repos_text, makecache_func):
+        def _fill(tmp_dir):
+            makecache_func(os.path.join(tmp_dir, 'cache'))
+            with open(os.path.join(tmp_dir, 'repos.txt'), 'w') as repos_fh:
+                repos_fh.write(repos_text)
+            open(os.path.join(tmp_dir, 'refreshed'), 'w').close()
+        self._store_dir(key, _fill)
+
+    def checkout(self, key, repos_text, dest_dir, makecache_func):
+        """Copy the metadata for key into dest_dir, which will be used as the
+        cachedir of a single YumInstaller.  If the entry is missing or stale,
+        it is first refreshed by calling makecache_func with the dir to
+        download the metadata into.
+
+        """
+        with self.lock(key, shared=True):
+            if self.is_fresh(key):
+                clone_tree(os.path.join(self.entry_dir(key), 'cache'), dest_dir, hardlink=False)
+                self.touch(key)
+                return
+        with self.lock(key):
+            # another build may have refreshed it while we waited for the lock
+            if not self.is_fresh(key):
+                statusmsg("Refreshing repo metadata in %s %r" % (self.description, self.entry_dir(key)))
+                self._refresh(key, repos_text, makecache_func)
+            clone_tree(os.path.join(self.entry_dir(key), 'cache'), dest_dir, hardlink=False)
+            self.touch(key)
@@ -0,0 +1,351 @@
+"""
+Point the ELF files in a tarball at their libraries with $ORIGIN RUNPATHs.
+
+setup.sh puts six $OSG_LOCATION dirs on the LD_LIBRARY_PATH, so every
+process started from the tarball looks for each library it needs in each of
+those dirs in turn before finding it; on CVMFS every one of those failed
+lookups is a round trip.  With --rewrite-rpath, stage 2 reads the NEEDED
+entries of every ELF file that goes in the tarball, finds the libraries that
+are in the tarball's library dirs (in LD_LIBRARY_PATH order, as the dynamic
+loader would), and sets the RUNPATH of the file to those dirs relative to
+$ORIGIN (the dir of the file itself), ahead of the RUNPATH it already had.
+The file then finds its libraries without the LD_LIBRARY_PATH, wherever the
+tarball is unpacked.
+
+A library dir stays on the LD_LIBRARY_PATH of setup.sh and setup.csh only if
+it has a library that no ELF file in the tarball needs (which may be
+dlopen()ed by name), or one needed by a file whose RUNPATH could not be
+changed.  The lookups saved are measured by loading a few of the binaries
+with `ld.so --list` and LD_DEBUG=libs, with the full LD_LIBRARY_PATH before
+the rewrite and with the slimmed one after, and counting the files the
+loader tried.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import stat
+import struct
+import subprocess
+
+import treewalk
+from common import Error, errormsg, to_str
+
+
+# How many binaries to measure the library lookups of
+MAX_SAMPLES = 10
+# Where to pick them from, in order
+SAMPLE_DIRS = ['usr/bin', 'usr/sbin', 'bin', 'sbin']
+
+ELF_MAGIC = b'\x7fELF'
+ET_DYN = 3
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# struct formats of the ELF header (after e_ident), program header and
+# dynamic section entries, by ELF class
+_ELF_FORMATS = {
+    1: ('HHIIIIIHHH', 'IIIIIIII', 'iI'),
+    2: ('HHIQQQIHHH', 'IIQQQQQQ', 'qQ'),
+}
+
+
+class ElfInfo(object):
+    """What the dynamic loader reads from a dynamically linked ELF file"""
+    __slots__ = ('shared', 'interp', 'needed', 'soname', 'rpath', 'runpath')
+
+    def __init__(self, shared=False, interp=None, needed=None, soname=None, rpath=None, runpath=None):
+        self.shared = shared
+        self.interp = interp
+        self.needed = needed or []
+        self.soname = soname
+        self.rpath = rpath
+        self.runpath = runpath
+
+    @property
+    def search_path(self):
+        """The RUNPATH (or, without one, the RPATH) as a list of dirs"""
+        path = self.runpath if self.runpath is not None else self.rpath
+        return [x for x in (path or '').split(':') if x]
+
+
+def _read_cstring(fh, offset):
+    fh.seek(offset)
+    data = b''
+    while b'\0' not in data:
+        chunk = fh.read(256)
+        if not chunk:
+            break
+        data += chunk
+    return to_str(data.split(b'\0', 1)[0])
+
+
+def read_elf(path):
+    """Return an ElfInfo for path, or None if it is not a dynamically linked
+    ELF file (or can't be read as one)
+
+    """
+    try:
+        with open(path, 'rb') as fh:
+            ident = fh.read(16)
+            if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+                return None
+            elf_class, elf_data = bytearray(ident[4:6])
+            if elf_class not in _ELF_FORMATS or elf_data not in (1, 2):
+                return None
+            endian = '<' if elf_data == 1 else '>'
+            header_fmt, phdr_fmt, dyn_fmt = [endian + x for x in _ELF_FORMATS[elf_class]]
+
+            header = struct.unpack(header_fmt, fh.read(struct.calcsize(header_fmt)))
+            e_type, e_phoff, e_phentsize, e_phnum = header[0], header[4], header[8], header[9]
+            loads = []
+            dynamic = interp = None
+            fh.seek(e_phoff)
+            phdrs = fh.read(e_phentsize * e_phnum)
+            for i in range(e_phnum):
+                phdr = struct.unpack_from(phdr_fmt, phdrs, i * e_phentsize)
+                if elf_class == 1:
+                    p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[1], phdr[2], phdr[4]
+                else:
+                    p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[2], phdr[3], phdr[5]
+                if p_type == PT_LOAD:
+                    loads.append((p_vaddr, p_offset, p_filesz))
+                elif p_type == PT_DYNAMIC:
+                    dynamic = (p_offset, p_filesz)
+                elif p_type == PT_INTERP:
+                    interp = (p_offset, p_filesz)
+            if not dynamic:
+                return None
+
+            fh.seek(dynamic[0])
+            dyn_data = fh.read(dynamic[1])
+            dyn_size = struct.calcsize(dyn_fmt)
+            entries = []
+            for offset in range(0, len(dyn_data) - dyn_size + 1, dyn_size):
+                tag, value = struct.unpack_from(dyn_fmt, dyn_data, offset)
+                if tag == DT_NULL:
+                    break
+                entries.append((tag, value))
+            strtab = None
+            for tag, value in entries:
+                if tag == DT_STRTAB:
+                    # an address; find where it is in the file
+                    for p_vaddr, p_offset, p_filesz in loads:
+                        if p_vaddr <= value < p_vaddr + p_filesz:
+                            strtab = value - p_vaddr + p_offset
+            if strtab is None:
+                return None
+
+            info = ElfInfo(shared=(e_type == ET_DYN))
+            if interp:
+                fh.seek(interp[0])
+                info.interp = to_str(fh.read(interp[1]).rstrip(b'\0'))
+            for tag, value in entries:
+                if tag == DT_NEEDED:
+                    info.needed.append(_read_cstring(fh, strtab + value))
+                elif tag == DT_SONAME:
+                    info.soname = _read_cstring(fh, strtab + value)
+                elif tag == DT_RPATH:
+                    info.rpath = _read_cstring(fh, strtab + value)
+                elif tag == DT_RUNPATH:
+                    info.runpath = _read_cstring(fh, strtab + value)
+            return info
+    except (EnvironmentError, struct.error, ValueError):
+        return None
+
+
+def origin_path(elf_relpath, lib_dir):
+    """The $ORIGIN-relative form of lib_dir for the file at elf_relpath
+    (both relative to the stage dir)
+
+    """
+    relpath = os.path.relpath(lib_dir, os.path.dirname(elf_relpath))
+    return '$ORIGIN' if relpath == '.' else '$ORIGIN/' + relpath
+
+
+def _replace(path, make_tmp):
+    tmp_path = path + '.rpath-tmp'
+    make_tmp(tmp_path)
+    os.rename(tmp_path, path)
+
+
+def set_runpath(path, runpath, unshare=False):
+    """Set the RUNPATH of the ELF file at path with patchelf.  If unshare is
+    True, the file is copied first, so its other hard links (e.g. in a
+    cached snapshot) are left alone.
+
+    """
+    if unshare:
+        _replace(path, lambda tmp_path: shutil.copy2(path, tmp_path))
+    proc = subprocess.Popen(["patchelf", "--set-rpath", runpath, path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = to_str(proc.communicate()[0]).strip()
+    if proc.returncode:
+        raise Error("patchelf --set-rpath failed on %r: %s" % (path, output))
+
+
+def count_lookups(interp, binary_path, library_path):
+    """Return how many files the dynamic loader tries to open to load the
+    libraries of binary_path with library_path (a list of dirs) as the
+    LD_LIBRARY_PATH, or None if it can't be told.  The binary is not run:
+    the loader just lists its libraries.
+
+    """
+    env = {'PATH': '/usr/bin:/bin',
+           'LD_DEBUG': 'libs',
+           'LD_LIBRARY_PATH': ":".join(library_path)}
+    try:
+        proc = subprocess.Popen([interp, "--list", binary_path], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = to_str(proc.communicate()[1])
+    except EnvironmentError:
+        return None
+    return sum(1 for x in output.splitlines() if 'trying file=' in x)
+
+
+class RpathRewriter(object):
+    """Rewrite the RUNPATHs of the ELF files in a stage dir.  search_dir is
+    where to look for the files that go in the tarball (the stage dir, or the
+    layer stage 2 installed into); exclude_paths is the set of stage 1 files
+    in it and excludes are the patterns of files left out of the tarball.
+    The files are changed through stage_dir_abs.  library_dirs are the
+    LD_LIBRARY_PATH dirs (relative to the stage dir), in search order.
+
+    """
+    def __init__(self, stage_dir_abs, search_dir, library_dirs, excludes=None, exclude_paths=None):
+        self.stage_dir_abs = stage_dir_abs
+        self.search_dir = search_dir
+        self.library_dirs = list(library_dirs)
+        self.excludes = excludes or []
+        self.exclude_paths = exclude_paths or set()
+        self.elf_files = {}     # relpath -> ElfInfo
+        self.libraries = {}     # library name -> lib dir it is found in first
+        self.aliases = {}       # relpath of a library file -> names it is known by
+        self.inodes = {}        # relpath of an ELF file -> (st_dev, st_ino, st_nlink)
+        self.rewritten = []
+        self.failed = []
+        self.slim_library_dirs = None
+
+    def scan(self):
+        """Find the ELF files and the libraries in the library dirs"""
+        walk = treewalk.TreeWalk(self.search_dir, [treewalk.Stage1Visitor(self.exclude_paths),
+                                                   treewalk.ExcludeVisitor(self.excludes)])
+        library_dirs = set(self.library_dirs)
+        symlinks = []
+        for entry in walk.run():
+            in_library_dir = os.path.dirname(entry.relpath) in library_dirs
+            if stat.S_ISREG(entry.st.st_mode) and entry.st.st_size > 64:
+                info = read_elf(os.path.join(self.stage_dir_abs, entry.relpath))
+                if info:
+                    self.elf_files[entry.relpath] = info
+                    self.inodes[entry.relpath] = (entry.st.st_dev, entry.st.st_ino, entry.st.st_nlink)
+                    if in_library_dir and info.shared:
+                        self.aliases[entry.relpath] = set([os.path.basename(entry.relpath), info.soname])
+            elif stat.S_ISLNK(entry.st.st_mode) and in_library_dir:
+                symlinks.append(entry.relpath)
+        for relpath in symlinks:
+            target = os.path.normpath(os.path.join(os.path.dirname(relpath), os.readlink(os.path.join(self.search_dir, relpath))))
+            if target in self.aliases:
+                self.aliases[target].add(os.path.basename(relpath))
+        # the first dir on the LD_LIBRARY_PATH with a library is where the loader finds it
+        for library_dir in reversed(self.library_dirs):
+            for relpath, names in self.aliases.items():
+                if os.path.dirname(relpath) == library_dir:
+                    for name in names:
+                        if name:
+                            self.libraries[name] = library_dir
+
+    def new_runpath(self, relpath, info):
+        """Return the RUNPATH relpath (with ElfInfo info) should have, or
+        None if it needs no change
+
+        """
+        lib_dirs = set(self.libraries[x] for x in info.needed if x in self.libraries)
+        if not lib_dirs:
+            return None
+        path = [origin_path(relpath, x) for x in self.library_dirs if x in lib_dirs]
+        path += [x for x in info.search_path if x not in path]
+        if path == info.search_path and info.runpath is not None:
+            return None
+        return ":".join(path)
+
+    def rewrite(self):
+        """Set the RUNPATHs, and work out which library dirs still need to
+        be on the LD_LIBRARY_PATH (slim_library_dirs)
+
+        """
+        needed = set()
+        keep_dirs = set()
+        links_in_tree = {}
+        for dev, ino, _ in self.inodes.values():
+            links_in_tree[(dev, ino)] = links_in_tree.get((dev, ino), 0) + 1
+        done = {}   # (st_dev, st_ino) -> relpath of the rewritten file
+        for relpath in sorted(self.elf_files):
+            info = self.elf_files[relpath]
+            runpath = self.new_runpath(relpath, info)
+            if runpath:
+                path = os.path.join(self.stage_dir_abs, relpath)
+                dev, ino, nlink = self.inodes[relpath]
+                try:
+                    if (dev, ino) in done:
+                        # a hard link to a file already rewritten; if that was
+                        # unshared, link to the new copy
+                        done_path = os.path.join(self.stage_dir_abs, done[(dev, ino)])
+                        if os.lstat(done_path).st_ino != os.lstat(path).st_ino:
+                            _replace(path, lambda tmp_path: os.link(done_path, tmp_path))
+                    else:
+                        set_runpath(path, runpath, unshare=(nlink > links_in_tree[(dev, ino)]))
+                        done[(dev, ino)] = relpath
+                    self.rewritten.append(relpath)
+                except (Error, EnvironmentError) as err:
+                    self.failed.append(relpath)
+                    errormsg(str(err))
+                    keep_dirs.update(self.libraries[x] for x in info.needed if x in self.libraries)
+                    continue
+            needed.update(info.needed)
+        for relpath, names in self.aliases.items():
+            if not names & needed:
+                # nothing links to it, so it may be dlopen()ed by name
+                keep_dirs.add(os.path.dirname(relpath))
+        self.slim_library_dirs = [x for x in self.library_dirs if x in keep_dirs]
+
+    def samples(self):
+        """Pick the binaries to measure the lookups of: ones whose RUNPATH
+        is going to be rewritten, and whose loader is on this host
+
+        """
+        samples = []
+        for sample_dir in SAMPLE_DIRS:
+            for relpath in sorted(self.elf_files):
+                info = self.elf_files[relpath]
+                if (os.path.dirname(relpath) == sample_dir and info.interp and os.path.exists(info.interp)
+                        and self.new_runpath(relpath, info)):
+                    samples.append(relpath)
+        return samples[:MAX_SAMPLES]
+
+    def measure(self, samples, library_dirs):
+        """Return the total number of library lookups for samples with
+        library_dirs on the LD_LIBRARY_PATH, or None if it can't be measured
+
+        """
+        library_path = [os.path.join(self.stage_dir_abs, x) for x in library_dirs]
+        total = 0
+        for relpath in samples:
+            count = count_lookups(self.elf_files[relpath].interp, os.path.join(self.stage_dir_abs, relpath), library_path)
+            if count is None:
+                return None
+            total += count
+        return total
+
+    def stats(self):
+        return {'elf_files': len(self.elf_files),
+                'rewritten': len(self.rewritten),
+                'failed': self.failed,
+                'library_dirs': self.library_dirs,
+                'slim_library_dirs': self.slim_library_dirs}
@@ -0,0 +1,95 @@
+"""
+An in-memory snapshot of the RPM database in a stage dir.
+
+Starting rpm opens the whole rpmdb, so asking it about one package at a time
+is slow.  RpmDbSnapshot loads the names, versions, sizes and files of every
+installed package with a single query, and answers questions about them from
+memory.  Take a new snapshot after installing or erasing packages.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import subprocess
+
+from common import Error, to_str
+
+
+_PKG_MARKER = '@@PKG@@'
+_QUERYFORMAT = (_PKG_MARKER + '\t%{NAME}\t%{EPOCHNUM}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\t%{NVRA}\t%{SIZE}\n'
+                '[%{FILENAMES}\t%{FILESIZES}\n]')
+
+
+class RpmPackage(object):
+    __slots__ = ('name', 'epoch', 'version', 'release', 'arch', 'nvra', 'size')
+
+    def __init__(self, name, epoch, version, release, arch, nvra, size):
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.nvra = nvra
+        self.size = size
+
+    @property
+    def nevra(self):
+        return "%s-%s:%s-%s.%s" % (self.name, self.epoch, self.version, self.release, self.arch)
+
+    def specs(self):
+        """The ways this package can be named on an 'rpm -q' command line"""
+        nv = "%s-%s" % (self.name, self.version)
+        nvr = "%s-%s" % (nv, self.release)
+        return [self.name, nv, nvr, self.nvra, self.nevra]
+
+
+class RpmDbSnapshot(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.packages = []
+        self.by_spec = {}
+        self.file_owners = {}
+        self.file_sizes = {}
+        self._load()
+
+    def _load(self):
+        cmd = ["rpm", "--root", self.root, "-qa", "--queryformat", _QUERYFORMAT]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = to_str(proc.communicate()[0])
+        if proc.returncode != 0:
+            raise Error("Could not query rpmdb in %r (rpm process returned %d)" % (self.root, proc.returncode))
+
+        package = None
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if fields[0] == _PKG_MARKER:
+                name, epoch, version, release, arch, nvra, size = fields[1:8]
+                package = RpmPackage(name, epoch, version, release, arch, nvra, int(size or 0))
+                self.packages.append(package)
+                for spec in package.specs():
+                    self.by_spec.setdefault(spec, []).append(package)
+            elif package is not None and len(fields) == 2 and fields[0] != '(none)':
+                path, size = fields
+                self.file_owners.setdefault(path, []).append(package)
+                try:
+                    self.file_sizes[path] = int(size)
+                except ValueError:
+                    pass
+
+    def installed(self, spec):
+        """Return True if a package matching spec (a name, name-version,
+        NVR, NVRA or NEVRA) is installed, like 'rpm -q spec' would.
+
+        """
+        return spec in self.by_spec
+
+    def owners(self, path):
+        """Return the packages that own path (an absolute path in the root)"""
+        return self.file_owners.get(path, [])
+
+    def nvras(self):
+        """Return the NVRAs of all packages, like 'rpm -qa' would"""
+        return [x.nvra for x in self.packages]
+
+    def nevras(self):
+        return [x.nevra for x in self.packages]
@@ -0,0 +1,168 @@
+"""
+A persistent local store of downloaded RPMs.
+
+RPMs are stored once, named after the sha256 of their contents, and indexed by
+their file name (NAME-VERSION-RELEASE.ARCH.rpm, as found in the repos).
+YumInstaller asks yumdownloader which RPMs it would download, takes the ones it
+can from the store, downloads the rest and adds them to the store afterward.
+Since different repos can have different builds under the same file name,
+YumInstaller looks RPMs up by the sha256 the repo metadata has for them (their
+pkgid), which is also the name of their blob; the file name index is only used
+when that is not known.
+The store counts hits and misses, and evicts the least recently used RPMs when
+it gets bigger than its maximum size.
+
+Layout:
+- blobs/XX/<sha256>: the RPMs, where XX is the first two digits of the hash
+- index/<file name>: the sha256 of the RPM with that file name
+- lock:              held exclusively while adding or evicting RPMs
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+
+import common
+from common import statusmsg, sha256_file
+
+
+DEFAULT_MAX_SIZE = "20G"
+
+
+class RpmStore(object):
+    def __init__(self, store_dir, max_size=DEFAULT_MAX_SIZE):
+        self.store_dir = os.path.abspath(store_dir)
+        self.max_size = common.parse_size(max_size) if max_size else 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.added_bytes = 0
+
+    def _lock(self, shared=False):
+        return common.FileLock(os.path.join(self.store_dir, 'lock'), shared=shared)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.store_dir, 'blobs', digest[:2], digest)
+
+    def _index_path(self, filename):
+        return os.path.join(self.store_dir, 'index', filename)
+
+    def _lookup(self, filename):
+        """Return the blob path for filename, or None if it's not in the store"""
+        try:
+            with open(self._index_path(filename)) as index_fh:
+                digest = index_fh.read().strip()
+        except EnvironmentError:
+            return None
+        blob_path = self._blob_path(digest)
+        if not digest or not os.path.isfile(blob_path):
+            return None
+        return blob_path
+
+    def digest(self, filename):
+        """Return the sha256 of the RPM with file name filename, or None if
+        it's not in the store
+
+        """
+        blob_path = self._lookup(filename)
+        return os.path.basename(blob_path) if blob_path else None
+
+    def checkout(self, filenames, dest_dir, checksums=None):
+        """Put the RPMs named in filenames that are in the store into dest_dir,
+        under those names.  Returns the names of the ones that are not.
+        If checksums (a dict of the sha256 of each RPM by file name) is given,
+        an RPM is only taken from the store if it has that sha256; RPMs with
+        no checksum in it count as missing.
+
+        """
+        missing = []
+        with self._lock(shared=True):
+            for filename in filenames:
+                if checksums is not None:
+                    blob_path = self._blob_path(checksums[filename]) if checksums.get(filename) else None
+                    if blob_path and not os.path.isfile(blob_path):
+                        blob_path = None
+                else:
+                    blob_path = self._lookup(filename)
+                if not blob_path:
+                    missing.append(filename)
+                    continue
+                _link_or_copy(blob_path, os.path.join(dest_dir, filename))
+                os.utime(blob_path, None)
+                self.hits += 1
+                self.hit_bytes += os.stat(blob_path).st_size
+        self.misses += len(missing)
+        return missing
+
+    def add(self, rpm_paths):
+        """Add the RPM files in rpm_paths to the store"""
+        with self._lock():
+            for rpm_path in rpm_paths:
+                digest = sha256_file(rpm_path)
+                blob_path = self._blob_path(digest)
+                if not os.path.isfile(blob_path):
+                    common.safe_makedirs(os.path.dirname(blob_path))
+                    _atomic_copy(rpm_path, blob_path)
+                    self.added_bytes += os.stat(blob_path).st_size
+                index_path = self._index_path(os.path.basename(rpm_path))
+                common.safe_makedirs(os.path.dirname(index_path))
+                tmp_path = index_path + '.tmp.%d' % os.getpid()
+                with open(tmp_path, 'w') as index_fh:
+                    index_fh.write(digest + "\n")
+                os.rename(tmp_path, index_path)
+
+    def evict(self):
+        """Remove the least recently used RPMs until the store is no bigger
+        than max_size, along with the index entries that refer to them.
+
+        """
+        if not self.max_size:
+            return
+        with self._lock():
+            blobs = []
+            total_size = 0
+            for root, _, files in os.walk(os.path.join(self.store_dir, 'blobs')):
+                for name in files:
+                    st = os.stat(os.path.join(root, name))
+                    blobs.append((st.st_mtime, os.path.join(root, name), st.st_size))
+                    total_size += st.st_size
+            if total_size <= self.max_size:
+                return
+            removed = 0
+            for _, blob_path, size in sorted(blobs):
+                if total_size <= self.max_size:
+                    break
+                os.unlink(blob_path)
+                total_size -= size
+                removed += 1
+            statusmsg("Evicted %d RPMs from the RPM store %r (store too big)" % (removed, self.store_dir))
+            index_dir = os.path.join(self.store_dir, 'index')
+            for filename in os.listdir(index_dir):
+                if not self._lookup(filename):
+                    os.unlink(os.path.join(index_dir, filename))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'hit_bytes': self.hit_bytes,
+                'added_bytes': self.added_bytes}
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def _atomic_copy(src, dest):
+    tmp_path = dest + '.tmp.%d' % os.getpid()
+    try:
+        shutil.copy2(src, tmp_path)
+        os.rename(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
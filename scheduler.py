@@ -0,0 +1,94 @@
+"""
+Limits on how many builds can be in each stage at once.
+
+With --pipeline, the bundle/paramset builds of a run all start together (up
+to --jobs at a time), but each of the stages below only lets a few builds in
+at a time: while one build compresses its tarball, the next can install its
+packages, instead of either waiting for the other to finish or competing
+with it for the network and the CPUs.
+
+- stage1:  making the stage 1 dir (installing, or cloning from the cache)
+- install: installing the stage 2 packages
+- fixups:  patching and fixing the stage 2 dir
+- archive: writing and compressing the tarball
+
+The builds run in separate processes, so the slots for each stage are lock
+files in a directory shared by all of them; a build is in a stage while it
+holds a flock() on one of that stage's slot files.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import contextlib
+import errno
+import fcntl
+import os
+import time
+
+from common import safe_makedirs
+
+
+STAGES = ['stage1', 'install', 'fixups', 'archive']
+DEFAULT_STAGE_JOBS = ",".join("%s=1" % x for x in STAGES)
+
+# How often to check for a free slot
+POLL_INTERVAL = 0.5
+
+
+def parse_stage_jobs(stage_jobs):
+    """Parse 'STAGE=N[,STAGE=N...]' into a dict; stages not given get 1.
+    Raises ValueError if it can't be parsed.
+
+    """
+    limits = dict((x, 1) for x in STAGES)
+    for item in stage_jobs.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        stage, _, count = item.partition('=')
+        if stage not in STAGES:
+            raise ValueError("unknown stage %r; must be one of %s" % (stage, ", ".join(STAGES)))
+        try:
+            limits[stage] = int(count)
+        except ValueError:
+            raise ValueError("bad number of jobs %r for stage %s" % (count, stage))
+        if limits[stage] < 1:
+            raise ValueError("number of jobs for stage %s must be at least 1" % stage)
+    return limits
+
+
+class StageSlots(object):
+    def __init__(self, slot_dir, limits):
+        self.slot_dir = os.path.abspath(slot_dir)
+        self.limits = limits
+
+    def _try_slots(self, stage):
+        """Return an open file with a flock() on a free slot for stage, or None"""
+        for i in range(self.limits.get(stage, 1)):
+            slot_fh = open(os.path.join(self.slot_dir, "%s.%d.lock" % (stage, i)), 'a')
+            try:
+                fcntl.flock(slot_fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_fh
+            except IOError as err:
+                slot_fh.close()
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return None
+
+    @contextlib.contextmanager
+    def slot(self, stage):
+        """Wait for a free slot for stage and hold it for the duration of the
+        with block.  Yields the time spent waiting, in seconds.
+
+        """
+        safe_makedirs(self.slot_dir)
+        start = time.time()
+        slot_fh = self._try_slots(stage)
+        while not slot_fh:
+            time.sleep(POLL_INTERVAL)
+            slot_fh = self._try_slots(stage)
+        try:
+            yield time.time() - start
+        finally:
+            fcntl.flock(slot_fh.fileno(), fcntl.LOCK_UN)
+            slot_fh.close()
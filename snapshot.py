@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Make a frozen snapshot of the repos a bundle is built from.
+
+The repo files in repos/ point at live repos, so two builds of the same
+version can get different packages, and every build depends on the speed of
+the network.  This resolves the full set of packages a bundle/paramset can
+need (stage 1 and stage 2, with all their dependencies), copies the RPMs into
+a local repo with its own metadata, and writes a repo file for it.  Passing
+that repo file to make-client-tarball with --repofile builds from the
+snapshot instead of the live repos, at local disk speed, and gets the same
+packages every time.
+
+For each bundle/paramset, OUTPUT_DIR gets:
+- <bundle>-<dver>-<basearch>/:       the repo (RPMs and repodata)
+- <bundle>-<dver>-<basearch>.repo:   the repo file to build from
+- <bundle>-<dver>-<basearch>.json:   the NEVRAs and checksums in the snapshot
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+from optparse import OptionParser
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from shutil import which as find_executable
+except ImportError:  # Python 2:
+    from distutils.spawn import find_executable
+
+# make sure we can find our imports
+if __name__ == "__main__" and __package__ is None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import make_client_tarball
+import repocache
+import rpmstore
+import stage1
+import yumconf
+from common import VALID_BASEARCHES, VALID_DVERS, DEFAULT_BASEARCH, Error, statusmsg, errormsg, safe_makedirs, sha256_file, to_str
+
+
+SNAPSHOT_REPO_NAME = 'tarball-snapshot'
+
+
+def _nevra_to_filename(nevra):
+    """name-epoch:version-release.arch -> name-version-release.arch.rpm"""
+    name_epoch, _, version_release_arch = nevra.partition(':')
+    name = name_epoch.rsplit('-', 1)[0]
+    return "%s-%s.rpm" % (name, version_release_arch)
+
+
+def get_snapshot_packages(bundlecfg, bundle, dver, basearch, prog_dir):
+    """Return every package name a build of bundle for dver,basearch asks
+    for, across both stages.  Groups are expanded later by resolve().
+
+    """
+    stage1_pkglist_file = os.path.join(prog_dir, bundlecfg.get(bundle, 'stage1file') % {'basearch': basearch, 'dver': dver})
+    packages = list(stage1.FORCE_INSTALL_PACKAGES)
+    packages += stage1.get_stage1_packages(stage1_pkglist_file)
+    packages += bundlecfg.get(bundle, 'packages').split()
+    if bundlecfg.has_option(bundle, 'versionrpm'):
+        packages.append(bundlecfg.get(bundle, 'versionrpm'))
+    return packages
+
+
+def download_closure(yum, packages, rpm_dir):
+    """Download packages and everything they could require into rpm_dir.
+    Returns the paths of the RPMs.
+
+    """
+    nevras = yum.resolve(packages)
+    empty_root = tempfile.mkdtemp(prefix='snapshot-root-')
+    try:
+        err = subprocess.call(["rpm", "--initdb", "--root", empty_root])
+        if err:
+            raise Error("Could not initialize rpmdb into %r (rpm process returned %d)" % (empty_root, err))
+        # What yum would pick when installing the packages from scratch...
+        names = [x for x in packages if not x.startswith('@')]
+        yum.download(empty_root, names, rpm_dir, resolve=True)
+        # ...plus the packages the groups expand to and the alternative
+        # providers of the dependencies, which the repoquery found.
+        have = set(os.listdir(rpm_dir))
+        extra = [x for x in nevras if _nevra_to_filename(x) not in have]
+        if extra:
+            yum.download(empty_root, extra, rpm_dir)
+    finally:
+        shutil.rmtree(empty_root, ignore_errors=True)
+    return sorted(os.path.join(rpm_dir, x) for x in os.listdir(rpm_dir) if x.endswith('.rpm'))
+
+
+def createrepo(repo_dir):
+    createrepo_cmd = find_executable('createrepo_c') or find_executable('createrepo')
+    if not createrepo_cmd:
+        raise Error("Required executable 'createrepo_c' or 'createrepo' not found")
+    err = subprocess.call([createrepo_cmd, "--quiet", "--database", repo_dir])
+    if err:
+        raise Error("Could not create repo metadata in %r (createrepo process returned %d)" % (repo_dir, err))
+
+
+def write_snapshot_repofile(repofile_path, repo_dir, description):
+    with open(repofile_path, 'w') as repofile_fh:
+        repofile_fh.write("# Snapshot of %s\n" % description)
+        repofile_fh.write("[%s]\n" % SNAPSHOT_REPO_NAME)
+        repofile_fh.write("name = %s\n" % description)
+        repofile_fh.write("baseurl = file://%s\n" % os.path.abspath(repo_dir))
+        repofile_fh.write("gpgcheck = 0\n")
+        repofile_fh.write("enabled = 1\n")
+
+
+def read_rpm_nevra(rpm_path):
+    proc = subprocess.Popen(["rpm", "-qp", "--nosignature", "--queryformat", yumconf.NEVRA_QUERYFORMAT, rpm_path],
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise Error("Could not read %r (rpm process returned %d)" % (rpm_path, proc.returncode))
+    return to_str(output).strip()
+
+
+def make_snapshot(bundlecfg, bundle, dver, basearch, prog_dir, output_dir, extra_repos=None, repo_cache=None, rpm_store=None):
+    """Make the snapshot repo and repo file for one bundle/paramset.
+    Returns the path to the repo file.
+
+    """
+    name = "%s-%s-%s" % (bundle, dver, basearch)
+    repo_dir = os.path.join(output_dir, name)
+    repofile = make_client_tarball.get_repofile(prog_dir, bundlecfg, bundle, basearch=basearch, dver=dver)
+    packages = get_snapshot_packages(bundlecfg, bundle, dver, basearch, prog_dir)
+
+    tmp_repo_dir = repo_dir + '.tmp.%d' % os.getpid()
+    shutil.rmtree(tmp_repo_dir, ignore_errors=True)
+    try:
+        packages_dir = os.path.join(tmp_repo_dir, 'Packages')
+        safe_makedirs(packages_dir)
+        statusmsg("Downloading the packages for %s from %s" % (name, repofile))
+        with yumconf.YumInstaller(repofile, dver, basearch, extra_repos, metadata_cache=repo_cache, rpm_store=rpm_store) as yum:
+            try:
+                rpms = download_closure(yum, packages, packages_dir)
+            except subprocess.CalledProcessError as err:
+                raise Error("Could not resolve packages for %s: %s" % (name, err))
+        statusmsg("Creating repo metadata for %d packages" % len(rpms))
+        createrepo(tmp_repo_dir)
+        contents = dict((read_rpm_nevra(x), sha256_file(x)) for x in rpms)
+
+        if os.path.isdir(repo_dir):
+            shutil.rmtree(repo_dir)
+        os.rename(tmp_repo_dir, repo_dir)
+    finally:
+        shutil.rmtree(tmp_repo_dir, ignore_errors=True)
+
+    with open(os.path.join(output_dir, name + '.json'), 'w') as manifest_fh:
+        json.dump({'bundle': bundle,
+                   'dver': dver,
+                   'basearch': basearch,
+                   'repofile': os.path.relpath(repofile, prog_dir),
+                   'extra_repos': extra_repos or [],
+                   'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'packages': contents},
+                  manifest_fh, indent=2, sort_keys=True)
+    snapshot_repofile = os.path.join(output_dir, name + '.repo')
+    write_snapshot_repofile(snapshot_repofile, repo_dir, "%s for %s,%s" % (bundle, dver, basearch))
+    return snapshot_repofile
+
+
+def parse_cmdline_args(argv):
+    parser = OptionParser("""
+    %prog [options] --bundle=<bundle> --dver=<dver> [--basearch=<basearch>] <OUTPUT DIR>
+or: %prog [options] --bundle=<bundle> --all <OUTPUT DIR>
+""")
+    parser.add_option("--bundle", dest="bundles", action="append", default=[], help="Names of bundles (from {0}) to make snapshots for".format(make_client_tarball.BUNDLES_FILE))
+    parser.add_option("-d", "--dver", help="Make snapshots for this distro version. Must be one of (" + ", ".join(VALID_DVERS) + ")")
+    parser.add_option("-b", "--basearch", help="Make snapshots for this base architecture. Must be one of (" + ", ".join(VALID_BASEARCHES) + "). Default is %default.", default=DEFAULT_BASEARCH)
+    parser.add_option("-a", "--all", default=False, action="store_true", help="Make snapshots for all dver,basearch combinations of the bundles.")
+    parser.add_option("--prerelease", default=True, action="store_true", help="Take packages from the prerelease repository (the default)")
+    parser.add_option("--no-prerelease", "--noprerelease", dest="prerelease", action="store_false", help="Do not take packages from the prerelease repository")
+    parser.add_option("--extra-repos", dest="extra_repos", action="append", help="Extra yum repos to use")
+    parser.add_option("--repo-cache", default=None, help="Directory of the repo metadata cache to use (see make-client-tarball)")
+    parser.add_option("--rpm-store", default=None, help="Directory of the RPM store to take RPMs from and add them to (see make-client-tarball)")
+
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("An output directory must be specified")
+    if not options.bundles:
+        parser.error("--bundle must be specified")
+    if options.dver and options.dver not in VALID_DVERS:
+        parser.error("--dver must be in " + ", ".join(VALID_DVERS))
+    if options.basearch and options.basearch not in VALID_BASEARCHES:
+        parser.error("--basearch must be in " + ", ".join(VALID_BASEARCHES))
+    if not options.all and not options.dver:
+        parser.error("Either --all or --dver must be specified.")
+    if options.prerelease:
+        options.extra_repos = options.extra_repos or []
+        options.extra_repos.append('osg-prerelease-for-tarball')
+    return options, args[0]
+
+
+def main(argv):
+    prog_dir = os.path.dirname(os.path.abspath(argv[0]))
+    options, output_dir = parse_cmdline_args(argv)
+    output_dir = os.path.abspath(output_dir)
+
+    if os.getuid() != 0:
+        errormsg("Error: You need to be root to run this script")
+        return 1
+
+    bundlecfg = make_client_tarball.read_bundlecfg(prog_dir)
+    repo_cache = repocache.RepoMetadataCache(options.repo_cache) if options.repo_cache else None
+    rpm_store = rpmstore.RpmStore(options.rpm_store) if options.rpm_store else None
+
+    safe_makedirs(output_dir)
+    failed = []
+    for bundle in options.bundles:
+        if options.all:
+            paramsets = [tuple(x.split(',')) for x in bundlecfg.get(bundle, 'paramsets').split()]
+        else:
+            paramsets = [(options.dver, options.basearch)]
+        for dver, basearch in paramsets:
+            try:
+                repofile = make_snapshot(bundlecfg, bundle, dver, basearch, prog_dir, output_dir,
+                                         extra_repos=options.extra_repos, repo_cache=repo_cache, rpm_store=rpm_store)
+                statusmsg("Snapshot repo file for %s %s,%s written to %r" % (bundle, dver, basearch, repofile))
+            except (Error, EnvironmentError) as err:
+                errormsg("Could not make snapshot for %s %s,%s: %s" % (bundle, dver, basearch, err))
+                failed.append((bundle, dver, basearch))
+
+    if failed:
+        return 1
+    statusmsg("To build from the snapshots, pass")
+    print("    --repofile '%s'" % os.path.join(output_dir, "%(bundle)s-%(dver)s-%(basearch)s.repo"))
+    statusmsg("to make-client-tarball")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
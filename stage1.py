@@ -12,11 +12,11 @@ tarballs, but will not be included in the tarballs.
 
 from __future__ import absolute_import
 from __future__ import print_function
+import contextlib
 import glob
 import grp
 import os
 from os.path import join as opj
-import pipes
 import shlex
 import shutil
 import stat
@@ -24,6 +24,10 @@ import subprocess
 import sys
 
 
+import archive
+import buildreport
+import fileindex
+import rpmdb
 import yumconf
 import common
 from common import statusmsg, errormsg, safe_makedirs, Error
@@ -81,6 +85,15 @@ def get_stage1_packages(pkglist_file):
         return list(filter(None, shlex.split(filehandle.read(), comments=True)))
 
 
+# Packages that _install_stage1_packages() installs before the ones in the
+# stage 1 package list
+FORCE_INSTALL_PACKAGES = ['filesystem', 'bash', 'grep', 'info', 'findutils', 'libacl', 'libattr', 'coreutils']
+
+
+def get_includes_file(pkglist_file):
+    return pkglist_file.replace('.lst','-include.lst')
+
+
 def _install_stage1_packages(yum, dver, stage1_root, stage1_packages):
     def yuminstall(packages):
         yum.install(installroot=stage1_root, packages=packages)
@@ -89,7 +102,9 @@ def _install_stage1_packages(yum, dver, stage1_root, stage1_packages):
     def yumforceerase(packages):
         yum.force_erase(installroot=stage1_root, packages=packages)
 
-    yum.yum_clean()
+    if not yum.metadata_cache:
+        # the metadata cache takes care of refreshing its metadata
+        yum.yum_clean()
     yumforceinstall(['filesystem'], noscripts=True)
     yumforceinstall(['bash', 'grep', 'info', 'findutils', 'libacl', 'libattr'], noscripts=True, resolve=True)
     yumforceinstall(['coreutils'], noscripts=True)
@@ -105,62 +120,197 @@ def _install_stage1_packages(yum, dver, stage1_root, stage1_packages):
         yumforceerase(["libpsl"])
 
 
-def install_stage1_packages(stage1_root, repofile, dver, basearch, pkglist_file):
+def install_stage1_packages(stage1_root, repofile, dver, basearch, pkglist_file, repo_cache=None, rpm_store=None):
     stage1_packages = get_stage1_packages(pkglist_file)
     with common.MountProcFS(stage1_root):
-        with yumconf.YumInstaller(repofile, dver, basearch) as yum:
+        with yumconf.YumInstaller(repofile, dver, basearch, metadata_cache=repo_cache, rpm_store=rpm_store) as yum:
             _install_stage1_packages(yum, dver, stage1_root, stage1_packages)
 
 
+def install_locked_stage1_packages(stage1_root, locked):
+    """Install the RPMs from locked (a pkglock.LockedStage).  As when
+    resolving, FORCE_INSTALL_PACKAGES go in first without running their
+    scripts, since there is nothing in the chroot to run them with yet;
+    the rest go in in one transaction after that.  Dependencies are not
+    checked since some stage 1 packages are installed without theirs.
+
+    """
+    force_rpms = []
+    other_rpms = []
+    for nevra, rpm_path in zip(locked.nevras(), locked.rpm_paths()):
+        if nevra.rsplit('-', 2)[0] in FORCE_INSTALL_PACKAGES:
+            force_rpms.append(rpm_path)
+        else:
+            other_rpms.append(rpm_path)
+    with common.MountProcFS(stage1_root):
+        if force_rpms:
+            yumconf.rpm_install(stage1_root, force_rpms, nodeps=True, noscripts=True)
+        if other_rpms:
+            yumconf.rpm_install(stage1_root, other_rpms, nodeps=True)
+    subprocess.call(['touch', opj(stage1_root, 'etc/fstab')])
+
+
 def make_stage1_filelist(stage_dir, pkglist_file):
-    oldwd = os.getcwd()
-    includes_file = pkglist_file.replace('.lst','-include.lst')
-    if not os.path.exists(includes_file):
-        includes_file = '/dev/null'
-    try:
-        os.chdir(stage_dir)
-        os.system('find . -not -type d | sort > stage1_filelist_tmp')
-        os.system('comm -2 -3 stage1_filelist_tmp ' + includes_file + ' > stage1_filelist')
+    """Write the index (see the fileindex module) of the files in stage_dir
+    that stage 2 leaves out of the tarball: everything except directories
+    and the paths in the stage 1 include list
 
-    finally:
-        os.chdir(oldwd)
+    """
+    includes_file = get_includes_file(pkglist_file)
+    include_paths = set()
+    if os.path.exists(includes_file):
+        include_paths = archive.read_stage1_filelist(includes_file)
+    fileindex.make_index(stage_dir, opj(stage_dir, fileindex.INDEX_FILE), include_paths)
 
 
 def make_stage1_rpmlist(stage_dir, stage1_root):
-    oldwd = os.getcwd()
-    try:
-        os.chdir(stage_dir)
-        os.system('rpm -qa --root=' + pipes.quote(stage1_root) + ' > stage1_rpmlist')
-    finally:
-        os.chdir(oldwd)
+    rpmdb_snapshot = rpmdb.RpmDbSnapshot(stage1_root)
+    with open(os.path.join(stage_dir, 'stage1_rpmlist'), 'w') as rpmlist_fh:
+        rpmlist_fh.write("".join(x + "\n" for x in sorted(rpmdb_snapshot.nvras())))
 
 
-def make_stage1_dir(stage_dir, repofile, dver, basearch, pkglist_file):
-    def _statusmsg(msg):
-        statusmsg("[%r,%r]: %s" % (dver, basearch, msg))
+def get_stage1_cache_key(cache, repofile, dver, basearch, pkglist_file, repo_cache=None):
+    """Resolve the stage 1 packages and return the cache key and the resolved
+    NEVRAs.
 
-    _statusmsg("Using %r for stage 1 directory" % stage_dir)
-    stage1_root = os.path.realpath(stage_dir)
-    try:
-        _statusmsg("Making stage 1 root directory")
+    """
+    stage1_packages = get_stage1_packages(pkglist_file)
+    with yumconf.YumInstaller(repofile, dver, basearch, metadata_cache=repo_cache) as yum:
+        try:
+            nevras = yum.resolve(FORCE_INSTALL_PACKAGES + stage1_packages)
+        except (subprocess.CalledProcessError, IndexError) as err:
+            raise Error("Could not resolve stage 1 packages: %s" % err)
+    key = cache.key(dver, basearch, pkglist_file, get_includes_file(pkglist_file), nevras)
+    return key, nevras
+
+
+def _make_stage1_dir(stage_dir, stage1_root, repofile, dver, basearch, pkglist_file, repo_cache, rpm_store, locked, _statusmsg, report):
+    _statusmsg("Making stage 1 root directory")
+    with report.phase("stage1.make_root_dir"):
         make_stage1_root_dir(stage1_root)
 
-        _statusmsg("Initializing stage 1 rpm db")
+    _statusmsg("Initializing stage 1 rpm db")
+    with report.phase("stage1.init_rpmdb"):
         init_stage1_rpmdb(stage1_root)
 
-        _statusmsg("Initializing /dev in root dir")
+    _statusmsg("Initializing /dev in root dir")
+    with report.phase("stage1.init_devices"):
         init_stage1_devices(stage1_root)
 
+    if locked:
+        _statusmsg("Installing %d locked stage 1 packages" % len(locked.entries))
+        with report.phase("stage1.install_packages"):
+            install_locked_stage1_packages(stage1_root, locked)
+    else:
         _statusmsg("Installing stage 1 packages from " + pkglist_file)
-        install_stage1_packages(stage1_root, repofile, dver, basearch, pkglist_file)
+        with report.phase("stage1.install_packages"):
+            install_stage1_packages(stage1_root, repofile, dver, basearch, pkglist_file, repo_cache, rpm_store)
 
-        _statusmsg("Making file list")
+    _statusmsg("Making file list")
+    with report.phase("stage1.make_filelist"):
         make_stage1_filelist(stage_dir, pkglist_file)
 
-        _statusmsg("Making rpm list")
+    _statusmsg("Making rpm list")
+    with report.phase("stage1.make_rpmlist"):
         make_stage1_rpmlist(stage_dir, stage1_root)
 
-        return True
-    except Error as err:
-        errormsg(str(err))
-        return False
+
+def _get_cache_key(cache, repofile, dver, basearch, pkglist_file, repo_cache, locked, _statusmsg, report):
+    if locked:
+        nevras = sorted(locked.nevras())
+        return cache.key(dver, basearch, pkglist_file, get_includes_file(pkglist_file), nevras), nevras
+    if not cache.resolves_packages:
+        return cache.input_key(dver, basearch, pkglist_file, get_includes_file(pkglist_file), repofile), None
+    _statusmsg("Resolving stage 1 packages for the cache key")
+    with report.phase("stage1.resolve_cache_key"):
+        return get_stage1_cache_key(cache, repofile, dver, basearch, pkglist_file, repo_cache)
+
+
+def make_stage1_dir(stage_dir, repofile, dver, basearch, pkglist_file, repo_cache=None, rpm_store=None, cache=None, report=None, locked=None,
+                    clone=True):
+    """Make the stage 1 dir, from scratch or from the cache (a
+    stage1cache.Stage1Cache) if given.  If locked (a pkglock.LockedStage) is
+    given, install exactly its RPMs instead of the packages in pkglist_file.
+    If clone is False, a cache hit leaves stage_dir alone.
+    Returns True on success.
+
+    """
+    def _statusmsg(msg):
+        statusmsg("[%r,%r]: %s" % (dver, basearch, msg))
+
+    report = report or buildreport.BuildReport()
+    _statusmsg("Using %r for stage 1 directory" % stage_dir)
+    stage1_root = os.path.realpath(stage_dir)
+    # the whole of stage 1 is one stage for the scheduler
+    with report.phase("stage1", stage="stage1"):
+        try:
+            if not cache:
+                _make_stage1_dir(stage_dir, stage1_root, repofile, dver, basearch, pkglist_file, repo_cache, rpm_store, locked, _statusmsg, report)
+                return True
+
+            key, nevras = _get_cache_key(cache, repofile, dver, basearch, pkglist_file, repo_cache, locked, _statusmsg, report)
+            with cache.lock(key):
+                if cache.has(key):
+                    _statusmsg("Stage 1 cache hit (%s)" % key)
+                    report.set('stage1_cache', 'hit')
+                    if not clone:
+                        return True
+                    with report.phase("stage1.clone_from_cache"):
+                        make_stage1_root_dir(stage1_root)
+                        method = cache.clone_to(key, stage1_root)
+                    _statusmsg("Cloned stage 1 dir from cache using %ss" % method)
+                    return True
+
+                _statusmsg("Stage 1 cache miss (%s)" % key)
+                report.set('stage1_cache', 'miss')
+                _make_stage1_dir(stage_dir, stage1_root, repofile, dver, basearch, pkglist_file, repo_cache, rpm_store, locked, _statusmsg, report)
+
+                _statusmsg("Adding stage 1 dir to cache")
+                with report.phase("stage1.store_in_cache"):
+                    cache.store(key, stage1_root, info={'dver': dver,
+                                                        'basearch': basearch,
+                                                        'pkglist_file': os.path.abspath(pkglist_file),
+                                                        'nevras': nevras})
+            with report.phase("stage1.evict_cache"):
+                cache.evict(keep_key=key)
+
+            return True
+        except Error as err:
+            errormsg(str(err))
+            return False
+
+
+@contextlib.contextmanager
+def stage1_layer(stage_dir, repofile, dver, basearch, pkglist_file, repo_cache=None, rpm_store=None, cache=None, report=None, locked=None):
+    """Make stage 1 for use as the read-only lower layer of an overlay, and
+    yield the dir to use.  With a cache, that is the cache entry itself, so
+    concurrent builds can share it; it is kept from being evicted until the
+    with block ends.  Otherwise, stage 1 is built in stage_dir.
+    Raises Error on failure.
+
+    """
+    def _statusmsg(msg):
+        statusmsg("[%r,%r]: %s" % (dver, basearch, msg))
+
+    report = report or buildreport.BuildReport()
+    if cache:
+        key, _ = _get_cache_key(cache, repofile, dver, basearch, pkglist_file, repo_cache, locked, _statusmsg, report)
+        with cache.lock(key, shared=True):
+            if cache.has(key):
+                _statusmsg("Stage 1 cache hit (%s); using it as the lower layer" % key)
+                report.set('stage1_cache', 'hit')
+                cache.touch(key)
+                yield cache.root_dir(key)
+                return
+
+    if not make_stage1_dir(stage_dir, repofile, dver, basearch, pkglist_file, repo_cache=repo_cache, rpm_store=rpm_store,
+                           cache=cache, report=report, locked=locked, clone=False):
+        raise Error("Making stage 1 dir unsuccessful")
+    if not cache:
+        yield stage_dir
+        return
+
+    with cache.lock(key, shared=True):
+        if not cache.has(key):
+            raise Error("Stage 1 cache entry %s was evicted before it could be used" % key)
+        yield cache.root_dir(key)
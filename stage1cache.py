@@ -0,0 +1,117 @@
+"""
+A persistent cache of stage 1 directories.
+
+Building a stage 1 directory from scratch takes a long time, but its inputs
+(the dver and basearch, the package list files and the set of packages yum
+resolves them to) rarely change.  Completed stage 1 directories are kept in
+the cache, keyed on a hash of those inputs; a build whose inputs match an
+existing entry gets its stage dir by cloning the entry (using reflinks or
+hardlinks) instead of installing everything again.
+
+Each entry is a directory named after its key, containing:
+- root/:     the stage 1 directory, including stage1_index and stage1_rpmlist
+- info.json: the inputs the key was computed from, for the curious
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+
+from common import sha256_file, hash_strings, clone_tree
+import dircache
+
+
+# Directories in a stage 1 dir whose files get modified in place (rather than
+# replaced) during stage 2; these must not be shared by hardlinked clones.
+UNSHARE_DIRS = ['var/lib/rpm', 'var/lib/dnf', 'var/lib/yum', 'var/cache', 'var/log', 'etc']
+
+DEFAULT_MAX_AGE_DAYS = dircache.DEFAULT_MAX_AGE_DAYS
+DEFAULT_MAX_SIZE = "20G"
+
+
+class Stage1Cache(dircache.DirCache):
+    description = "stage 1 cache"
+    # whether the key includes the resolved stage 1 packages (see key())
+    # or only the input files (see SharedStage1Dirs.input_key())
+    resolves_packages = True
+
+    def __init__(self, cache_dir, max_age_days=DEFAULT_MAX_AGE_DAYS, max_size=DEFAULT_MAX_SIZE):
+        super(Stage1Cache, self).__init__(cache_dir, max_age_days, max_size)
+
+    def key(self, dver, basearch, pkglist_file, includes_file, nevras):
+        """Return the cache key for a stage 1 dir built from the given inputs"""
+        file_hashes = []
+        for path in pkglist_file, includes_file:
+            if path and os.path.exists(path):
+                file_hashes.append(sha256_file(path))
+            else:
+                file_hashes.append("")
+        return hash_strings([dver, basearch] + file_hashes + list(nevras))
+
+    def root_dir(self, key):
+        """The stage 1 dir in the entry for key, which must not be modified"""
+        return os.path.join(self.entry_dir(key), 'root')
+
+    def has(self, key):
+        return os.path.isdir(self.root_dir(key))
+
+    def clone_to(self, key, stage_dir):
+        """Populate stage_dir from the cached entry for key.  Returns the
+        clone method used.
+
+        """
+        method = clone_tree(self.root_dir(key), stage_dir, UNSHARE_DIRS)
+        self.touch(key)
+        return method
+
+    def store(self, key, stage_dir, info=None):
+        """Add stage_dir to the cache as the entry for key"""
+        def _fill(tmp_dir):
+            clone_tree(stage_dir, os.path.join(tmp_dir, 'root'), UNSHARE_DIRS)
+            with open(os.path.join(tmp_dir, 'info.json'), 'w') as info_fh:
+                json.dump(info or {}, info_fh, indent=2, sort_keys=True)
+        self._store_dir(key, _fill)
+
+
+class SharedStage1Dirs(Stage1Cache):
+    """The stage 1 dirs shared by the builds in one run of make-client-tarball,
+    for bundles that have the same stage 1 inputs.  The first build to need
+    one makes it; the others clone it.  Since all the builds run at about the
+    same time, the key is made from the input files alone, without resolving
+    the packages, and nothing is evicted; the whole dir is removed at the end
+    of the run.
+
+    """
+    description = "shared stage 1 dirs"
+    resolves_packages = False
+
+    def __init__(self, cache_dir):
+        super(SharedStage1Dirs, self).__init__(cache_dir, max_age_days=0, max_size=None)
+
+    def input_key(self, dver, basearch, pkglist_file, includes_file, repofile):
+        """Return the key for a stage 1 dir built from the given inputs"""
+        file_hashes = []
+        for path in pkglist_file, includes_file, repofile:
+            if path and os.path.exists(path):
+                file_hashes.append(sha256_file(path))
+            else:
+                file_hashes.append("")
+        return hash_strings([dver, basearch] + file_hashes)
+
+
+class BaseBundleSnapshots(Stage1Cache):
+    """Snapshots of the stage dirs of base bundles (see 'basebundle' in
+    bundles.ini) taken right after their stage 2 packages are installed, for
+    the builds of bundles derived from them in the same run of
+    make-client-tarball.  Like SharedStage1Dirs, nothing is evicted, and the
+    whole dir is removed at the end of the run.
+
+    """
+    description = "base bundle snapshots"
+
+    def __init__(self, cache_dir):
+        super(BaseBundleSnapshots, self).__init__(cache_dir, max_age_days=0, max_size=None)
+
+    def key(self, bundle, dver, basearch):
+        return "%s-%s-%s" % (bundle, dver, basearch)
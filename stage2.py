@@ -1,22 +1,25 @@
 from __future__ import print_function
 from __future__ import absolute_import
+import contextlib
 import glob
+import json
 import os
 import re
 import shutil
 import subprocess
-import tempfile
 
+import archive
+import buildreport
+import bytecode
 import envsetup
+import fileindex
+import rpmdb
+import rpath
+import treewalk
 import yumconf
 
 import common
-from common import statusmsg, errormsg, safe_makedirs, safe_symlink, Error, to_str, to_bytes
-
-
-def package_installed(stage_dir_abs, pkg):
-    """Return True if a package is installed"""
-    return subprocess.call(["rpm", "--root", stage_dir_abs, "-q", pkg]) == 0
+from common import statusmsg, errormsg, safe_makedirs, safe_symlink, Error
 
 
 def get_stage1_rpmlist(stage_dir_abs):
@@ -29,20 +32,12 @@ def get_stage1_rpmlist(stage_dir_abs):
         return stage1_rpmlist.read().strip().split()
 
 
-def write_package_list_file(stage_dir_abs, exclude_list=None):
+def write_package_list_file(stage_dir_abs, rpmdb_snapshot, exclude_list=None):
     exclude_list = exclude_list or []
     if isinstance(exclude_list, str):
         exclude_list = [exclude_list]
 
-    cmd = ["rpm", "--root", stage_dir_abs, "-qa"]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    output = to_str(proc.communicate()[0])
-    retcode = proc.returncode
-
-    if retcode != 0:
-        raise subprocess.CalledProcessError(retcode, ' '.join(cmd))
-
-    package_set = set(output.strip().split())
+    package_set = set(rpmdb_snapshot.nvras())
     exclude_set = set(exclude_list)
     package_set.difference_update(exclude_set)
 
@@ -50,21 +45,45 @@ def write_package_list_file(stage_dir_abs, exclude_list=None):
         output_fh.write("\n".join(sorted(package_set)) + "\n")
 
 
-def install_packages(stage_dir_abs, packages, repofile, dver, basearch, extra_repos=None):
-    """Install packages into a stage1 dir"""
+def install_packages(stage_dir_abs, packages, repofile, dver, basearch, extra_repos=None, repo_cache=None, rpm_store=None):
+    """Install packages into a stage1 dir.
+    Returns an rpmdb.RpmDbSnapshot of the stage dir after the install.
+
+    """
     if isinstance(packages, str):
         packages = [packages]
+    if not packages:
+        # e.g. a bundle made from its base bundle with no extra packages
+        return rpmdb.RpmDbSnapshot(stage_dir_abs)
 
     with common.MountProcFS(stage_dir_abs):
-        with yumconf.YumInstaller(repofile, dver, basearch, extra_repos) as yum:
+        with yumconf.YumInstaller(repofile, dver, basearch, extra_repos, metadata_cache=repo_cache, rpm_store=rpm_store) as yum:
             yum.install(installroot=stage_dir_abs, packages=packages)
 
     # Check that the packages got installed
+    rpmdb_snapshot = rpmdb.RpmDbSnapshot(stage_dir_abs)
     for pkg in packages:
         if pkg.startswith('@'):
             continue # can't check on groups
-        if not package_installed(stage_dir_abs, pkg):
+        if not rpmdb_snapshot.installed(pkg):
             raise Error("%r not installed after yum install" % pkg)
+    return rpmdb_snapshot
+
+
+def install_locked_packages(stage_dir_abs, locked):
+    """Install the RPMs from locked (a pkglock.LockedStage) into a stage1 dir
+    in one transaction.
+    Returns an rpmdb.RpmDbSnapshot of the stage dir after the install.
+
+    """
+    with common.MountProcFS(stage_dir_abs):
+        yumconf.rpm_install(stage_dir_abs, locked.rpm_paths())
+
+    rpmdb_snapshot = rpmdb.RpmDbSnapshot(stage_dir_abs)
+    for nevra in locked.nevras():
+        if not rpmdb_snapshot.installed(nevra):
+            raise Error("%r not installed after rpm install" % nevra)
+    return rpmdb_snapshot
 
 
 def patch_installed_packages(stage_dir_abs, patch_dirs, dver):
@@ -139,8 +158,12 @@ def fix_gsissh_config_dir(stage_dir_abs):
         raise Error("unable to fix gsissh config dir: %s" % err)
 
 
-def copy_osg_post_scripts(stage_dir_abs, post_scripts_dir, dver, basearch):
-    """Copy osg scripts from post_scripts_dir to the stage2 directory"""
+def copy_osg_post_scripts(stage_dir_abs, post_scripts_dir, dver, basearch, search_paths=None):
+    """Copy osg scripts from post_scripts_dir to the stage2 directory, and
+    write the environment script templates with search_paths (if given; see
+    envsetup.get_search_paths())
+
+    """
 
     if not os.path.isdir(post_scripts_dir):
         raise Error("script directory (%r) not found" % post_scripts_dir)
@@ -159,165 +182,328 @@ def copy_osg_post_scripts(stage_dir_abs, post_scripts_dir, dver, basearch):
             raise Error("unable to copy script (%r) to (%r): %s" % (script_path, dest_dir, err))
 
     try:
-        envsetup.write_setup_in_files(dest_dir, dver, basearch)
+        envsetup.write_setup_in_files(dest_dir, dver, basearch, search_paths)
     except EnvironmentError as err:
-        raise Error("unable to create environment script templates (setup.csh.in, setup.sh.in): %s" % err)
-
+        raise Error("unable to create environment script templates (setup.csh.in, setup.sh.in, setup.env.in): %s" % err)
+
+
+# Patterns (see the archive module) for files not to put in the tarball
+TARBALL_EXCLUDES = ["var/log/yum.log",
+                    "tmp/*",
+                    "var/cache/yum/*",
+                    "var/lib/rpm/*",
+                    "var/lib/yum/*",
+                    "var/tmp/*",
+                    "dev/*",
+                    "proc/*",
+                    "etc/rc.d/rc?.d",
+                    "etc/alternatives",
+                    "var/lib/alternatives",
+                    "usr/bin/[[]",
+                    "usr/share/man/man1/[[].1.gz",
+                    "bin/dbus*",
+                    "lib/libcap*",
+                    "lib/dbus*",
+                    "lib/security/pam*.so",
+                    "lib64/libcap*",
+                    "lib64/dbus*",
+                    "lib64/security/pam*.so",
+                    "usr/bin/gnome*",
+                    "*~",
+                    fileindex.INDEX_FILE,
+                    "stage1_rpmlist"]
+
+
+# The placeholder osg-post-install replaces with the install location, and the
+# index (in the tarball) of the files it is in
+OSG_LOCATION_PLACEHOLDER = "@@OSG_LOCATION@@"
+RELOCATION_INDEX = "osg/relocation-index.json"
+
+
+def read_stage1_files(stage_dir_abs):
+    """Return the set of stage 1 files (relative to the stage dir) to leave
+    out of the tarball, from the stage 1 index
 
-def _write_exclude_list(stage1_filelist_path, exclude_list_path, prepend_dir, extra_excludes=None):
-    assert stage1_filelist_path != exclude_list_path
-    with open(stage1_filelist_path, 'rb') as in_fh:
-        with open(exclude_list_path, 'wb') as out_fh:
-            for line in in_fh:
-                out_fh.write(os.path.join(to_bytes(prepend_dir), line.lstrip(b'./')))
-    if extra_excludes:
-        with open(exclude_list_path, 'ab') as out_fh:
-            for excl in extra_excludes:
-                out_fh.write(to_bytes(os.path.join(prepend_dir, excl) + '\n'))
+    """
+    stage1_index = os.path.join(stage_dir_abs, fileindex.INDEX_FILE)
+    stage1_filelist = os.path.join(stage_dir_abs, 'stage1_filelist')
+    if os.path.isfile(stage1_index):
+        with fileindex.Stage1Index(stage1_index) as index:
+            return index.paths()
+    elif os.path.isfile(stage1_filelist):
+        # made by an older version, e.g. in the stage 1 cache
+        return archive.read_stage1_filelist(stage1_filelist)
+    return set()
+
+
+def rewrite_rpaths(stage_dir_abs, search_dir, basearch, report):
+    """Give the ELF files that go in the tarball $ORIGIN RUNPATHs to the
+    libraries they need (see the rpath module); search_dir is the stage dir
+    or the layer stage 2 installed into.  Records what was done, and how
+    many library lookups that saves on a few of the binaries, in report.
+    Returns the library dirs that still need to be on the LD_LIBRARY_PATH.
 
+    """
+    exclude_paths = read_stage1_files(stage_dir_abs) if search_dir == stage_dir_abs else set()
+    rewriter = rpath.RpathRewriter(stage_dir_abs, search_dir, envsetup.get_library_dirs(basearch),
+                                   excludes=TARBALL_EXCLUDES, exclude_paths=exclude_paths)
+    with report.phase("stage2.rewrite_rpath"):
+        rewriter.scan()
+        samples = rewriter.samples()
+        lookups_before = rewriter.measure(samples, rewriter.library_dirs)
+        rewriter.rewrite()
+        lookups_after = rewriter.measure(samples, rewriter.slim_library_dirs)
+    stats = rewriter.stats()
+    stats['lookups'] = {'samples': samples, 'before': lookups_before, 'after': lookups_after}
+    report.set('rpath', stats)
+    if rewriter.failed:
+        errormsg("Could not rewrite the RUNPATHs of %d files; their library dirs stay on the LD_LIBRARY_PATH" % len(rewriter.failed))
+    return rewriter.slim_library_dirs
+
+
+def prune_search_paths(stage_dir_abs, search_dir, dver, basearch, report, library_dirs=None, include_paths=None):
+    """Return the search paths (see envsetup.get_search_paths()) for the
+    setup files, without the dirs that have nothing in the tarball, and
+    ordered by how many files they have in it.  search_dir is the stage dir
+    or the layer stage 2 installed into; include_paths are the stage 1
+    files that go in the tarball anyway.  If library_dirs is given (from
+    rewrite_rpaths()), it replaces the LD_LIBRARY_PATH dirs.  What was
+    decided is recorded in report.
 
-def tar_stage_dir(stage_dir_abs, tarball):
-    """tar up the stage_dir
-    Assume: valid stage2 dir
     """
-    tarball_abs = os.path.abspath(tarball)
-    stage_dir_parent = os.path.dirname(stage_dir_abs)
-    stage_dir_base = os.path.basename(stage_dir_abs)
-
-    excludes = ["var/log/yum.log",
-                "tmp/*",
-                "var/cache/yum/*",
-                "var/lib/rpm/*",
-                "var/lib/yum/*",
-                "var/tmp/*",
-                "dev/*",
-                "proc/*",
-                "etc/rc.d/rc?.d",
-                "etc/alternatives",
-                "var/lib/alternatives",
-                "usr/bin/[[]",
-                "usr/share/man/man1/[[].1.gz",
-                "bin/dbus*",
-                "lib/libcap*",
-                "lib/dbus*",
-                "lib/security/pam*.so",
-                "lib64/libcap*",
-                "lib64/dbus*",
-                "lib64/security/pam*.so",
-                "usr/bin/gnome*",
-                "*~",
-                "*.py[co]",
-                "__pycache__",
-                "stage1_rpmlist"]
-
-    cmd = ["tar", "-C", stage_dir_parent, "-czf", tarball_abs, stage_dir_base]
+    search_paths = envsetup.get_search_paths(dver, basearch)
+    if library_dirs is not None:
+        search_paths['LD_LIBRARY_PATH'] = library_dirs
+    stage1_files = read_stage1_files(stage_dir_abs) if search_dir == stage_dir_abs else set()
+    exclude_re = treewalk.compile_excludes(TARBALL_EXCLUDES)
 
-    stage1_filelist = os.path.join(stage_dir_abs, 'stage1_filelist')
-    if os.path.isfile(stage1_filelist):
-        exclude_list = os.path.join(stage_dir_parent, 'exclude_list')
-        _write_exclude_list(stage1_filelist, exclude_list, stage_dir_base, excludes)
-        cmd.insert(3, '--exclude-from=%s' % exclude_list)
-
-    err = subprocess.call(cmd)
-    if err:
-        raise Error("unable to create tarball (%r) from stage 2 dir (%r)" % (tarball_abs, stage_dir_abs))
-
-
-def fix_alternatives_symlinks(stage_dir_abs):
-    for root, dirs, files in os.walk(os.path.join(stage_dir_abs, 'usr')):
-        for afile in files:
-            afilepath = os.path.join(root, afile)
-            if not os.path.islink(afilepath):
-                continue
-            linkpath = os.readlink(afilepath)
-            if not linkpath.startswith('/etc/alternatives'):
-                continue
-            stage_linkpath = os.path.join(stage_dir_abs, linkpath.lstrip('/'))
-            if not os.path.islink(stage_linkpath):
-                print("broken symlink to alternatives? {0} -> {1}".format(afilepath, stage_linkpath))
-                continue
-            alternatives_linkpath = os.readlink(stage_linkpath)
-            stage_alternatives_linkpath = os.path.join(stage_dir_abs, alternatives_linkpath.lstrip('/'))
-            if not os.path.exists(stage_alternatives_linkpath):
-                print("broken symlink from alternatives? {0} -> {1}".format(stage_linkpath, stage_alternatives_linkpath))
-                continue
-            new_linkpath = os.path.relpath(stage_alternatives_linkpath, start=os.path.dirname(afilepath))
-            os.unlink(afilepath)
-            os.symlink(new_linkpath, afilepath)
-
-
-def fix_permissions(stage_dir_abs):
-    return subprocess.call(['chmod', '-R', 'u+rwX', stage_dir_abs])
-
-
-def remove_empty_dirs_from_tarball(tarball, topdir, recreate_dirs=None):
-    recreate_dirs = recreate_dirs or []
-    tarball_abs = os.path.abspath(tarball)
-    tarball_base = os.path.basename(tarball)
-    extract_dir = tempfile.mkdtemp()
-    oldcwd = os.getcwd()
-    try:
-        os.chdir(extract_dir)
-        subprocess.check_call(['tar', '-xzf', tarball_abs])
-        subprocess.call(['find', topdir, '-type', 'd', '-empty', '-delete'])
-        # hack to preserve these directories
-        for rdir in recreate_dirs:
-            safe_makedirs(os.path.join(topdir, rdir.lstrip('/')))
-        subprocess.check_call(['tar', '-czf', tarball_base, topdir])
-        shutil.copy(tarball_base, tarball_abs)
-    finally:
-        os.chdir(oldcwd)
-        shutil.rmtree(extract_dir)
+    def _skip(relpath):
+        return relpath in stage1_files or bool(exclude_re.match(relpath))
 
+    with report.phase("stage2.prune_search_paths"):
+        search_paths, decisions = envsetup.prune_search_paths(search_paths, search_dir, skip=_skip, include_paths=include_paths)
+    report.set('search_paths', decisions)
+    return search_paths
 
-def make_stage2_tarball(stage_dir, packages, tarball, patch_dirs, post_scripts_dir, repofile, dver, basearch, relnum=0, extra_repos=None):
-    def _statusmsg(msg):
-        statusmsg("[%r,%r]: %s" % (dver, basearch, msg))
 
-    _statusmsg("Making stage2 tarball in %r" % stage_dir)
+def compile_python(stage_dir_abs, search_dir, dver, basearch, report):
+    """Compile the Python modules stage 2 added to the PYTHONPATH of the
+    tarball (see the bytecode module), and record in report how long importing the modules
+    stage 2 added (the ones under search_dir, which is the stage dir or the
+    layer stage 2 installed into) takes with and without the bytecode.
+    Returns the dirs (relative to the stage dir) whose bytecode goes in the
+    tarball.
 
-    stage_dir_abs = os.path.abspath(stage_dir)
+    """
+    python_dirs = envsetup.get_python_dirs(dver, basearch)
+    stage1_files = read_stage1_files(stage_dir_abs) if search_dir == stage_dir_abs else set()
+    with report.phase("stage2.compile_python"):
+        compiled = bytecode.compile_dirs(stage_dir_abs, python_dirs, search_dir, stage1_files)
+    with report.phase("stage2.time_python_imports"):
+        modules = bytecode.shipped_modules(search_dir, compiled, stage1_files)
+        report.set('python_bytecode', {
+            'dirs': compiled,
+            'modules': modules,
+            'import_seconds_without_bytecode': bytecode.time_imports(stage_dir_abs, compiled, modules, use_bytecode=False),
+            'import_seconds_with_bytecode': bytecode.time_imports(stage_dir_abs, compiled, modules, use_bytecode=True)})
+    return compiled
+
+
+def fix_and_scan_stage_dir(stage_dir_abs, recreate_dirs=None, overlay=None, bytecode_dirs=None, stats=None, visitors=None):
+    """Walk the stage dir once, making symlinks into /etc/alternatives
+    point directly at their targets and fixing permissions (as `chmod -R
+    u+rwX` would) on the way, and return the archive.StageEntry list of what
+    goes in the tarball: everything but stage 1 files, excluded files and
+    empty dirs (except for the ones in recreate_dirs, which are created if
+    necessary).  Compiled Python files are left out too, except for those
+    under bytecode_dirs (from compile_python()).  If overlay (an OverlayLayers, not mounted) is given, only
+    its upper layer is fixed, and the tarball is made from that layer plus
+    the stage 1 files in the overlay's include_paths; no stage 1 file list
+    is needed.  If stats (a dict) is given, the stats of the walk (see the
+    treewalk module) are stored in it.  visitors are more treewalk visitors
+    to run after the ones that fix the dir.
+
+    """
+    changed_dir = overlay.upper_dir if overlay else stage_dir_abs
+    recreate_dirs = [x.strip('/') for x in recreate_dirs or []]
+    for rdir in recreate_dirs:
+        safe_makedirs(os.path.join(changed_dir, rdir))
+
+    layers = [overlay.upper_dir, overlay.lower_dir] if overlay else [stage_dir_abs]
+    visitors = [treewalk.BytecodeVisitor(bytecode_dirs), treewalk.AlternativesVisitor(layers), treewalk.PermissionsVisitor()] + list(visitors or [])
     try:
-        _statusmsg("Installing packages %r" % packages)
-        install_packages(stage_dir_abs, packages, repofile, dver, basearch, extra_repos)
+        if overlay:
+            return archive.scan_overlay(overlay.upper_dir, overlay.lower_dir, excludes=TARBALL_EXCLUDES, include_paths=overlay.include_paths,
+                                        keep_dirs=recreate_dirs, visitors=visitors, stats=stats)
+        return archive.scan_stage_dir(stage_dir_abs, excludes=TARBALL_EXCLUDES, exact_excludes=read_stage1_files(stage_dir_abs),
+                                      keep_dirs=recreate_dirs, visitors=visitors, stats=stats)
+    except EnvironmentError as err:
+        raise Error("unable to fix up stage 2 dir (%r): %s" % (changed_dir, err))
 
-        if patch_dirs is not None:
-            if isinstance(patch_dirs, str):
-                patch_dirs = [patch_dirs]
 
-            _statusmsg("Patching packages using %r" % patch_dirs)
-            patch_installed_packages(stage_dir_abs=stage_dir_abs, patch_dirs=patch_dirs, dver=dver)
+def add_relocation_index(entries, changed_dir, relocations):
+    """Write the relocation index (RELOCATION_INDEX) for osg-post-install
+    from relocations (a treewalk.PlaceholderVisitor) into changed_dir (the
+    stage dir, or the upper layer of an overlay), and return entries (from
+    fix_and_scan_stage_dir()) with the index added
 
-        if package_installed(stage_dir_abs, 'gsi-openssh'):
-            _statusmsg("Fixing gsissh config dir (if needed)")
-            fix_gsissh_config_dir(stage_dir_abs)
+    """
+    index = {'placeholder': OSG_LOCATION_PLACEHOLDER,
+             'files': [{'path': relpath, 'size': size, 'offsets': offsets}
+                       for relpath, (size, offsets) in sorted(relocations.files.items())]}
+    index_path = os.path.join(changed_dir, RELOCATION_INDEX)
+    try:
+        with open(index_path, 'w') as index_fh:
+            json.dump(index, index_fh, sort_keys=True)
+        index_entry = treewalk.StageEntry(RELOCATION_INDEX, index_path, os.lstat(index_path))
+    except EnvironmentError as err:
+        raise Error("unable to write relocation index (%r): %s" % (index_path, err))
+    index_dir = os.path.dirname(RELOCATION_INDEX)
+    entries = [x for x in entries if x.relpath != RELOCATION_INDEX]
+    for i, entry in enumerate(entries):
+        if entry.relpath == index_dir:
+            return entries[:i + 1] + [index_entry] + entries[i + 1:]
+    raise Error("%r is not in the tarball" % index_dir)
+
+
+def tar_stage_entries(entries, stage_dir_abs, tarball, codec=None):
+    """tar up entries (from fix_and_scan_stage_dir()) under the top-level
+    directory named after the stage dir, and compress it using codec (gzip if
+    not specified).
+    Returns an archive.ArchiveResult.
+    """
+    tarball_abs = os.path.abspath(tarball)
+    try:
+        return archive.write_tarball(entries, tarball_abs, os.path.basename(stage_dir_abs), codec)
+    except Error as err:
+        raise Error("unable to create tarball (%r) from stage 2 dir (%r): %s" % (tarball_abs, stage_dir_abs, err))
 
-        if package_installed(stage_dir_abs, 'osg-version'):
-            _statusmsg("Fixing osg-version")
-            fix_osg_version(stage_dir_abs, relnum)
 
-        _statusmsg("Fixing broken /etc/alternatives symlinks")
-        fix_alternatives_symlinks(stage_dir_abs)
+class OverlayLayers(object):
+    """Where the layers are for a stage 2 done in an overlay on top of a
+    read-only stage 1 dir.  include_paths are the stage 1 files (relative
+    to the stage dir) that go in the tarball anyway.
 
-        _statusmsg("Copying OSG scripts from %r" % post_scripts_dir)
-        copy_osg_post_scripts(stage_dir_abs, post_scripts_dir, dver, basearch)
+    """
+    def __init__(self, lower_dir, upper_dir, work_dir, include_paths=None):
+        self.lower_dir = os.path.abspath(lower_dir)
+        self.upper_dir = os.path.abspath(upper_dir)
+        self.work_dir = os.path.abspath(work_dir)
+        self.include_paths = include_paths or set()
 
-        stage1_rpmlist = get_stage1_rpmlist(stage_dir_abs)
-        _statusmsg("Writing package list to osg/rpm-versions.txt")
-        write_package_list_file(stage_dir_abs, exclude_list=stage1_rpmlist)
 
-        _statusmsg("Fixing permissions")
-        fix_permissions(stage_dir_abs)
+@contextlib.contextmanager
+def _stage2_root(stage_dir_abs, overlay):
+    if not overlay:
+        yield
+        return
+    with common.OverlayMount(overlay.lower_dir, overlay.upper_dir, overlay.work_dir, stage_dir_abs):
+        yield
+
+
+def make_stage2_tarball(stage_dir, packages, tarball, patch_dirs, post_scripts_dir, repofile, dver, basearch, relnum=0, extra_repos=None, repo_cache=None, rpm_store=None, codec=None,
+                        report=None, locked=None, overlay=None, snapshot_func=None, rewrite_rpath=False):
+    """Do stage 2 in stage_dir and write the tarball, recording the time
+    taken by each step in report (a buildreport.BuildReport).  If locked (a
+    pkglock.LockedStage) is given, install exactly its RPMs instead of
+    packages.  If overlay (an OverlayLayers) is given, stage_dir is an
+    overlay mount of its upper layer on the stage 1 dir, which is left
+    alone; the tarball is made from the upper layer.  If snapshot_func is
+    given, it is called with the stage dir (or the upper layer) right after
+    the packages are installed, before anything is patched or fixed.  If
+    rewrite_rpath is True, the ELF files get $ORIGIN RUNPATHs and the
+    LD_LIBRARY_PATH of the setup files only has the library dirs still
+    needed.  The search paths of the setup files leave out the dirs that
+    have nothing in the tarball.
+    Returns an archive.ArchiveResult on success, None on failure.
 
-        _statusmsg("Creating tarball %r" % tarball)
-        tar_stage_dir(stage_dir_abs, tarball)
+    """
+    def _statusmsg(msg):
+        statusmsg("[%r,%r]: %s" % (dver, basearch, msg))
+
+    _statusmsg("Making stage2 tarball in %r" % stage_dir)
 
-        _statusmsg("Removing empty dirs from tarball")
+    report = report or buildreport.BuildReport()
+    stage_dir_abs = os.path.abspath(stage_dir)
+    # Only look at what stage 2 changed where we can
+    changed_dir = overlay.upper_dir if overlay else stage_dir_abs
+    try:
+        with _stage2_root(stage_dir_abs, overlay):
+            if locked:
+                _statusmsg("Installing %d locked packages" % len(locked.entries))
+                with report.phase("stage2.install_packages", stage="install"):
+                    rpmdb_snapshot = install_locked_packages(stage_dir_abs, locked)
+            else:
+                _statusmsg("Installing packages %r" % packages)
+                with report.phase("stage2.install_packages", stage="install"):
+                    rpmdb_snapshot = install_packages(stage_dir_abs, packages, repofile, dver, basearch, extra_repos, repo_cache, rpm_store)
+
+            if snapshot_func:
+                _statusmsg("Taking snapshot of the installed packages")
+                with report.phase("stage2.snapshot"):
+                    snapshot_func(changed_dir)
+
+            with report.phase("stage2.fixups", stage="fixups"):
+                if patch_dirs is not None:
+                    if isinstance(patch_dirs, str):
+                        patch_dirs = [patch_dirs]
+
+                    _statusmsg("Patching packages using %r" % patch_dirs)
+                    with report.phase("stage2.patch"):
+                        patch_installed_packages(stage_dir_abs=stage_dir_abs, patch_dirs=patch_dirs, dver=dver)
+
+                if rpmdb_snapshot.installed('gsi-openssh'):
+                    _statusmsg("Fixing gsissh config dir (if needed)")
+                    with report.phase("stage2.fix_gsissh_config_dir"):
+                        fix_gsissh_config_dir(stage_dir_abs)
+
+                if rpmdb_snapshot.installed('osg-version'):
+                    _statusmsg("Fixing osg-version")
+                    with report.phase("stage2.fix_osg_version"):
+                        fix_osg_version(stage_dir_abs, relnum)
+
+                library_dirs = None
+                if rewrite_rpath:
+                    _statusmsg("Rewriting the RUNPATHs of ELF files")
+                    library_dirs = rewrite_rpaths(stage_dir_abs, changed_dir, basearch, report)
+
+                _statusmsg("Pruning the search paths of the setup files")
+                search_paths = prune_search_paths(stage_dir_abs, changed_dir, dver, basearch, report, library_dirs,
+                                                  overlay.include_paths if overlay else None)
+
+                _statusmsg("Copying OSG scripts from %r" % post_scripts_dir)
+                with report.phase("stage2.copy_osg_post_scripts"):
+                    copy_osg_post_scripts(stage_dir_abs, post_scripts_dir, dver, basearch, search_paths)
+
+                stage1_rpmlist = get_stage1_rpmlist(stage_dir_abs)
+                _statusmsg("Writing package list to osg/rpm-versions.txt")
+                with report.phase("stage2.write_package_list"):
+                    write_package_list_file(stage_dir_abs, rpmdb_snapshot, exclude_list=stage1_rpmlist)
+
+                _statusmsg("Compiling Python modules")
+                bytecode_dirs = compile_python(stage_dir_abs, changed_dir, dver, basearch, report)
+
+        # with an overlay, the rest is done on the (now unmounted) upper layer
         recreate_dirs = ['var/lib/osg-ca-certs']
-        if package_installed(stage_dir_abs, 'fetch-crl'):
+        if rpmdb_snapshot.installed('fetch-crl'):
             recreate_dirs.append('etc/fetch-crl.d')
-        remove_empty_dirs_from_tarball(tarball, os.path.basename(stage_dir), recreate_dirs)
+        _statusmsg("Fixing symlinks and permissions, and listing the files for the tarball")
+        walk_stats = {}
+        relocations = treewalk.PlaceholderVisitor(OSG_LOCATION_PLACEHOLDER.encode(), skip_dirs=[os.path.dirname(RELOCATION_INDEX)])
+        with report.phase("stage2.fix_tree", stage="fixups"):
+            entries = fix_and_scan_stage_dir(stage_dir_abs, recreate_dirs, overlay, bytecode_dirs, walk_stats, [relocations])
+            entries = add_relocation_index(entries, changed_dir, relocations)
+        report.set('tree_walk', walk_stats)
+        report.set('relocation', {'files': len(relocations.files),
+                                  'placeholders': sum(len(x[1]) for x in relocations.files.values()),
+                                  'binary_files': relocations.binary_files})
+        if relocations.binary_files:
+            errormsg("%s is in binary files, which osg-post-install can't fix: %s" % (
+                OSG_LOCATION_PLACEHOLDER, ", ".join(relocations.binary_files)))
 
-        return True
+        _statusmsg("Creating tarball %r" % tarball)
+        with report.phase("stage2.archive", stage="archive"):
+            return tar_stage_entries(entries, stage_dir_abs, tarball, codec)
     except Error as err:
         errormsg(str(err))
+        return None
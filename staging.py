@@ -0,0 +1,82 @@
+"""
+Where builds do their work: on disk, or in RAM.
+
+A build does hundreds of thousands of small-file operations in its stage dir
+(rpm installs, patching, fixing symlinks and permissions, archiving), which
+are much faster on a tmpfs than on a spinning or network disk.  With
+--staging=tmpfs the temporary dir a build works in is a tmpfs; with
+--staging=auto it is one if the packages the build installs (going by their
+installed sizes in the repo metadata) fit in the memory budget, and is on
+disk otherwise.  Tarballs are written to the current directory either way.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+
+from common import Error, MountTmpFS, statusmsg
+
+
+STAGING_MODES = ['disk', 'tmpfs', 'auto']
+
+# Room for file system overhead and the files the build adds, relative to
+# the installed size of the packages
+SIZE_MARGIN = 1.25
+
+
+def mem_available():
+    """Return the memory available for new work (MemAvailable) in bytes, or
+    0 if it can't be told
+
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo_fh:
+            for line in meminfo_fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def default_mem_budget(jobs):
+    """Return the tmpfs size for each of jobs concurrent builds: half the
+    available memory, divided evenly between them
+
+    """
+    return mem_available() // 2 // max(jobs, 1)
+
+
+def estimate_size(yum, packages):
+    """Estimate how much space installing packages (and everything they
+    need) takes, from the installed sizes in the repo metadata of yum (a
+    yumconf.YumInstaller)
+
+    """
+    return int(yum.installed_size(yum.resolve(packages)) * SIZE_MARGIN)
+
+
+class StagingDir(object):
+    """A temporary dir for a build, made with tempfile.mkdtemp(); if tmpfs_size
+    is given, a tmpfs of that size is mounted on it
+
+    """
+    def __init__(self, prefix, tmpfs_size=None):
+        self.path = tempfile.mkdtemp(prefix=prefix)
+        self.tmpfs = None
+        if tmpfs_size:
+            self.tmpfs = MountTmpFS(self.path, tmpfs_size)
+            try:
+                self.tmpfs.mount()
+            except Error:
+                os.rmdir(self.path)
+                raise
+            statusmsg("Using a %d MB tmpfs on %r for staging" % (tmpfs_size // (1024 * 1024), self.path))
+
+    def remove(self):
+        if self.tmpfs:
+            self.tmpfs.umount()
+            self.tmpfs = None
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,383 @@
+"""
+Fix up a stage 2 dir and list what goes in the tarball, in one pass.
+
+After the stage 2 packages are installed and patched, the stage dir used to
+be walked once to fix symlinks into /etc/alternatives, once more by
+`chmod -R u+rwX`, and again to make the tarball.  A TreeWalk walks it once,
+stat()ing each entry once, and hands every entry to a list of visitors:
+
+- Stage1Visitor:       leaves out the files that came from stage 1
+- ExcludeVisitor:      leaves out files matching the exclude patterns
+- BytecodeVisitor:     leaves out compiled Python files, except for the ones
+                       stage 2 compiled to ship (see the bytecode module)
+- AlternativesVisitor: makes symlinks into /etc/alternatives point directly
+                       (and relatively) at their targets
+- PermissionsVisitor:  makes everything readable and writable (and dirs and
+                       executables executable) by the owner, only chmod()ing
+                       the entries that need it
+- EmptyDirVisitor:     leaves out dirs that end up with nothing in them
+- PlaceholderVisitor:  finds the files with a placeholder (@@OSG_LOCATION@@)
+                       for osg-post-install to replace, and where it is in them
+
+The entries that are left, in the order they should be archived, go
+straight to archive.write_tarball().  The time spent in each visitor, and how
+many entries it changed or left out, is kept for the build report.
+
+Each dir is read with a single scandir(); the entries of a dir are first
+offered to the skip() method of every visitor (cheap checks on the relative
+path, before the entry is stat()ed), then the rest are stat()ed and passed to
+visit(), and then the subdirs are walked.  A dir is visited before anything
+in it is looked at, so a visitor can make an unreadable dir readable.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import fnmatch
+import mmap
+import os
+import re
+import shutil
+import stat
+import time
+
+from common import Error
+
+
+class StageEntry(object):
+    """A file, dir, or other object in the stage dir that will be archived"""
+    __slots__ = ('relpath', 'path', 'st')
+
+    def __init__(self, relpath, path, st):
+        self.relpath = relpath
+        self.path = path
+        self.st = st
+
+
+def compile_excludes(patterns):
+    """Compile a list of exclude patterns into a single regex"""
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(x) for x in patterns))
+
+
+def parent_dirs(relpaths):
+    """Return the set of relpaths and all of their parent dirs"""
+    dirs = set()
+    for relpath in relpaths:
+        relpath = relpath.strip('/')
+        while relpath:
+            dirs.add(relpath)
+            relpath = os.path.dirname(relpath)
+    return dirs
+
+
+class Visitor(object):
+    """Base class for the visitors of a TreeWalk.  Subclasses override the
+    methods they need; the walk only calls the ones that are overridden.
+    'changed' counts the entries the visitor changed or left out.
+
+    """
+    name = None
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.changed = 0
+
+    def skip(self, relpath, dir_entry):
+        """Return True to leave out relpath (and everything under it)"""
+        return False
+
+    def visit(self, entry):
+        """Look at (and maybe fix) entry, a StageEntry.  A visitor that
+        changes the file must update entry.st.
+
+        """
+        pass
+
+    def keep_dir(self, entry):
+        """Return False to leave out the dir entry, which has nothing left in it"""
+        return True
+
+    def stats(self):
+        return {'seconds': self.seconds, 'changed': self.changed}
+
+
+def _overrides(visitor, method):
+    return getattr(type(visitor), method) is not getattr(Visitor, method)
+
+
+class TreeWalk(object):
+    def __init__(self, root, visitors):
+        self.root = os.path.abspath(root)
+        self.visitors = list(visitors)
+        self.skippers = [x for x in self.visitors if _overrides(x, 'skip')]
+        self.visiting = [x for x in self.visitors if _overrides(x, 'visit')]
+        self.dir_keepers = [x for x in self.visitors if _overrides(x, 'keep_dir')]
+        self.entry_count = 0
+        self.seconds = 0.0
+
+    def run(self):
+        """Walk the tree and return a list of StageEntry objects for what is
+        left of it, in the order they should be archived.  The root is the
+        first entry, unless nothing is left at all.
+
+        """
+        start = time.time()
+        root_entry = StageEntry('', self.root, os.lstat(self.root))
+        self._visit([root_entry])
+        children = self._walk(self.root, '')
+        self.seconds += time.time() - start
+        if not children and not self._keep_dir(root_entry):
+            return []
+        return [root_entry] + children
+
+    def stats(self):
+        return {'entries': self.entry_count,
+                'seconds': self.seconds,
+                'visitors': dict((x.name, x.stats()) for x in self.visitors)}
+
+    def visit_extra(self, entries):
+        """Pass entries that are not under the root to the visit() method of
+        every visitor, parents first, as if the walk had found them
+
+        """
+        start = time.time()
+        self.entry_count += len(entries)
+        self._visit(entries)
+        self.seconds += time.time() - start
+
+    def _visit(self, entries):
+        for visitor in self.visiting:
+            start = time.time()
+            for entry in entries:
+                visitor.visit(entry)
+            visitor.seconds += time.time() - start
+
+    def _keep_dir(self, entry):
+        for visitor in self.dir_keepers:
+            start = time.time()
+            keep = visitor.keep_dir(entry)
+            visitor.seconds += time.time() - start
+            if not keep:
+                return False
+        return True
+
+    def _walk(self, dir_path, dir_relpath):
+        try:
+            dir_entries = sorted(os.scandir(dir_path), key=lambda x: x.name)
+        except OSError as err:
+            raise Error("unable to read directory %r: %s" % (dir_path, err))
+        prefix = dir_relpath + '/' if dir_relpath else ''
+        candidates = [(prefix + x.name, x) for x in dir_entries]
+        for visitor in self.skippers:
+            start = time.time()
+            candidates = [x for x in candidates if not visitor.skip(*x)]
+            visitor.seconds += time.time() - start
+
+        try:
+            entries = [StageEntry(relpath, x.path, x.stat(follow_symlinks=False)) for relpath, x in candidates]
+        except OSError as err:
+            raise Error("unable to stat a file in %r: %s" % (dir_path, err))
+        self.entry_count += len(entries)
+        self._visit(entries)
+
+        result = []
+        for entry in entries:
+            if stat.S_ISDIR(entry.st.st_mode):
+                children = self._walk(entry.path, entry.relpath)
+                if children or self._keep_dir(entry):
+                    result.append(entry)
+                    result.extend(children)
+            else:
+                result.append(entry)
+        return result
+
+
+class Stage1Visitor(Visitor):
+    """Leave out the paths in the set stage1_files"""
+    name = 'stage1'
+
+    def __init__(self, stage1_files):
+        Visitor.__init__(self)
+        self.stage1_files = stage1_files
+
+    def skip(self, relpath, dir_entry):
+        if relpath in self.stage1_files:
+            self.changed += 1
+            return True
+        return False
+
+
+class ExcludeVisitor(Visitor):
+    """Leave out paths matching the exclude patterns (see the archive module)"""
+    name = 'excludes'
+
+    def __init__(self, patterns):
+        Visitor.__init__(self)
+        self.exclude_re = compile_excludes(patterns)
+
+    def skip(self, relpath, dir_entry):
+        if self.exclude_re and self.exclude_re.match(relpath):
+            self.changed += 1
+            return True
+        return False
+
+
+class BytecodeVisitor(Visitor):
+    """Leave out compiled Python files (*.pyc, *.pyo and __pycache__ dirs),
+    except for the ones under keep_dirs that are not optimized (opt-1,
+    opt-2) bytecode
+
+    """
+    name = 'bytecode'
+
+    def __init__(self, keep_dirs=None):
+        Visitor.__init__(self)
+        self.keep_prefixes = tuple(x.strip('/') + '/' for x in keep_dirs or [])
+
+    def skip(self, relpath, dir_entry):
+        name = dir_entry.name
+        if name == '__pycache__':
+            keep = relpath.startswith(self.keep_prefixes)
+        elif name.endswith(('.pyc', '.pyo')):
+            keep = relpath.startswith(self.keep_prefixes) and '.opt-' not in name and not name.endswith('.pyo')
+        else:
+            return False
+        if not keep:
+            self.changed += 1
+        return not keep
+
+
+class AlternativesVisitor(Visitor):
+    """Make symlinks under usr/ that point into /etc/alternatives point
+    directly (and relatively) at their targets.  The alternatives links and
+    their targets are looked up in layers, a list of dirs: the stage dir, or
+    the upper and lower layers of an (unmounted) overlay, upper first.
+
+    """
+    name = 'alternatives'
+
+    def __init__(self, layers):
+        Visitor.__init__(self)
+        self.layers = layers
+
+    def _find(self, relpath):
+        """Return the path of relpath in the topmost layer that has it, or
+        None if there is none or it was removed (whited out)
+
+        """
+        for layer in self.layers:
+            path = os.path.join(layer, relpath)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                return None
+            return path
+        return None
+
+    def visit(self, entry):
+        if not entry.relpath.startswith('usr/') or not stat.S_ISLNK(entry.st.st_mode):
+            return
+        linkpath = os.readlink(entry.path)
+        if not linkpath.startswith('/etc/alternatives'):
+            return
+        alternatives_path = self._find(linkpath.lstrip('/'))
+        if not alternatives_path or not os.path.islink(alternatives_path):
+            print("broken symlink to alternatives? {0} -> {1}".format(entry.path, linkpath))
+            return
+        target_relpath = os.readlink(alternatives_path).lstrip('/')
+        target_path = self._find(target_relpath)
+        if not target_path or not os.path.exists(target_path):
+            print("broken symlink from alternatives? {0} -> {1}".format(alternatives_path, target_relpath))
+            return
+        os.unlink(entry.path)
+        os.symlink(os.path.relpath(target_relpath, start=os.path.dirname(entry.relpath)), entry.path)
+        entry.st = os.lstat(entry.path)
+        self.changed += 1
+
+
+class PermissionsVisitor(Visitor):
+    """Do what `chmod -R u+rwX` would, but only chmod() the entries whose
+    mode actually changes.  A file with other hard links (e.g. into a
+    cached stage 1 dir the stage dir was cloned from) is copied first, so
+    the other links keep their mode.
+
+    """
+    name = 'permissions'
+
+    def visit(self, entry):
+        mode = entry.st.st_mode
+        if stat.S_ISLNK(mode):
+            return
+        new_mode = mode | stat.S_IRUSR | stat.S_IWUSR
+        if stat.S_ISDIR(mode) or mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+            new_mode |= stat.S_IXUSR
+        if new_mode == mode:
+            return
+        if stat.S_ISREG(mode) and entry.st.st_nlink > 1:
+            tmp_path = entry.path + '.chmod-tmp'
+            shutil.copy2(entry.path, tmp_path)
+            os.rename(tmp_path, entry.path)
+        os.chmod(entry.path, stat.S_IMODE(new_mode))
+        entry.st = os.lstat(entry.path)
+        self.changed += 1
+
+
+class EmptyDirVisitor(Visitor):
+    """Leave out dirs that have nothing left in them, except for keep_dirs
+    (and their parents)
+
+    """
+    name = 'empty_dirs'
+
+    def __init__(self, keep_dirs=None):
+        Visitor.__init__(self)
+        self.keep_dirs = parent_dirs(keep_dirs or [])
+
+    def keep_dir(self, entry):
+        if entry.relpath in self.keep_dirs or (not entry.relpath and self.keep_dirs):
+            return True
+        self.changed += 1
+        return False
+
+
+class PlaceholderVisitor(Visitor):
+    """Find the regular files with placeholder (a bytes) in them, except
+    under skip_dirs, and the byte offsets it is at.  Files with NUL bytes
+    (binaries) are left out of files, since the placeholder can't be
+    replaced with something of another length in them, and listed in
+    binary_files instead.  'changed' counts the files found.
+
+    """
+    name = 'placeholders'
+
+    def __init__(self, placeholder, skip_dirs=None):
+        Visitor.__init__(self)
+        self.placeholder = placeholder
+        self.skip_prefixes = tuple(x.strip('/') + '/' for x in skip_dirs or [])
+        self.files = {}         # relpath -> (size, [offsets])
+        self.binary_files = []
+
+    def visit(self, entry):
+        if not stat.S_ISREG(entry.st.st_mode) or entry.st.st_size < len(self.placeholder) \
+                or entry.relpath.startswith(self.skip_prefixes):
+            return
+        with open(entry.path, 'rb') as fh:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offsets = []
+                offset = mapped.find(self.placeholder)
+                while offset != -1:
+                    offsets.append(offset)
+                    offset = mapped.find(self.placeholder, offset + len(self.placeholder))
+                if not offsets:
+                    return
+                if mapped.find(b'\0') != -1:
+                    self.binary_files.append(entry.relpath)
+                    return
+            finally:
+                mapped.close()
+        self.files[entry.relpath] = (entry.st.st_size, offsets)
+        self.changed += 1
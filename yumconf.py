@@ -1,6 +1,11 @@
 from __future__ import absolute_import
+import ast
+import binascii
+import contextlib
+import functools
 import glob
 import os
+import re
 import shutil
 import subprocess
 import tempfile
@@ -10,12 +15,94 @@ try:
 except ImportError:
     import configparser as ConfigParser
 
-from common import VALID_BASEARCHES, VALID_DVERS, Error, to_str, to_bytes
+from common import VALID_BASEARCHES, VALID_DVERS, BindMount, Error, hash_strings, to_str, to_bytes
 
 # Edit repos/osg-3.?.repo.in to define which packages to use from
 # testing/minefield (via the 'includepkgs' lines) and whether to use
 # testing/minefield at all (via the 'enabled' lines)
 
+NEVRA_QUERYFORMAT = "%{name}-%{epoch}:%{version}-%{release}.%{arch}"
+NVRA_QUERYFORMAT = "%{name}-%{version}-%{release}.%{arch}"
+
+def _parse_sha256(checksum):
+    """Return the hex sha256 in a checksum from repoquery, or None if it's
+    some other kind of checksum.  dnf prints hawkey's (type, digest) tuple,
+    yum the hex digest.
+
+    """
+    checksum = checksum.strip()
+    if checksum.startswith('('):
+        try:
+            checksum = binascii.hexlify(ast.literal_eval(checksum)[1]).decode()
+        except (ValueError, SyntaxError, TypeError, IndexError):
+            return None
+    if re.match(r'^[0-9a-fA-F]{64}$', checksum):
+        return checksum.lower()
+    return None
+
+_VERSION_SEGMENT_RE = re.compile(r'~|\^|[0-9]+|[a-zA-Z]+')
+
+def rpmvercmp(one, two):
+    """Compare two version (or release) strings the way rpm does; returns
+    -1, 0 or 1.  Digits sort after letters, '~' sorts before anything
+    (even the end of the string) and '^' after the end but before anything
+    else.
+
+    """
+    if one == two:
+        return 0
+    one_segs = _VERSION_SEGMENT_RE.findall(one)
+    two_segs = _VERSION_SEGMENT_RE.findall(two)
+    while one_segs or two_segs:
+        seg1 = one_segs[0] if one_segs else ''
+        seg2 = two_segs[0] if two_segs else ''
+        if seg1 == '~' or seg2 == '~':
+            if seg1 != '~':
+                return 1
+            if seg2 != '~':
+                return -1
+        elif seg1 == '^' or seg2 == '^':
+            if not one_segs:
+                return -1
+            if not two_segs:
+                return 1
+            if seg1 != '^':
+                return 1
+            if seg2 != '^':
+                return -1
+        elif not (one_segs and two_segs):
+            break
+        elif seg1.isdigit() != seg2.isdigit():
+            return 1 if seg1.isdigit() else -1
+        elif seg1.isdigit():
+            if int(seg1) != int(seg2):
+                return 1 if int(seg1) > int(seg2) else -1
+        elif seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+        one_segs.pop(0)
+        two_segs.pop(0)
+    if not one_segs and not two_segs:
+        return 0
+    return 1 if one_segs else -1
+
+def split_nevra(nevra):
+    """Split 'name-epoch:version-release.arch' (the epoch is optional) into
+    (name, epoch, version, release, arch)
+
+    """
+    nevr, _, arch = nevra.rpartition('.')
+    name, evr = nevr.rsplit('-', 2)[0], nevr.rsplit('-', 2)[1:]
+    epoch, _, version = evr[0].rpartition(':')
+    return name, epoch or '0', version, evr[1], arch
+
+def compare_nevras(nevra1, nevra2):
+    """Compare two NEVRAs by their EVRs, as rpm would; returns -1, 0 or 1"""
+    _, epoch1, version1, release1, _ = split_nevra(nevra1)
+    _, epoch2, version2, release2, _ = split_nevra(nevra2)
+    if int(epoch1) != int(epoch2):
+        return 1 if int(epoch1) > int(epoch2) else -1
+    return rpmvercmp(version1, version2) or rpmvercmp(release1, release2)
+
 class YumInstallError(Error):
     def __init__(self, packages, rootdir, err):
         super(self.__class__, self).__init__("Could not install %r into %r (rpm/yum process returned %d)" % (packages, rootdir, err))
@@ -26,8 +113,29 @@ class YumEraseError(Error):
     def __init__(self, packages, rootdir, err):
         super(self.__class__, self).__init__("Could not erase %r from %r (rpm process returned %d)" % (packages, rootdir, err))
 
+def rpm_install(installroot, rpms, nodeps=False, noscripts=False):
+    """Install (or upgrade to) the RPM files in rpms into installroot, in a
+    single rpm transaction
+
+    """
+    cmd = ["rpm",
+           "--upgrade",
+           "--verbose",
+           "--root", installroot]
+    if nodeps:
+        cmd.append("--nodeps")
+    if noscripts:
+        cmd.append("--noscripts")
+    cmd += rpms
+    env = os.environ.copy()
+    env.update({'LANG': 'C', 'LC_ALL': 'C'})
+    err = subprocess.call(cmd, env=env)
+    if err:
+        raise YumInstallError([os.path.basename(x) for x in rpms], installroot, err)
+
+
 class YumInstaller(object):
-    def __init__(self, templatefile, dver, basearch, extra_repos=None):
+    def __init__(self, templatefile, dver, basearch, extra_repos=None, metadata_cache=None, rpm_store=None):
         if not dver in VALID_DVERS:
             raise ValueError('Invalid dver, should be in {0}'.format(VALID_DVERS))
         if not basearch in VALID_BASEARCHES:
@@ -36,6 +144,14 @@ class YumInstaller(object):
         self.dver = dver
         self.basearch = basearch
         self.templatefile = templatefile
+        # If metadata_cache (a repocache.RepoMetadataCache) is given, all
+        # commands use a private copy of its metadata as their cachedir;
+        # otherwise the system yum cache is used.
+        self.metadata_cache = metadata_cache
+        self.cachedir = None
+        # If rpm_store (an rpmstore.RpmStore) is given, RPMs are taken from
+        # and added to it instead of always being downloaded.
+        self.rpm_store = rpm_store
 
         self.config = ConfigParser.RawConfigParser()
         self._set_main()
@@ -53,6 +169,16 @@ class YumInstaller(object):
     def __enter__(self):
         self.conf_file = tempfile.NamedTemporaryFile(suffix='.conf', mode='wt')
         self._write_config(self.conf_file.file)
+        if self.metadata_cache:
+            self.cachedir = tempfile.mkdtemp(prefix='yumcache-%s-%s-' % (self.dver, self.basearch))
+            entered = False
+            try:
+                self.metadata_cache.checkout(self.metadata_cache_key(), self._repos_text(), self.cachedir, self.makecache)
+                entered = True
+            finally:
+                # __exit__ won't be called if we fail here, so clean up ourselves
+                if not entered:
+                    self.__exit__(None, None, None)
         return self
 
 
@@ -61,6 +187,9 @@ class YumInstaller(object):
             self.conf_file.close()
         except (AttributeError, NameError):
             pass
+        if self.cachedir:
+            shutil.rmtree(self.cachedir, ignore_errors=True)
+            self.cachedir = None
 
 
     def _get_repo_args(self):
@@ -100,8 +229,53 @@ class YumInstaller(object):
         dest_file.flush()
 
 
+    def _repos_text(self):
+        """The parts of the config that determine what metadata we get"""
+        lines = []
+        for sec in sorted(self.config.sections()):
+            if sec == 'main':
+                continue
+            lines.append("[%s]" % sec)
+            lines.extend("%s = %s" % item for item in sorted(self.config.items(sec)))
+        lines.append("# " + " ".join(self.repo_args))
+        lines.append("# dnf=%s" % self.yum_is_dnf)
+        return "\n".join(lines) + "\n"
+
+    def metadata_cache_key(self):
+        return hash_strings([self._repos_text()])
+
+    def _cache_args(self):
+        if self.cachedir:
+            # the metadata cache decides when the metadata needs refreshing
+            return ["--setopt=cachedir=" + self.cachedir, "--setopt=metadata_expire=never"]
+        return []
+
+    @contextlib.contextmanager
+    def _installroot_cache(self, installroot):
+        """yum looks for the cachedir inside the installroot, so make ours
+        visible there for the duration of a with block
+
+        """
+        if not self.cachedir:
+            yield
+            return
+        with BindMount(self.cachedir, os.path.join(installroot, self.cachedir.lstrip('/'))):
+            yield
+
+    def makecache(self, cachedir):
+        """Download the metadata for our repos into cachedir"""
+        cmd = ["yum", "makecache",
+               "-c", self.conf_file.name,
+               "-q",
+               "--setopt=cachedir=" + cachedir,
+               "--setopt=metadata_expire=0"]
+        cmd.extend(self.repo_args)
+        err = subprocess.call(cmd)
+        if err:
+            raise Error("Could not download repo metadata into %r (yum process returned %d)" % (cachedir, err))
+
     def yum_clean(self):
-        args = ["-c", self.conf_file.name, "--enablerepo=*"]
+        args = ["-c", self.conf_file.name, "--enablerepo=*"] + self._cache_args()
         with open(os.devnull, 'wb') as fnull:
             subprocess.call(["yum", "clean", "all"] + args, stdout=fnull)
 
@@ -114,18 +288,16 @@ class YumInstaller(object):
         except (IndexError, ValueError):
             raise Error("unexpected output from yum --version: %s" % output)
 
-    def repoquery(self, *args):
-        # Correct someone passing a list of strings instead of just the strings
-        if type(args[0]) is list or type(args[0]) is tuple:
-            args = list(args[0])
+    def _repoquery_lines(self, args):
         cmd = ["repoquery",
                "-c", self.conf_file.name]
         if not self.yum_is_dnf:
             cmd.append("--plugins")
         cmd.extend(self.repo_args)
+        cmd.extend(self._cache_args())
         cmd.extend(args)
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        output = to_str(proc.communicate()[0]).splitlines()[0]
+        output = to_str(proc.communicate()[0]).splitlines()
         retcode = proc.returncode
 
         if not retcode:
@@ -133,9 +305,175 @@ class YumInstaller(object):
         else:
             raise subprocess.CalledProcessError(retcode,
                                                 cmd,
-                                                output,
+                                                "\n".join(output),
                                                 "")
 
+    def repoquery(self, *args):
+        # Correct someone passing a list of strings instead of just the strings
+        if type(args[0]) is list or type(args[0]) is tuple:
+            args = list(args[0])
+        return self._repoquery_lines(list(args))[0]
+
+    def group_packages(self, group):
+        """Return the mandatory and default packages in a yum group"""
+        cmd = ["yum", "groupinfo",
+               "-c", self.conf_file.name,
+               "-q"]
+        cmd.extend(self.repo_args)
+        cmd.extend(self._cache_args())
+        cmd.append(group.lstrip('@'))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = to_str(proc.communicate()[0]).splitlines()
+        if proc.returncode:
+            raise Error("Could not get info for group %r (yum process returned %d)" % (group, proc.returncode))
+
+        packages = []
+        in_section = False
+        for line in output:
+            if line.strip().endswith(':'):
+                in_section = line.strip() in ('Mandatory Packages:', 'Default Packages:')
+            elif in_section and line.strip():
+                packages.append(line.strip().lstrip('=+-'))
+        return packages
+
+    def resolve(self, packages):
+        """Return a sorted list of the NEVRAs of packages and everything they
+        require, as the repos currently stand.  Groups ('@group') are expanded
+        to their mandatory and default packages.
+
+        """
+        names = []
+        for pkg in packages:
+            if pkg.startswith('@'):
+                names.extend(self.group_packages(pkg))
+            else:
+                names.append(pkg)
+        if not names:
+            return []
+
+        args = ["--queryformat=" + NEVRA_QUERYFORMAT]
+        if self.yum_is_dnf:
+            args.extend(["--latest-limit=1", "--arch=%s,noarch" % self.basearch])
+        nevras = set(self._repoquery_lines(args + names))
+        nevras.update(self._repoquery_lines(args + ["--requires", "--resolve", "--recursive"] + names))
+        return sorted(x for x in nevras if x.strip())
+
+    def installed_size(self, nevras):
+        """Return the total installed size (in bytes) of the packages in
+        nevras, according to the repo metadata
+
+        """
+        if not nevras:
+            return 0
+        size_tag = "%{installsize}" if self.yum_is_dnf else "%{installedsize}"
+        total = 0
+        for line in self._repoquery_lines(["--queryformat=" + size_tag] + list(nevras)):
+            try:
+                total += int(line.strip())
+            except ValueError:
+                pass
+        return total
+
+    def file_owners(self, paths):
+        """Return a dict of the NEVRA of the (latest) package in the repos that
+        provides each of the absolute paths in paths.  Paths no package
+        provides are left out.
+
+        """
+        args = ["--queryformat=" + NEVRA_QUERYFORMAT]
+        if self.yum_is_dnf:
+            args.extend(["--latest-limit=1", "--arch=%s,noarch" % self.basearch])
+        owners = {}
+        for path in paths:
+            nevras = sorted(x.strip() for x in self._repoquery_lines(args + ["--file", path]) if x.strip())
+            if nevras:
+                owners[path] = max(nevras, key=functools.cmp_to_key(compare_nevras))
+        return owners
+
+
+    def package_checksums(self, nvras):
+        """Return a dict of the sha256 the repo metadata has for each of the
+        RPMs in nvras (the pkgid; a sha256 of the whole RPM unless the repo was
+        made with another checksum type), by file name.  RPMs with another
+        checksum type, or with different checksums in different repos, are
+        left out.
+
+        """
+        if not nvras:
+            return {}
+        checksum_tag = "%{chksum}" if self.yum_is_dnf else "%{checksum}"
+        found = {}
+        for line in self._repoquery_lines(["--queryformat=" + NVRA_QUERYFORMAT + "\t" + checksum_tag] + list(nvras)):
+            nvra, _, checksum = line.strip().partition("\t")
+            if nvra:
+                found.setdefault(nvra + ".rpm", set()).add(_parse_sha256(checksum))
+        return dict((filename, checksums.pop()) for filename, checksums in found.items()
+                    if len(checksums) == 1 and None not in checksums)
+
+
+    def _yumdownloader_cmd(self, installroot, packages, extra_args):
+        cmd = ["yumdownloader",
+               "--releasever", self.dver[2:],
+               "--installroot", installroot,
+               "-c", self.conf_file.name,
+               "--nogpgcheck"]
+        if not self.yum_is_dnf:
+            cmd.append("--enableplugin=priorities")
+        cmd.extend(self.repo_args)
+        cmd.extend(self._cache_args())
+        cmd.extend(extra_args)
+        cmd += packages
+        return cmd
+
+    def _download_urls(self, installroot, packages, resolve):
+        """Return the URLs of the RPMs yumdownloader would download"""
+        cmd = self._yumdownloader_cmd(installroot, packages, ["-q", "--urls"] + (["--resolve"] if resolve else []))
+        with self._installroot_cache(installroot):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            output = to_str(proc.communicate()[0]).splitlines()
+        if proc.returncode:
+            raise YumDownloaderError(packages, installroot, proc.returncode, resolve)
+        return [x.strip() for x in output if '://' in x and x.strip().endswith('.rpm')]
+
+    def download(self, installroot, packages, rpm_dir, resolve=False):
+        """Download packages (and the dependencies they need in installroot,
+        if resolve) into rpm_dir.  If we have an RPM store, RPMs are taken
+        from it where possible, and the ones that had to be downloaded are
+        added to it.  Returns the paths of the RPMs.
+
+        """
+        if not self.rpm_store:
+            cmd = self._yumdownloader_cmd(installroot, packages, ["-d1", "--destdir", rpm_dir] + (["--resolve"] if resolve else []))
+            with self._installroot_cache(installroot):
+                err = subprocess.call(cmd)
+            if err:
+                raise YumDownloaderError(packages, installroot, err, resolve)
+            return glob.glob(os.path.join(rpm_dir, "*.rpm"))
+
+        filenames = sorted(set(os.path.basename(x) for x in self._download_urls(installroot, packages, resolve)))
+        try:
+            checksums = self.package_checksums([x[:-len('.rpm')] for x in filenames])
+        except subprocess.CalledProcessError:
+            checksums = {}
+        missing = self.rpm_store.checkout(filenames, rpm_dir, checksums)
+        if missing:
+            # download into a separate dir so only what we asked for goes in the store
+            download_dir = tempfile.mkdtemp(suffix='.download', dir=rpm_dir)
+            try:
+                nvras = [x[:-len('.rpm')] for x in missing]
+                cmd = self._yumdownloader_cmd(installroot, nvras, ["-d1", "--destdir", download_dir])
+                with self._installroot_cache(installroot):
+                    err = subprocess.call(cmd)
+                if err:
+                    raise YumDownloaderError(nvras, installroot, err)
+                downloaded = glob.glob(os.path.join(download_dir, "*.rpm"))
+                self.rpm_store.add(downloaded)
+                for path in downloaded:
+                    os.rename(path, os.path.join(rpm_dir, os.path.basename(path)))
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+        return glob.glob(os.path.join(rpm_dir, "*.rpm"))
+
 
     def install(self, installroot, packages):
         if not installroot:
@@ -145,6 +483,21 @@ class YumInstaller(object):
         if type(packages) in (str, bytes):
             packages = [packages]
 
+        # Get the RPMs from the store where we can, and install them as local
+        # files; yum still resolves anything they need that we don't give it.
+        # yumdownloader can't resolve groups, so let yum do all the work then.
+        rpm_dir = None
+        install_args = packages
+        if self.rpm_store and not [x for x in packages if x.startswith('@')]:
+            rpm_dir = tempfile.mkdtemp(suffix='.install')
+            install_args = self.download(installroot, packages, rpm_dir, resolve=True)
+        try:
+            self._yum_install(installroot, packages, install_args)
+        finally:
+            if rpm_dir:
+                shutil.rmtree(rpm_dir, ignore_errors=True)
+
+    def _yum_install(self, installroot, packages, install_args):
         cmd = ["yum", "install",
                "-y",
                "--installroot", installroot,
@@ -154,10 +507,12 @@ class YumInstaller(object):
         if not self.yum_is_dnf:
             cmd.append("--enableplugin=priorities")
         cmd.extend(self.repo_args)
-        cmd += packages
+        cmd.extend(self._cache_args())
+        cmd += install_args
         env = os.environ.copy()
         env.update({'LANG': 'C', 'LC_ALL': 'C'})
-        err = subprocess.call(cmd, env=env)
+        with self._installroot_cache(installroot):
+            err = subprocess.call(cmd, env=env)
         if err:
             raise YumInstallError(packages, installroot, err)
 
@@ -193,23 +548,7 @@ class YumInstaller(object):
 
         rpm_dir = tempfile.mkdtemp(suffix='.force-install')
         try:
-            cmd = ["yumdownloader",
-                   "--releasever", self.dver[2:],
-                   "--destdir", rpm_dir,
-                   "--installroot", installroot,
-                   "-c", self.conf_file.name,
-                   "-d1",
-                   "--nogpgcheck"]
-            if not self.yum_is_dnf:
-                cmd.append("--enableplugin=priorities")
-            cmd.extend(self.repo_args)
-            if resolve:
-                cmd.append('--resolve')
-            cmd += packages
-            err = subprocess.call(cmd)
-            if err:
-                raise YumDownloaderError(packages, installroot, err, resolve)
-            rpms = glob.glob(os.path.join(rpm_dir, "*.rpm"))
+            rpms = self.download(installroot, packages, rpm_dir, resolve)
             cmd = ["rpm",
                    "--install",
                    "--verbose",